@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, transaction
 from cognigrade.utils.models import BaseModel
 from cognigrade.courses.models import Classroom
 from cognigrade.accounts.models import User
@@ -8,6 +8,46 @@ class OMR(BaseModel):
     classroom = models.ForeignKey(Classroom, on_delete=models.CASCADE)
     title = models.CharField(max_length=255)
 
+    @transaction.atomic
+    def record_submissions(self, results):
+        """
+        Create or update the submission of every graded sheet whose QR code
+        identifies a student of the classroom, by user id or email.
+
+        Sets 'submission' on each graded result: the submission id, or None
+        when no student was identified. When several sheets identify the same
+        student none of them is recorded, since there is no telling which is
+        theirs; each gets 'conflict', the names of the other sheets.
+        """
+        students = {}
+        for student in self.classroom.enrollments.all():
+            students[str(student.pk)] = student
+            students[student.email.lower()] = student
+
+        sheets = {}
+        for result in results:
+            if 'error' in result:
+                continue
+            student = students.get((result.get('student_info') or '').strip().lower())
+            result['submission'] = None
+            if student is not None:
+                sheets.setdefault(student, []).append(result)
+
+        for student, graded in sheets.items():
+            if len(graded) > 1:
+                for result in graded:
+                    result['conflict'] = [other['name'] for other in graded if other is not result]
+                continue
+            result = graded[0]
+            submission = self.submissions.filter(user=student).first()
+            if submission is None:
+                submission = OMRSubmission.objects.create(omr=self, user=student, score=result['score'])
+            elif submission.score != result['score']:
+                submission.score = result['score']
+                submission.save(update_fields=['score', 'updated_on'])
+            result['submission'] = submission.id
+        return results
+
 
 class OMRQuestions(BaseModel):
     omr = models.ForeignKey(OMR, on_delete=models.CASCADE, related_name='questions')
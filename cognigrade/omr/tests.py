@@ -1,3 +1,429 @@
-from django.test import TestCase
+import io
+import os
+import zipfile
+import tempfile
+from unittest.mock import MagicMock, patch
+import cv2
+import numpy as np
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+from rest_framework import status
 
-# Create your tests here.
+from cognigrade.accounts.models import User
+from cognigrade.accounts.choices import RoleChoices
+from cognigrade.institutions.models import Institutions
+from cognigrade.courses.models import Course, Classroom
+from cognigrade.omr.models import OMR, OMRQuestions, OMRSubmission
+from cognigrade.utils import process_omr
+from cognigrade.utils.process_omr import correct_perspective_pyramid, detect_bubbles, grade_sheet, locate_qr_code, process_omr_batch
+
+ANSWER_KEY = [(question % 4) + 1 for question in range(30)]
+
+
+def make_sheet(answers, extension='.png', mark=30):
+    """
+    Encoded photo of a filled sheet: 3 columns of 10 questions with 4 options,
+    on a dark background so the sheet outline is the largest quadrilateral.
+
+    answers holds the option (1-4) filled for each question, or None; each is
+    marked with a square of mark pixels centred in the option's 40px slot.
+    """
+    image = np.full((500, 700, 3), 40, dtype=np.uint8)
+    sheet = np.full((400, 600, 3), 255, dtype=np.uint8)
+    for question, option in enumerate(answers):
+        if option is None:
+            continue
+        column, row = divmod(question, 10)
+        x = column * 200 + option * 40 + (40 - mark) // 2
+        y = row * 40 + (40 - mark) // 2
+        sheet[y:y + mark, x:x + mark] = 0
+    image[50:450, 50:650] = sheet
+    return cv2.imencode(extension, image)[1].tobytes()
+
+
+def make_photo(answers, corners, size=(2400, 1800), mark=30):
+    """A sheet from make_sheet photographed at an angle: its corners land on corners of a size (width, height) image"""
+    sheet = cv2.imdecode(np.frombuffer(make_sheet(answers, mark=mark), np.uint8), cv2.IMREAD_COLOR)[50:450, 50:650]
+    M = cv2.getPerspectiveTransform(
+        np.array([[0, 0], [599, 0], [599, 399], [0, 399]], dtype="float32"),
+        np.array(corners, dtype="float32")
+    )
+    return cv2.warpPerspective(sheet, M, size, borderValue=(40, 40, 40))
+
+
+def detect_bubbles_per_roi(processed_img, options=4, columns=3, rows=10):
+    """Bubble detection one ROI at a time, as detect_bubbles used to do it"""
+    height, width = processed_img.shape[:2]
+    cell_width = width // columns
+    cell_height = height // rows
+    option_width = cell_width // (options + 1)
+    padding = 7
+    student_answers = []
+    for col in range(columns):
+        for row in range(rows):
+            x_start = col * cell_width
+            y_start = row * cell_height
+            candidates = []
+            for option in range(1, options + 1):
+                ox_start = x_start + (option * option_width)
+                option_roi = processed_img[y_start + padding:y_start + cell_height - padding, ox_start + padding:ox_start + option_width - padding]
+                if option_roi.size == 0:
+                    continue
+                if cv2.countNonZero(option_roi) / option_roi.size > 0.2:
+                    candidates.append(option)
+            if len(candidates) == 1:
+                student_answers.append(chr(64 + candidates[0]))
+            else:
+                student_answers.append('X' if candidates else '?')
+    return student_answers
+
+
+class BubbleDetectionTestCase(TestCase):
+    """Test cases for vectorized bubble detection"""
+
+    def test_matches_per_roi_detection(self):
+        rng = np.random.default_rng(0)
+        for height, width in ((400, 600), (1123, 794), (97, 151)):
+            # Blocks of varying density so sheets mix empty, single and multiple marks
+            density = rng.random((height // 8 + 1, width // 8 + 1)) * 0.5
+            density = np.kron(density, np.ones((8, 8)))[:height, :width]
+            processed = np.where(rng.random((height, width)) < density, 255, 0).astype(np.uint8)
+
+            answers = detect_bubbles(processed, None)
+            self.assertEqual(answers, detect_bubbles_per_roi(processed))
+            self.assertEqual(len(answers), 30)
+
+    def test_other_layouts(self):
+        processed = cv2.threshold(cv2.imdecode(np.frombuffer(make_sheet(ANSWER_KEY), np.uint8), cv2.IMREAD_GRAYSCALE), 120, 255, cv2.THRESH_BINARY_INV)[1]
+        processed = processed[50:450, 50:650]
+
+        self.assertEqual(detect_bubbles(processed, None), [chr(64 + answer) for answer in ANSWER_KEY])
+        self.assertEqual(
+            detect_bubbles(processed, None, options=5, columns=2, rows=20),
+            detect_bubbles_per_roi(processed, options=5, columns=2, rows=20)
+        )
+
+
+@override_settings(OMR_PYRAMID=True, OMR_SHEET_WIDTH=600, OMR_SHEET_HEIGHT=400)
+class PyramidPerspectiveTestCase(TestCase):
+    """Test cases for finding the sheet at reduced resolution"""
+
+    def setUp(self):
+        self.correct_answers = [chr(64 + answer) for answer in ANSWER_KEY]
+        self.photo = make_photo(ANSWER_KEY, [[310, 220], [2150, 160], [2230, 1500], [240, 1620]])
+
+    def test_warps_to_canonical_size(self):
+        reduced = cv2.imdecode(cv2.imencode('.jpg', self.photo)[1], cv2.IMREAD_REDUCED_GRAYSCALE_4)
+        for corrected, scale in (correct_perspective_pyramid(self.photo, reduced), correct_perspective_pyramid(self.photo)):
+            self.assertEqual(corrected.shape, (400, 600, 3))
+            # The sheet spans about 1900 x 1350 pixels of the photo
+            np.testing.assert_allclose(scale, (400 / 1350, 600 / 1900), rtol=0.05)
+            processed = cv2.threshold(cv2.cvtColor(corrected, cv2.COLOR_BGR2GRAY), 120, 255, cv2.THRESH_BINARY_INV)[1]
+            self.assertEqual(detect_bubbles(processed, corrected), self.correct_answers)
+
+    def test_grades_photo(self):
+        for extension in ('.jpg', '.png'):
+            results = process_omr_batch([('photo', cv2.imencode(extension, self.photo)[1].tobytes())], self.correct_answers, workers=1)
+            self.assertEqual(results[0]['score'], 30)
+
+    def test_without_outline_resizes(self):
+        blank = np.full((800, 1000, 3), 255, dtype=np.uint8)
+
+        corrected, scale = correct_perspective_pyramid(blank)
+        self.assertEqual(corrected.shape, (400, 600, 3))
+        self.assertEqual(scale, (0.5, 0.6))
+        self.assertEqual(grade_sheet(blank, self.correct_answers)['score'], 0)
+
+    @override_settings(OMR_SHEET_WIDTH=827, OMR_SHEET_HEIGHT=1169)
+    def test_matches_full_resolution_grading(self):
+        # Small marks fill under a fifth of a bubble at full resolution, and
+        # would fill more than that if the padding weren't scaled to the canonical size
+        for mark in (30, 15, 10):
+            photo = make_photo(ANSWER_KEY, [[310, 220], [2150, 160], [2230, 1500], [240, 1620]], mark=mark)
+            pyramid = grade_sheet(photo, self.correct_answers)
+            with override_settings(OMR_PYRAMID=False):
+                full = grade_sheet(photo, self.correct_answers)
+            self.assertEqual(pyramid['answers'], full['answers'])
+            self.assertEqual(pyramid['score'], full['score'])
+
+
+class FakeQRDecoder:
+    """Stands in for pyzbar.decode: finds a code in grayscale images only, or in colour images only"""
+
+    def __init__(self, data, grayscale=True):
+        self.data = data
+        self.grayscale = grayscale
+        self.shapes = []
+
+    def __call__(self, image):
+        self.shapes.append(image.shape)
+        if self.data is not None and (image.ndim == 2) == self.grayscale:
+            return [MagicMock(data=self.data.encode('utf-8'))]
+        return []
+
+
+class QRCodeTestCase(TestCase):
+    """Test cases for region-first QR decoding"""
+
+    def setUp(self):
+        self.corrected = np.full((1169, 827, 3), 255, dtype=np.uint8)
+        self.original = np.full((3000, 4000, 3), 255, dtype=np.uint8)
+
+    @override_settings(OMR_QR_REGION=(0.5, 0.0, 1.0, 0.5), OMR_QR_MAX_SIDE=200)
+    def test_region_is_cropped_and_downscaled(self):
+        decoder = FakeQRDecoder('42')
+        with patch('cognigrade.utils.process_omr.pyzbar.decode', decoder):
+            self.assertEqual(locate_qr_code(self.corrected, self.original), ('42', 'region'))
+
+        # The 414x584 region, shrunk so its longer side is 200 pixels
+        self.assertEqual(decoder.shapes, [(200, 142)])
+
+    def test_falls_back_to_full_image(self):
+        decoder = FakeQRDecoder('42', grayscale=False)
+        with patch('cognigrade.utils.process_omr.pyzbar.decode', decoder):
+            self.assertEqual(locate_qr_code(self.corrected, self.original), ('42', 'full'))
+
+        self.assertEqual(decoder.shapes[-1], self.original.shape)
+
+    def test_not_found(self):
+        with patch('cognigrade.utils.process_omr.pyzbar.decode', FakeQRDecoder(None)):
+            self.assertEqual(locate_qr_code(self.corrected, self.original), (None, None))
+
+
+class OMRProcessingTestCase(TestCase):
+    """Test cases for grading single sheets and stacks of OMR sheets"""
+
+    def setUp(self):
+        self.institution = Institutions.objects.create(name="Test University", location="Test City")
+        self.teacher = User.objects.create(
+            email="teacher@example.com",
+            first_name="Test",
+            last_name="Teacher",
+            role=RoleChoices.TEACHER,
+            institution=self.institution,
+            is_active=True
+        )
+        self.student = User.objects.create(
+            email="Student1@example.com",
+            first_name="Student",
+            last_name="One",
+            role=RoleChoices.STUDENT,
+            institution=self.institution,
+            is_active=True
+        )
+        self.course = Course.objects.create(name="Computer Science 101", code="CS101", institution=self.institution)
+        self.classroom = Classroom.objects.create(name="Introduction to Programming", course=self.course, teacher=self.teacher)
+        self.classroom.enrollments.add(self.student)
+        self.omr = OMR.objects.create(classroom=self.classroom, title="Midterm")
+        for answer in ANSWER_KEY:
+            OMRQuestions.objects.create(omr=self.omr, answer=answer)
+
+        self.correct_answers = [chr(64 + answer) for answer in ANSWER_KEY]
+        # Half the answers right: the other half pick the next option
+        self.half_right = [answer if question % 2 == 0 else answer % 4 + 1 for question, answer in enumerate(ANSWER_KEY)]
+        self.client = APIClient()
+
+    def test_failed_sheet_is_isolated(self):
+        sheets = [('full.png', make_sheet(ANSWER_KEY)), ('broken.png', b'not an image'), ('half.png', make_sheet(self.half_right))]
+        results = process_omr_batch(sheets, self.correct_answers, workers=1)
+
+        self.assertEqual([result['name'] for result in results], ['full.png', 'broken.png', 'half.png'])
+        self.assertEqual(results[0]['score'], 30)
+        self.assertEqual(results[0]['answers'], self.correct_answers)
+        self.assertIn('error', results[1])
+        self.assertEqual(results[2]['score'], 15)
+
+    def test_process_pool_matches_inline(self):
+        sheets = [(f'{index}.png', make_sheet(ANSWER_KEY if index % 2 else self.half_right)) for index in range(4)]
+        sheets.append(('broken.png', b'not an image'))
+
+        self.assertEqual(
+            process_omr_batch(sheets, self.correct_answers, workers=2),
+            process_omr_batch(sheets, self.correct_answers, workers=1)
+        )
+
+    @override_settings(OMR_WORKERS=1)
+    def test_batch_endpoint_accepts_images_and_zip(self):
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zip_file:
+            zip_file.writestr('scans/b.png', make_sheet(self.half_right))
+            zip_file.writestr('scans/a.jpg', make_sheet(ANSWER_KEY, '.jpg'))
+            zip_file.writestr('scans/notes.txt', 'ignored')
+
+        self.client.force_authenticate(user=self.teacher)
+        response = self.client.post(
+            reverse('omr-process-omr-batch', kwargs={'pk': self.omr.id}),
+            {'images': [
+                SimpleUploadedFile('single.png', make_sheet(ANSWER_KEY), content_type='image/png'),
+                SimpleUploadedFile('scans.zip', archive.getvalue(), content_type='application/zip'),
+            ]},
+            format='multipart'
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['processed'], 3)
+        self.assertEqual(response.data['failed'], 0)
+        self.assertEqual(
+            [(result['name'], result['score']) for result in response.data['results']],
+            [('single.png', 30), ('scans.zip/scans/a.jpg', 30), ('scans.zip/scans/b.png', 15)]
+        )
+
+    @override_settings(OMR_BATCH_MAX_SHEETS=1)
+    def test_batch_endpoint_limits_sheets(self):
+        self.client.force_authenticate(user=self.teacher)
+        response = self.client.post(
+            reverse('omr-process-omr-batch', kwargs={'pk': self.omr.id}),
+            {'images': [
+                SimpleUploadedFile('a.png', make_sheet(ANSWER_KEY), content_type='image/png'),
+                SimpleUploadedFile('b.png', make_sheet(ANSWER_KEY), content_type='image/png'),
+            ]},
+            format='multipart'
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(OMR_BATCH_MAX_SHEETS=2, OMR_BATCH_MAX_BYTES=1024)
+    def test_archives_are_checked_before_reading(self):
+        def archive(names, size=10):
+            data = io.BytesIO()
+            with zipfile.ZipFile(data, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+                for name in names:
+                    zip_file.writestr(name, b'0' * size)
+            data.seek(0)
+            data.name = 'scans.zip'
+            return data
+
+        with patch.object(zipfile.ZipFile, 'read') as read:
+            for upload in (
+                archive(['a.png', 'b.png', 'c.png']),
+                archive([f'{index}.txt' for index in range(5)]),
+                archive(['a.png'], size=2048),
+            ):
+                with self.assertRaises(ValueError):
+                    process_omr.read_sheets([upload])
+            read.assert_not_called()
+
+        self.assertEqual(len(process_omr.read_sheets([archive(['a.png', 'b.png', 'notes.txt'])])), 2)
+
+    def test_batch_endpoint_is_for_teachers(self):
+        self.client.force_authenticate(user=self.student)
+        response = self.client.post(
+            reverse('omr-process-omr-batch', kwargs={'pk': self.omr.id}),
+            {'images': [SimpleUploadedFile('a.png', make_sheet(ANSWER_KEY), content_type='image/png')]},
+            format='multipart'
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_only_staff_submit_single_sheets(self):
+        self.client.force_authenticate(user=self.student)
+        url = reverse('omr-process-omr', kwargs={'pk': self.omr.id})
+
+        def post(**data):
+            with patch('cognigrade.utils.process_omr.pyzbar.decode', FakeQRDecoder(str(self.student.id))):
+                return self.client.post(url, {
+                    'image': SimpleUploadedFile('sheet.png', make_sheet(ANSWER_KEY), content_type='image/png'),
+                    **data
+                }, format='multipart')
+
+        self.assertEqual(post(submit='true').status_code, status.HTTP_403_FORBIDDEN)
+        self.assertFalse(OMRSubmission.objects.exists())
+        # Grading without recording stays open to students
+        self.assertEqual(post().data['score'], 30)
+
+    def process(self, media_root, **settings):
+        self.client.force_authenticate(user=self.teacher)
+        with override_settings(MEDIA_ROOT=media_root, **settings):
+            response = self.client.post(
+                reverse('omr-process-omr', kwargs={'pk': self.omr.id}),
+                {'image': SimpleUploadedFile('sheet.png', make_sheet(self.half_right), content_type='image/png')},
+                format='multipart'
+            )
+            # The artifact writer is a single thread, so this waits for queued writes
+            process_omr._artifact_writer.submit(lambda: None).result()
+        return response
+
+    def test_process_in_memory(self):
+        with tempfile.TemporaryDirectory() as media_root:
+            response = self.process(media_root, OMR_DEBUG_ARTIFACTS=False)
+
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data['score'], 15)
+            self.assertEqual(os.listdir(media_root), [])
+
+    def test_debug_artifacts(self):
+        with tempfile.TemporaryDirectory() as media_root:
+            response = self.process(media_root, OMR_DEBUG_ARTIFACTS=True)
+
+            self.assertEqual(response.data['score'], 15)
+            self.assertEqual(len(os.listdir(os.path.join(media_root, 'scanned-omr'))), 1)
+
+    def test_artifact_errors_are_logged(self):
+        with tempfile.NamedTemporaryFile() as blocker:
+            # A file where the artifact directory should be
+            with self.assertLogs('cognigrade.utils.process_omr', level='WARNING') as logs:
+                process_omr._write_artifact(os.path.join(blocker.name, 'sheet.jpg'), np.zeros((4, 4), dtype=np.uint8))
+
+        self.assertIn('Error writing OMR debug artifact', logs.output[0])
+
+    @override_settings(OMR_WORKERS=1)
+    def test_batch_submissions_from_qr_codes(self):
+        url = reverse('omr-process-omr-batch', kwargs={'pk': self.omr.id})
+        self.client.force_authenticate(user=self.teacher)
+
+        def post(sheet, student_info):
+            with patch('cognigrade.utils.process_omr.pyzbar.decode', FakeQRDecoder(student_info)):
+                return self.client.post(url, {
+                    'images': [SimpleUploadedFile('sheet.png', make_sheet(sheet), content_type='image/png')],
+                    'submit': 'true'
+                }, format='multipart')
+
+        result = post(self.half_right, str(self.student.id)).data['results'][0]
+        self.assertEqual((result['student_info'], result['qr_path'], result['score']), (str(self.student.id), 'region', 15))
+        submission = OMRSubmission.objects.get(omr=self.omr, user=self.student)
+        self.assertEqual((result['submission'], submission.score), (submission.id, 15))
+
+        # A rescan by email updates the same submission
+        graded_on = submission.updated_on
+        result = post(ANSWER_KEY, 'student1@example.com').data['results'][0]
+        self.assertEqual(result['submission'], submission.id)
+        submission.refresh_from_db()
+        self.assertEqual(submission.score, 30)
+        self.assertGreater(submission.updated_on, graded_on)
+
+        self.assertIsNone(post(ANSWER_KEY, 'someone@example.com').data['results'][0]['submission'])
+        self.assertEqual(OMRSubmission.objects.count(), 1)
+
+    @override_settings(OMR_WORKERS=1)
+    def test_batch_reports_conflicting_sheets(self):
+        self.client.force_authenticate(user=self.teacher)
+        with patch('cognigrade.utils.process_omr.pyzbar.decode', FakeQRDecoder(str(self.student.id))):
+            response = self.client.post(reverse('omr-process-omr-batch', kwargs={'pk': self.omr.id}), {
+                'images': [
+                    SimpleUploadedFile('a.png', make_sheet(self.half_right), content_type='image/png'),
+                    SimpleUploadedFile('b.png', make_sheet(ANSWER_KEY), content_type='image/png'),
+                ],
+                'submit': 'true'
+            }, format='multipart')
+
+        self.assertEqual(response.data['conflicts'], 2)
+        results = sorted(response.data['results'], key=lambda result: result['name'])
+        self.assertEqual([result['conflict'] for result in results], [['b.png'], ['a.png']])
+        self.assertEqual([result['submission'] for result in results], [None, None])
+        self.assertFalse(OMRSubmission.objects.exists())
+
+    def test_process_without_submit(self):
+        self.client.force_authenticate(user=self.teacher)
+        with patch('cognigrade.utils.process_omr.pyzbar.decode', FakeQRDecoder(str(self.student.id))):
+            response = self.client.post(
+                reverse('omr-process-omr', kwargs={'pk': self.omr.id}),
+                {'image': SimpleUploadedFile('sheet.png', make_sheet(ANSWER_KEY), content_type='image/png')},
+                format='multipart'
+            )
+
+        self.assertEqual(response.data['student_info'], str(self.student.id))
+        self.assertEqual(response.data['qr_path'], 'region')
+        self.assertNotIn('submission', response.data)
+        self.assertFalse(OMRSubmission.objects.exists())
@@ -1,14 +1,13 @@
 from rest_framework import viewsets
 from rest_framework.permissions import IsAuthenticated
+from cognigrade.accounts.permissions import IsSuperAdminUser, IsAdminUser, IsTeacher
 from .models import OMR, OMRSubmission
 from .serializer import OMRSerializer, OMRSubmissionSerializer
 from cognigrade.utils.paginations import PagePagination
-from cognigrade.utils.process_omr import process_omr
+from cognigrade.utils.process_omr import process_omr_batch, process_sheet, read_sheets, upload_buffer
 from rest_framework.response import Response
 from rest_framework import status
-import os
-from django.conf import settings
-import random
+import zipfile
 from rest_framework.decorators import action
 
 # Create your views here.
@@ -23,7 +22,7 @@ class OMRViewSet(viewsets.ModelViewSet):
         if user.role == 'teacher':
             return OMR.objects.filter(classroom__teacher=user)
         elif user.role == 'student':
-            return OMR.objects.filter(classroom__enrollments__student=user)
+            return OMR.objects.filter(classroom__enrollments=user)
         elif user.role == 'admin':
             return OMR.objects.filter(classroom__course__institution=user.institution)
         elif user.role == 'superadmin':
@@ -37,6 +36,11 @@ class OMRViewSet(viewsets.ModelViewSet):
         
         if not image_file:
             return Response({'error': 'No image file provided'}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Anyone who can see the OMR may grade a sheet, only staff may record it as a submission
+        submit = str(request.data.get('submit', False)).lower() in ('true', '1')
+        if submit and not (IsSuperAdminUser|IsAdminUser|IsTeacher)().has_permission(request, self):
+            self.permission_denied(request)
         
         correct_answers = [chr(64 + answer) for answer in omr.questions.values_list('answer', flat=True)]
         # correct_answers = [0] * 30
@@ -44,11 +48,51 @@ class OMRViewSet(viewsets.ModelViewSet):
         #     correct_answers[i] = answer
         # print("correct_answers", correct_answers)
 
-        image_path = os.path.join(settings.MEDIA_ROOT, 'omr', f"{image_file.name}_{random.randint(1, 1000000)}.jpg")
-        with open(image_path, 'wb') as f:
-            f.write(image_file.read())
-        score, answers = process_omr(image_path, correct_answers)
-        return Response({'score': score, 'answers': answers}, status=status.HTTP_200_OK)
+        result = process_sheet(image_file.name, upload_buffer(image_file), correct_answers)
+        if 'error' in result:
+            return Response({'score': 0, 'answers': [], 'error': result['error']}, status=status.HTTP_200_OK)
+
+        # Sheets whose QR code names a student of the classroom become their submission
+        if submit:
+            omr.record_submissions([result])
+        result.pop('name')
+        return Response(result, status=status.HTTP_200_OK)
+
+    @action(url_path='process-batch', detail=True, methods=['POST'], permission_classes=[IsSuperAdminUser|IsAdminUser|IsTeacher])
+    def process_omr_batch(self, request, pk=None):
+        """
+        Grade a stack of sheets uploaded as 'images' files and/or ZIP archives of images.
+        With 'submit', sheets whose QR code names a student of the classroom become their submission,
+        unless several sheets name the same student: those are reported as conflicts instead.
+        """
+        omr = self.get_object()
+        uploads = request.FILES.getlist('images')
+
+        if not uploads:
+            return Response({'error': 'No image files provided'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            sheets = read_sheets(uploads)
+        except (ValueError, zipfile.BadZipFile) as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if not sheets:
+            return Response({'error': 'No images found in the upload'}, status=status.HTTP_400_BAD_REQUEST)
+
+        correct_answers = [chr(64 + answer) for answer in omr.questions.values_list('answer', flat=True)]
+        results = process_omr_batch(sheets, correct_answers)
+        submit = str(request.data.get('submit', False)).lower() in ('true', '1')
+        if submit:
+            omr.record_submissions(results)
+        failed = sum(1 for result in results if 'error' in result)
+        response = {
+            'processed': len(results) - failed,
+            'failed': failed,
+            'results': results
+        }
+        if submit:
+            # Sheets left unrecorded because another sheet identifies the same student
+            response['conflicts'] = sum(1 for result in results if 'conflict' in result)
+        return Response(response, status=status.HTTP_200_OK)
 
 
 class OMRSubmissionViewSet(viewsets.ModelViewSet):
@@ -11,7 +11,7 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
 from pathlib import Path
-from decouple import config
+from decouple import config, Csv
 from datetime import timedelta
 from django.conf import settings
 import os
@@ -55,6 +55,7 @@ INSTALLED_APPS = [
 ]
 
 OWN_APPS = [
+    'cognigrade.utils',
     'cognigrade.accounts',
     'cognigrade.institutions',
     'cognigrade.courses',
@@ -209,6 +210,155 @@ MEDIA_URLS ='/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
 
+# Embedding models
+# Models load lazily on first use. Enable warm-up to load them when the WSGI
+# worker starts instead of on its first grading/plagiarism request; the
+# readiness probe then reports 503 until they are loaded.
+
+EMBEDDING_WARMUP = config('EMBEDDING_WARMUP', default=False, cast=bool)
+
+# Pin a Hugging Face revision per answer type, e.g. {'short': '<commit sha>'}.
+# Unpinned models use the commit first downloaded into the local model cache.
+# The revision is part of every embedding cache key, so changing it
+# invalidates cached vectors for that model.
+EMBEDDING_MODEL_REVISIONS = {}
+
+# Inference backend per answer type: 'torch' (fp32, default), 'torch-int8',
+# 'onnx' or 'onnx-int8', e.g. {'long': 'onnx-int8'}. ONNX backends need
+# sentence-transformers[onnx]. Check a backend with
+# `manage.py check_embedding_parity` before enabling it.
+EMBEDDING_BACKENDS = {}
+
+# Instruction set targeted by the onnx-int8 export: 'arm64', 'avx2', 'avx512' or 'avx512_vnni'
+EMBEDDING_ONNX_QUANTIZATION = config('EMBEDDING_ONNX_QUANTIZATION', default='avx2')
+
+# Largest similarity difference from fp32 a backend may show in the parity check
+EMBEDDING_PARITY_TOLERANCE = 0.02
+
+# Out-of-process embedding service started with `manage.py run_embedding_worker`,
+# at a Unix socket path ('/run/cognigrade/embeddings.sock' or 'unix:/path') or,
+# explicitly, 'tcp:host:port'. When set, web workers don't load models: texts
+# missing from the embedding cache are sent to the service, which batches
+# concurrent requests into shared forward passes.
+EMBEDDING_SERVICE_ADDRESS = config('EMBEDDING_SERVICE_ADDRESS', default='')
+# Shared secret of the service and its clients, required to use the service.
+# Connections exchange pickles, so keep it random and private, e.g.
+# python -c "import secrets; print(secrets.token_urlsafe(32))"
+EMBEDDING_SERVICE_AUTHKEY = config('EMBEDDING_SERVICE_AUTHKEY', default='')
+# The service waits at most this long (seconds) for more requests to join a
+# batch, and stops collecting once a batch holds this many texts
+EMBEDDING_SERVICE_MAX_LATENCY = config('EMBEDDING_SERVICE_MAX_LATENCY', default=0.01, cast=float)
+EMBEDDING_SERVICE_MAX_BATCH = config('EMBEDDING_SERVICE_MAX_BATCH', default=256, cast=int)
+
+# Largest number of texts per forward pass when encoding in bulk
+EMBEDDING_BATCH_SIZE = config('EMBEDDING_BATCH_SIZE', default=128, cast=int)
+# Texts are bucketed by token length; a forward pass holds at most this many
+# tokens once padded to its longest text
+EMBEDDING_TOKEN_BUDGET = config('EMBEDDING_TOKEN_BUDGET', default=16384, cast=int)
+
+# Number of embeddings kept in each worker's in-process LRU cache
+EMBEDDING_CACHE_SIZE = config('EMBEDDING_CACHE_SIZE', default=20000, cast=int)
+
+# Persist embeddings to the database so they survive restarts and are shared
+# between workers
+EMBEDDING_CACHE_PERSIST = config('EMBEDDING_CACHE_PERSIST', default=True, cast=bool)
+
+# Number of (answer, key) grading results kept in each worker's LRU cache, so
+# re-running an evaluation only re-grades answers or keys that changed
+GRADING_CACHE_SIZE = config('GRADING_CACHE_SIZE', default=50000, cast=int)
+
+# Answer embedding store. 'memmap' keeps each theory's and question's
+# embeddings as contiguous .npy files under EMBEDDING_STORE_ROOT, appended as
+# submissions arrive and memory-mapped by every worker. 'pgvector' keeps them
+# in a vector column in PostgreSQL (needs the vector extension, the table is
+# created by the theory migrations) and runs plagiarism candidate search as
+# an indexed SQL query. Empty disables it.
+EMBEDDING_STORE = config('EMBEDDING_STORE', default='')
+EMBEDDING_STORE_ROOT = os.path.join(MEDIA_ROOT, 'embeddings')
+# 'float16' halves the files at a small precision cost
+EMBEDDING_STORE_DTYPE = config('EMBEDDING_STORE_DTYPE', default='float32')
+# Questions whose memmap row index each process keeps in memory
+EMBEDDING_STORE_LOOKUPS = config('EMBEDDING_STORE_LOOKUPS', default=256, cast=int)
+
+# Memory (bytes) one tile of a pairwise similarity matrix may use. Large
+# cohorts are compared tile by tile so peak memory stays flat.
+SIMILARITY_TILE_MEMORY = config('SIMILARITY_TILE_MEMORY', default=64 * 1024 * 1024, cast=int)
+
+# Lexical MinHash/LSH stage for plagiarism. Answers whose character shingle
+# Jaccard similarity reaches the threshold are copies: they are flagged with
+# 1.0, and only one answer of each group of copies is encoded and scored
+# against the other answers, its scores standing for the whole group.
+LEXICAL_PREFILTER = config('LEXICAL_PREFILTER', default=True, cast=bool)
+LEXICAL_DUPLICATE_THRESHOLD = config('LEXICAL_DUPLICATE_THRESHOLD', default=0.9, cast=float)
+MINHASH_NUM_PERM = 128
+MINHASH_BANDS = 32
+
+# Cascade mode for long and paraphrased answers: every pair is scored with the
+# MiniLM ('short') model and only pairs within the band of the threshold are
+# re-scored with the answer type's mpnet model. Pairs above the band keep the
+# MiniLM score. A wider band trades throughput for recall.
+PLAGIARISM_CASCADE = config('PLAGIARISM_CASCADE', default=False, cast=bool)
+PLAGIARISM_CASCADE_BAND = config('PLAGIARISM_CASCADE_BAND', default=0.1, cast=float)
+
+# Batch plagiarism checks on questions with at least BINARY_PREFILTER_MIN_ANSWERS
+# answers compare 1-bit sign codes of the embeddings by Hamming distance first;
+# only pairs within the radius implied by the threshold get an exact cosine.
+# The radius is widened by BINARY_PREFILTER_MARGIN (a fraction of the
+# dimensions), or calibrated on BINARY_PREFILTER_SAMPLE random pairs when unset.
+# A question whose sample shows more than BINARY_PREFILTER_MAX_CANDIDATES of
+# its pairs within the radius is scored exactly instead, since the prefilter
+# would cost more than it saves. Off by default: with numpy, the exact tiled
+# product is faster unless the radius dismisses almost every pair.
+BINARY_PREFILTER = config('BINARY_PREFILTER', default=False, cast=bool)
+BINARY_PREFILTER_MARGIN = config('BINARY_PREFILTER_MARGIN', default='', cast=lambda value: float(value) if value else None)
+BINARY_PREFILTER_SAMPLE = config('BINARY_PREFILTER_SAMPLE', default=4096, cast=int)
+BINARY_PREFILTER_MAX_CANDIDATES = config('BINARY_PREFILTER_MAX_CANDIDATES', default=0.05, cast=float)
+BINARY_PREFILTER_MIN_ANSWERS = config('BINARY_PREFILTER_MIN_ANSWERS', default=256, cast=int)
+
+# Plagiarism checks store the per-question similarities above this floor, so
+# later checks at any threshold at or above it replay stored scores instead of
+# recomputing them. Lower floors store more pairs (about n^2/2 per question
+# near 0); an empty value stores only the pairs above each check's threshold.
+PLAGIARISM_SCORE_FLOOR = config('PLAGIARISM_SCORE_FLOOR', default='0.5', cast=lambda value: float(value) if value else None)
+
+# Approximate nearest-neighbour indexes for cross-theory plagiarism search,
+# one directory per course, question lineage and answer type
+ANN_INDEX_ROOT = os.path.join(MEDIA_ROOT, 'ann')
+# Indexes are searched exhaustively until they hold this many answers, then
+# clustered again each time they double
+ANN_MIN_TRAIN_SIZE = config('ANN_MIN_TRAIN_SIZE', default=1024, cast=int)
+# Submitted answers are indexed on a background thread after commit; when
+# off they are indexed right after commit, still outside the transaction
+ANN_INDEX_IN_BACKGROUND = config('ANN_INDEX_IN_BACKGROUND', default=True, cast=bool)
+# Number of clusters scanned per query
+ANN_NPROBE = config('ANN_NPROBE', default=8, cast=int)
+
+# OMR batch scanning. Sheets are graded over a process pool with one process
+# per core unless OMR_WORKERS is set. A batch holds at most OMR_BATCH_MAX_SHEETS
+# sheets and OMR_BATCH_MAX_BYTES of images once ZIP archives are expanded; an
+# archive may list at most twice OMR_BATCH_MAX_SHEETS entries.
+OMR_WORKERS = config('OMR_WORKERS', default=0, cast=int)
+OMR_BATCH_MAX_SHEETS = config('OMR_BATCH_MAX_SHEETS', default=1000, cast=int)
+OMR_BATCH_MAX_BYTES = config('OMR_BATCH_MAX_BYTES', default=1024 * 1024 * 1024, cast=int)
+# Write every thresholded sheet to MEDIA_ROOT/scanned-omr (in the background)
+# for debugging or auditing; sheets are otherwise processed in memory only
+OMR_DEBUG_ARTIFACTS = config('OMR_DEBUG_ARTIFACTS', default=False, cast=bool)
+# Pyramid mode: find the sheet outline on a quarter-size grayscale decode and
+# warp the full-resolution photo straight to OMR_SHEET_WIDTH x OMR_SHEET_HEIGHT
+# pixels (A4 at 100 dpi by default), so bubbles are always sampled on the same grid
+OMR_PYRAMID = config('OMR_PYRAMID', default=False, cast=bool)
+OMR_SHEET_WIDTH = config('OMR_SHEET_WIDTH', default=827, cast=int)
+OMR_SHEET_HEIGHT = config('OMR_SHEET_HEIGHT', default=1169, cast=int)
+# Where the sheet template prints the student's QR code, as 'x0,y0,x1,y1'
+# fractions of the warped sheet. The region is shrunk to at most
+# OMR_QR_MAX_SIDE pixels before decoding; the whole photo is only searched
+# when no code is found there.
+OMR_QR_REGION = config('OMR_QR_REGION', default='0.7,0,1,0.3', cast=Csv(float, post_process=tuple))
+OMR_QR_MAX_SIDE = config('OMR_QR_MAX_SIDE', default=400, cast=int)
+# Django rejects requests with more files than this; multi-file batch uploads need it raised
+DATA_UPLOAD_MAX_NUMBER_FILES = config('DATA_UPLOAD_MAX_NUMBER_FILES', default=OMR_BATCH_MAX_SHEETS, cast=int)
+
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
@@ -0,0 +1,23 @@
+# Generated by Django 5.1 on 2026-10-17 12:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('theory', '0005_plagiarismrecord_threshold_used_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='theoryquestions',
+            name='answer_embedding',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='theoryquestions',
+            name='answer_embedding_model',
+            field=models.CharField(blank=True, default='', editable=False, max_length=255),
+        ),
+    ]
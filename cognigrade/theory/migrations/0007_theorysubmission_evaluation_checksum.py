@@ -0,0 +1,23 @@
+# Generated by Django 5.1 on 2026-10-17 12:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('theory', '0006_theoryquestions_answer_embedding_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='theorysubmission',
+            name='evaluated_on',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='theorysubmission',
+            name='evaluation_checksum',
+            field=models.CharField(blank=True, default='', editable=False, max_length=64),
+        ),
+    ]
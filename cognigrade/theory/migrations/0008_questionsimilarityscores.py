@@ -0,0 +1,31 @@
+# Generated by Django 5.1 on 2026-10-17 12:41
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('theory', '0007_theorysubmission_evaluation_checksum'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuestionSimilarityScores',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('updated_on', models.DateTimeField(auto_now=True)),
+                ('model_tag', models.CharField(max_length=255)),
+                ('answers_checksum', models.CharField(max_length=64)),
+                ('floor', models.FloatField()),
+                ('pairs', models.BinaryField()),
+                ('scores', models.BinaryField()),
+                ('question', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='similarity_scores', to='theory.theoryquestions')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,65 @@
+import logging
+from django.conf import settings
+from django.db import migrations, transaction
+
+logger = logging.getLogger(__name__)
+
+TABLE = f'{settings.DB_PREFIX}_answer_embedding'
+
+# Dimensions of the embedding models (MiniLM and mpnet); each gets a partial HNSW index
+INDEXED_DIMS = (384, 768)
+
+
+def create_answer_embedding_table(apps, schema_editor):
+    """Create the pgvector answer embedding table, on PostgreSQL with the vector extension only."""
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'vector'")
+        if cursor.fetchone() is None:
+            logger.info("pgvector is not available, skipping the answer embedding table")
+            return
+
+    answers_table = apps.get_model('theory', 'TheorySubmissionAnswer')._meta.db_table
+    try:
+        with transaction.atomic(using=connection.alias):
+            schema_editor.execute("CREATE EXTENSION IF NOT EXISTS vector")
+            schema_editor.execute(
+                f"CREATE TABLE IF NOT EXISTS {TABLE} ("
+                "id bigserial PRIMARY KEY, "
+                "theory_id bigint NOT NULL, "
+                "question_id bigint NOT NULL, "
+                f"answer_id bigint NOT NULL REFERENCES {answers_table} (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+                "model_tag varchar(255) NOT NULL, "
+                "fingerprint bigint NOT NULL, "
+                "dims integer NOT NULL, "
+                "embedding vector NOT NULL, "
+                "created_on timestamptz NOT NULL DEFAULT now(), "
+                "UNIQUE (answer_id, model_tag))"
+            )
+            schema_editor.execute(f"CREATE INDEX IF NOT EXISTS {TABLE}_question ON {TABLE} (question_id, model_tag)")
+            for dims in INDEXED_DIMS:
+                schema_editor.execute(
+                    f"CREATE INDEX IF NOT EXISTS {TABLE}_hnsw_{dims} ON {TABLE} "
+                    f"USING hnsw ((embedding::vector({dims})) vector_cosine_ops) WHERE dims = {dims}"
+                )
+    except Exception as e:
+        # The extension needs privileges this role may not have; the store stays unavailable
+        logger.warning(f"Could not create the pgvector answer embedding table: {str(e)}")
+
+
+def drop_answer_embedding_table(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(f"DROP TABLE IF EXISTS {TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('theory', '0008_questionsimilarityscores'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_answer_embedding_table, drop_answer_embedding_table),
+    ]
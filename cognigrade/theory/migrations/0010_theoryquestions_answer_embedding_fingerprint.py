@@ -0,0 +1,18 @@
+# Generated by Django 5.1 on 2026-10-17 12:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('theory', '0009_answer_embedding_pgvector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='theoryquestions',
+            name='answer_embedding_fingerprint',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -1,9 +1,51 @@
-from django.db import models
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections, models, transaction
+from django.utils import timezone
+import numpy as np
 from cognigrade.utils.models import BaseModel
 from cognigrade.courses.models import Classroom
 from cognigrade.accounts.models import User
-from cognigrade.utils.evaluation import grade_answer_proc
-from cognigrade.utils.plagiarism import detect_question_plagiarism
+from cognigrade.utils import ann
+from cognigrade.utils.duplicates import canonical_text
+from cognigrade.utils.embedding_cache import text_hash
+from cognigrade.utils.embedding_store import encode_answers, get_store, text_fingerprint
+from cognigrade.utils.embeddings import encode, model_tag
+from cognigrade.utils.evaluation import grade_answers_batch, grading_model_type
+from cognigrade.utils.plagiarism import detect_answer_plagiarism, detect_question_plagiarism_batch
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PLAGIARISM_THRESHOLDS = {
+    'short': 0.9,
+    'long': 0.85,
+    'paraphrased': 0.8
+}
+
+def evaluation_checksum(answers):
+    """
+    Fingerprint of everything a submission's grade depends on.
+
+    Covers each answer's text and its question's key, marks, answer type and
+    grading model, so any change to them makes the submission dirty.
+
+    Args:
+        answers: The submission's answers, with their question loaded
+    """
+    tags = {}
+    parts = []
+    for answer in sorted(answers, key=lambda answer: answer.question_id):
+        question = answer.question
+        if question.answer_type not in tags:
+            tags[question.answer_type] = model_tag(grading_model_type(question.answer_type))
+        parts.append(
+            f"{question.id}:{question.marks}:{question.answer_type}:{tags[question.answer_type]}:"
+            f"{text_hash(question.answer)}:{text_hash(answer.answer)}"
+        )
+    return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
 
 class TheoryType(models.TextChoices):
     ASSIGNMENT = 'assignment'
@@ -20,6 +62,192 @@ class Theory(BaseModel):
     title = models.CharField(max_length=255)
     type = models.CharField(max_length=255, choices=TheoryType.choices)
 
+    def evaluate(self, submissions=None, force=False):
+        """
+        Grade submissions of this theory in one batch.
+
+        Answers are loaded in a single query, encoded in one batch per model,
+        compared to the precomputed answer keys and written back with bulk_update.
+        Submissions whose evaluation checksum is unchanged since their last
+        evaluation are skipped unless force is set.
+
+        Args:
+            submissions: Submissions to grade, defaults to all submissions of the theory
+            force: Re-grade submissions even if nothing changed
+
+        Returns:
+            List of the submissions that were graded
+        """
+        if submissions is None:
+            submissions = self.submissions.all()
+        submissions = list(submissions)
+        if not submissions:
+            return []
+
+        answers = list(
+            TheorySubmissionAnswer.objects.filter(submission__in=submissions).select_related('question')
+        )
+        answers_by_submission = {submission.id: [] for submission in submissions}
+        for answer in answers:
+            answers_by_submission[answer.submission_id].append(answer)
+
+        checksums = {
+            submission_id: evaluation_checksum(submission_answers)
+            for submission_id, submission_answers in answers_by_submission.items()
+        }
+        submissions = [
+            submission for submission in submissions
+            if force or submission.evaluated_on is None or submission.evaluation_checksum != checksums[submission.id]
+        ]
+        if not submissions:
+            return []
+        answers = [answer for submission in submissions for answer in answers_by_submission[submission.id]]
+
+        questions = {answer.question_id: answer.question for answer in answers}
+        key_embeddings = TheoryQuestions.answer_key_embeddings(questions.values())
+
+        grades, similarities = grade_answers_batch(
+            [answer.answer for answer in answers],
+            [key_embeddings[answer.question_id] for answer in answers],
+            [answer.question.answer_type for answer in answers],
+            [answer.question.answer for answer in answers],
+            [((self.id, answer.question_id), answer.id) for answer in answers]
+        )
+
+        now = timezone.now()
+        scores = {submission.id: 0 for submission in submissions}
+        for answer, similarity in zip(answers, similarities):
+            marks = float(similarity) * answer.question.marks
+            answer.marks = marks
+            answer.updated_on = now
+            scores[answer.submission_id] += marks
+
+        for submission in submissions:
+            submission.score = scores[submission.id]
+            submission.evaluation_checksum = checksums[submission.id]
+            submission.evaluated_on = now
+            submission.updated_on = now
+
+        TheorySubmissionAnswer.objects.bulk_update(answers, ['marks', 'updated_on'], batch_size=500)
+        TheorySubmission.objects.bulk_update(
+            submissions,
+            ['score', 'evaluation_checksum', 'evaluated_on', 'updated_on'],
+            batch_size=500
+        )
+        return submissions
+
+    def check_plagiarism(self, thresholds=None, stats=None, replay=True):
+        """
+        Check every pair of submissions of this theory for plagiarism at once.
+
+        Each question's answers are encoded once and compared with a single
+        similarity matrix, then all records are rebuilt with bulk_create.
+
+        The similarities a check finds are stored per question down to
+        PLAGIARISM_SCORE_FLOOR (or the threshold, when that is lower or no floor
+        is set), so a later check with a threshold at or above the stored floor
+        replays them instead of encoding and comparing again, as long as the
+        answers, the model and the prefilter settings are unchanged. Scores are
+        only stored once a question has been scored successfully: encoding errors
+        reach the caller.
+
+        Args:
+            thresholds: Dictionary with thresholds for different answer types
+                        Example: {'short': 0.9, 'long': 0.85, 'paraphrased': 0.8}
+            stats: Optional dictionary filled with the number of pairs each
+                   scoring stage resolved, summed over questions
+            replay: Reuse stored similarity scores when they are still valid
+        """
+        if thresholds is None:
+            thresholds = DEFAULT_PLAGIARISM_THRESHOLDS
+
+        # Get the default threshold (used for the PlagiarismRecord)
+        default_threshold = thresholds.get('default', 0.85)
+
+        # This will cascade delete related QuestionPlagiarismRecords due to on_delete=CASCADE
+        PlagiarismRecord.objects.filter(
+            models.Q(submission1__theory=self) | models.Q(submission2__theory=self)
+        ).delete()
+
+        answers = TheorySubmissionAnswer.objects.filter(
+            submission__theory=self
+        ).order_by('submission_id').values_list('id', 'submission_id', 'question_id', 'question__answer_type', 'answer')
+
+        question_data = {}
+        for answer_id, submission_id, question_id, answer_type, answer in answers:
+            question_data.setdefault((question_id, answer_type), []).append({
+                'submission_id': submission_id,
+                'answer_id': answer_id,
+                'answer': answer
+            })
+
+        stored_scores = {
+            scores.question_id: scores
+            for scores in QuestionSimilarityScores.objects.filter(question__theory=self)
+        }
+        floor = getattr(settings, 'PLAGIARISM_SCORE_FLOOR', None)
+        store = get_store()
+
+        # {(submission1_id, submission2_id): [(question_id, similarity), ...]}
+        pair_similarities = {}
+        for (question_id, answer_type), data in question_data.items():
+            if store is not None:
+                # Vectors of deleted answers are dropped here rather than on every delete
+                store.retain((self.id, question_id), [item['answer_id'] for item in data])
+            threshold = thresholds.get(answer_type, default_threshold)
+            tag = model_tag(answer_type)
+            checksum = QuestionSimilarityScores.checksum_of(data)
+            stored = stored_scores.get(question_id)
+
+            if replay and stored is not None and stored.is_valid(tag, checksum, threshold):
+                pairs = stored.pairs_above(threshold)
+                if stats is not None:
+                    stats['replayed_questions'] = stats.get('replayed_questions', 0) + 1
+            elif getattr(settings, 'PLAGIARISM_CASCADE', False) and answer_type != 'short':
+                # Cascade scores depend on the threshold, so they can't be replayed
+                pairs = detect_question_plagiarism_batch(data, answer_type, threshold, stats, (self.id, question_id))
+            else:
+                question_floor = threshold if floor is None else min(floor, threshold)
+                scored = detect_question_plagiarism_batch(data, answer_type, question_floor, stats, (self.id, question_id))
+                QuestionSimilarityScores.store(question_id, tag, checksum, question_floor, scored)
+                pairs = [pair for pair in scored if pair[2] > threshold]
+
+            for submission1_id, submission2_id, similarity in pairs:
+                pair_similarities.setdefault((submission1_id, submission2_id), []).append((question_id, similarity))
+
+        plagiarism_records = PlagiarismRecord.objects.bulk_create([
+            PlagiarismRecord(
+                submission1_id=submission1_id,
+                submission2_id=submission2_id,
+                similarity_score=max(similarity for _, similarity in similarities),
+                threshold_used=default_threshold
+            )
+            for (submission1_id, submission2_id), similarities in pair_similarities.items()
+        ])
+
+        QuestionPlagiarismRecord.objects.bulk_create([
+            QuestionPlagiarismRecord(
+                plagiarism_record=plagiarism_record,
+                question_id=question_id,
+                similarity_score=similarity
+            )
+            for plagiarism_record, similarities in zip(plagiarism_records, pair_similarities.values())
+            for question_id, similarity in similarities
+        ])
+
+        # Each submission's plagiarism score is its highest similarity to any other submission
+        max_similarities = {}
+        for plagiarism_record in plagiarism_records:
+            for submission_id in (plagiarism_record.submission1_id, plagiarism_record.submission2_id):
+                max_similarities[submission_id] = max(max_similarities.get(submission_id, 0.0), plagiarism_record.similarity_score)
+
+        submissions = list(self.submissions.filter(id__in=max_similarities.keys()))
+        for submission in submissions:
+            submission.plagiarism_score = max_similarities[submission.id]
+        TheorySubmission.objects.bulk_update(submissions, ['plagiarism_score'])
+
+        return plagiarism_records
+
 
 class TheoryQuestions(BaseModel):
     theory = models.ForeignKey(Theory, on_delete=models.CASCADE, related_name='questions')
@@ -28,6 +256,47 @@ class TheoryQuestions(BaseModel):
     options = models.JSONField(default=list)
     marks = models.IntegerField(default=0)
     answer_type = models.CharField(max_length=255, choices=AnswerType.choices, default=AnswerType.SHORT)
+    # Normalized float32 embedding of the answer key, the model that produced it and the key text it was computed from
+    answer_embedding = models.BinaryField(null=True, blank=True, editable=False)
+    answer_embedding_model = models.CharField(max_length=255, blank=True, default='', editable=False)
+    answer_embedding_fingerprint = models.BigIntegerField(null=True, blank=True, editable=False)
+
+    @classmethod
+    def answer_key_embeddings(cls, questions):
+        """
+        Load answer key embeddings for a set of questions.
+
+        Keys whose stored embedding is missing, was produced by another model or
+        was computed from a since-edited key text are encoded (one batch per
+        model) and saved back.
+
+        Returns:
+            Dictionary of {question_id: embedding}
+        """
+        embeddings = {}
+        stale = {}
+        for question in questions:
+            model_type = grading_model_type(question.answer_type)
+            if (question.answer_embedding is not None
+                    and question.answer_embedding_model == model_tag(model_type)
+                    and question.answer_embedding_fingerprint == text_fingerprint(question.answer)):
+                embeddings[question.id] = np.frombuffer(bytes(question.answer_embedding), dtype=np.float32)
+            else:
+                stale.setdefault(model_type, []).append(question)
+
+        updated = []
+        for model_type, group in stale.items():
+            vectors = encode([question.answer for question in group], model_type)
+            for question, vector in zip(group, vectors):
+                question.answer_embedding = vector.tobytes()
+                question.answer_embedding_model = model_tag(model_type)
+                question.answer_embedding_fingerprint = text_fingerprint(question.answer)
+                embeddings[question.id] = vector
+                updated.append(question)
+
+        if updated:
+            cls.objects.bulk_update(updated, ['answer_embedding', 'answer_embedding_model', 'answer_embedding_fingerprint'])
+        return embeddings
 
 class TheorySubmission(BaseModel):
     theory = models.ForeignKey(Theory, on_delete=models.CASCADE, related_name='submissions')
@@ -35,148 +304,245 @@ class TheorySubmission(BaseModel):
     score = models.IntegerField(default=0)
     # Overall plagiarism score for the entire submission
     plagiarism_score = models.FloatField(null=True, blank=True)
+    # When the submission was last graded, and the evaluation_checksum it was graded at
+    evaluated_on = models.DateTimeField(null=True, blank=True, editable=False)
+    evaluation_checksum = models.CharField(max_length=64, blank=True, default='', editable=False)
 
     def __str__(self):
         return f"{self.student.name} - {self.theory.title}"
     
-    def evaluate(self):
-        self.score = 0
-        for answer in self.answers.all():
-            grade, similarity = grade_answer_proc(answer.answer, answer.question.answer, answer.question.answer_type)
-            answer.marks = similarity * answer.question.marks
-            answer.save()
-            self.score += answer.marks
-            
-        self.save()
+    def evaluate(self, force=False):
+        """Grade every answer against its question's answer key, unless nothing changed since the last evaluation"""
+        return bool(self.theory.evaluate(submissions=[self], force=force))
     
+    def history_plagiarism(self, k=5, threshold=None):
+        """
+        Search earlier terms and other sections of the course for similar answers.
+
+        Every answer is looked up in the ANN index of its course and question
+        lineage, excluding answers to this same theory.
+
+        Args:
+            k: Number of matches to return per answer
+            threshold: Only return matches above this similarity
+
+        Returns:
+            List of {question_id, answer_id, matches: [{answer_id, submission_id,
+            theory_id, student_id, similarity}]} for answers with matches
+        """
+        partitions = {}
+        for answer in self.answers.select_related('question', 'submission__theory__classroom'):
+            if answer.answer and answer.answer.strip() != '':
+                partitions.setdefault(TheorySubmissionAnswer.index_partition(answer), []).append(answer)
+
+        # One batch encode and one index per partition; searching never writes to the index
+        queries = []
+        for (course_id, lineage, answer_type), group in partitions.items():
+            index = ann.get_index(course_id, lineage, answer_type, model_tag(answer_type))
+            if not len(index):
+                continue
+            vectors = encode([answer.answer for answer in group], answer_type)
+            for answer, vector in zip(group, vectors):
+                matches = [
+                    (answer_id, similarity)
+                    for answer_id, similarity in index.search(vector, k=k, exclude_group=self.theory_id)
+                    if threshold is None or similarity > threshold
+                ]
+                if matches:
+                    queries.append((answer, matches))
+
+        # Resolve matches in one query; ids of deleted answers are dropped
+        matched = TheorySubmissionAnswer.objects.filter(
+            id__in={answer_id for _, matches in queries for answer_id, _ in matches}
+        ).select_related('submission').in_bulk()
+
+        results = []
+        for answer, matches in queries:
+            found = [
+                {
+                    'answer_id': answer_id,
+                    'submission_id': matched[answer_id].submission_id,
+                    'theory_id': matched[answer_id].submission.theory_id,
+                    'student_id': matched[answer_id].submission.student_id,
+                    'similarity': round(similarity, 3)
+                }
+                for answer_id, similarity in matches
+                if answer_id in matched
+            ]
+            if found:
+                results.append({'question_id': answer.question_id, 'answer_id': answer.id, 'matches': found})
+        return results
+
     def check_plagiarism(self, thresholds=None):
         """
         Check for plagiarism against other submissions for the same theory
         
+        Each of this submission's answers is encoded once and scored against the
+        cached embeddings of every other answer to the question with one
+        matrix-vector product, or with a similarity search when an embedding
+        store is configured. Only records involving this submission are rebuilt.
+        
         Args:
             thresholds: Dictionary with thresholds for different answer types
                         Example: {'short': 0.9, 'long': 0.85, 'paraphrased': 0.8}
         """
         # Default thresholds if none provided
         if thresholds is None:
-            thresholds = {
-                'short': 0.9,
-                'long': 0.85,
-                'paraphrased': 0.8
-            }
+            thresholds = DEFAULT_PLAGIARISM_THRESHOLDS
         
         # Get the default threshold (used for the PlagiarismRecord)
         default_threshold = thresholds.get('default', 0.85)
         
-        other_submissions = TheorySubmission.objects.filter(
-            theory=self.theory
-        ).exclude(id=self.id)
-        
-        # Delete existing plagiarism records involving this submission
-        plagiarism_records = PlagiarismRecord.objects.filter(
+        # This will cascade delete related QuestionPlagiarismRecords due to on_delete=CASCADE
+        PlagiarismRecord.objects.filter(
             models.Q(submission1=self) | models.Q(submission2=self)
-        )
+        ).delete()
         
-        # This will cascade delete related QuestionPlagiarismRecords due to on_delete=CASCADE
-        plagiarism_records.delete()
+        store = get_store()
+        if store is not None:
+            pair_similarities = self._search_plagiarism(store, thresholds, default_threshold)
+        else:
+            pair_similarities = self._compare_plagiarism(thresholds, default_threshold)
+        
+        # Ensure consistent ordering of submissions
+        plagiarism_records = PlagiarismRecord.objects.bulk_create([
+            PlagiarismRecord(
+                submission1_id=min(self.id, other_id),
+                submission2_id=max(self.id, other_id),
+                similarity_score=max(similarity for _, similarity in similarities),
+                threshold_used=default_threshold
+            )
+            for other_id, similarities in pair_similarities.items()
+        ])
+        
+        QuestionPlagiarismRecord.objects.bulk_create([
+            QuestionPlagiarismRecord(
+                plagiarism_record=plagiarism_record,
+                question_id=question_id,
+                similarity_score=similarity
+            )
+            for plagiarism_record, similarities in zip(plagiarism_records, pair_similarities.values())
+            for question_id, similarity in similarities
+        ])
+        
+        if not plagiarism_records:
+            return plagiarism_records
+        
+        # Update the overall plagiarism score of this submission and raise the other side's if needed
+        self.plagiarism_score = max(record.similarity_score for record in plagiarism_records)
+        self.save(update_fields=['plagiarism_score', 'updated_on'])
         
-        # Track detected plagiarism for each other submission
-        submission_plagiarism = {}
+        new_scores = {
+            (record.submission2_id if record.submission1_id == self.id else record.submission1_id): record.similarity_score
+            for record in plagiarism_records
+        }
+        others = list(TheorySubmission.objects.filter(id__in=new_scores.keys()))
+        for other in others:
+            other.plagiarism_score = max(other.plagiarism_score or 0.0, new_scores[other.id])
+        TheorySubmission.objects.bulk_update(others, ['plagiarism_score'])
         
-        # Compare each question's answer with the corresponding answers from other submissions
-        for question in self.theory.questions.all():
-            # Get this student's answer to the current question
-            try:
-                student_answer = TheorySubmissionAnswer.objects.get(
-                    submission=self,
-                    question=question
-                )
-            except TheorySubmissionAnswer.DoesNotExist:
+        return plagiarism_records
+    
+    def _compare_plagiarism(self, thresholds, default_threshold):
+        """
+        Score this submission's answers against every other answer to their questions.
+
+        Returns:
+            Dictionary of {other_submission_id: [(question_id, similarity), ...]}
+        """
+        answers = TheorySubmissionAnswer.objects.filter(
+            submission__theory_id=self.theory_id
+        ).order_by('submission_id').values_list('id', 'submission_id', 'question_id', 'question__answer_type', 'answer')
+        
+        own_answers = {}
+        other_answers = {}
+        for answer_id, submission_id, question_id, answer_type, answer in answers:
+            if submission_id == self.id:
+                own_answers[question_id] = (answer_id, answer_type, answer)
+            else:
+                other_answers.setdefault(question_id, []).append({
+                    'submission_id': submission_id,
+                    'answer_id': answer_id,
+                    'answer': answer
+                })
+        
+        pair_similarities = {}
+        for question_id, (answer_id, answer_type, answer) in own_answers.items():
+            threshold = thresholds.get(answer_type, default_threshold)
+            matches = detect_answer_plagiarism(
+                answer,
+                other_answers.get(question_id, []),
+                answer_type,
+                threshold,
+                store_key=(self.theory_id, question_id),
+                answer_id=answer_id
+            )
+            for other_id, similarity in matches:
+                pair_similarities.setdefault(other_id, []).append((question_id, similarity))
+        return pair_similarities
+    
+    def _search_plagiarism(self, store, thresholds, default_threshold):
+        """
+        Find this submission's matches with a similarity search in the embedding store.
+
+        Other submissions' answers are only encoded when the store has no vector
+        for their current text (new or edited answers); everything else is a
+        nearest-neighbour query per question. Vectors of answers deleted since
+        they were stored are dropped from the store first.
+
+        Returns:
+            Dictionary of {other_submission_id: [(question_id, similarity), ...]}
+        """
+        own_answers = TheorySubmissionAnswer.objects.filter(
+            submission=self
+        ).values_list('id', 'question_id', 'question__answer_type', 'answer')
+        peers = TheorySubmissionAnswer.objects.filter(
+            submission__theory_id=self.theory_id
+        ).exclude(submission=self).exclude(answer='').values_list('id', 'submission_id', 'question_id', 'answer')
+        
+        own_answers = list(own_answers)
+        own_ids = {}
+        for answer_id, question_id, _, _ in own_answers:
+            own_ids.setdefault(question_id, []).append(answer_id)
+
+        submission_of = {}
+        peers_by_question = {}
+        for answer_id, submission_id, question_id, text in peers:
+            if text.strip() == '':
                 continue
-                
-            # Skip if the answer is empty
-            if not student_answer.answer or student_answer.answer.strip() == '':
+            submission_of[answer_id] = submission_id
+            peers_by_question.setdefault(question_id, []).append((answer_id, text))
+        
+        pair_similarities = {}
+        for answer_id, question_id, answer_type, answer in own_answers:
+            peer_ids = peers_by_question.get(question_id, [])
+            if not answer or answer.strip() == '' or not peer_ids:
                 continue
+            key = (self.theory_id, question_id)
+            tag = model_tag(answer_type)
+            encoder = lambda texts, answer_type=answer_type: encode(texts, answer_type)
+            store.retain(key, own_ids[question_id] + [peer_id for peer_id, _ in peer_ids])
+            
+            fingerprints = [text_fingerprint(text) for _, text in peer_ids]
+            stored = store.contains(key, tag, [peer_id for peer_id, _ in peer_ids], fingerprints)
+            missing = [peer for peer, hit in zip(peer_ids, stored) if not hit]
+            if missing:
+                encode_answers([key] * len(missing), [peer_id for peer_id, _ in missing], [text for _, text in missing], answer_type, encoder)
             
-            # Get the threshold for this answer type
-            answer_type = question.answer_type
+            query = encode_answers([key], [answer_id], [answer], answer_type, encoder)[0]
             threshold = thresholds.get(answer_type, default_threshold)
-                
-            for other_submission in other_submissions:
-                # Initialize tracking for this submission if needed
-                if other_submission.id not in submission_plagiarism:
-                    submission_plagiarism[other_submission.id] = {
-                        'submission': other_submission,
-                        'max_similarity': 0.0,
-                        'question_similarities': []
-                    }
-                
-                # Get the other student's answer to the same question
-                try:
-                    other_answer = TheorySubmissionAnswer.objects.get(
-                        submission=other_submission,
-                        question=question
-                    )
-                except TheorySubmissionAnswer.DoesNotExist:
-                    continue
-                    
-                # Skip if the other answer is empty
-                if not other_answer.answer or other_answer.answer.strip() == '':
-                    continue
-                
-                # Calculate similarity for this specific question
-                similarity = detect_question_plagiarism(
-                    student_answer.answer, 
-                    other_answer.answer,
-                    question.answer_type
-                )
-                
-                # If similarity is above threshold, track it
-                if similarity > threshold:
-                    submission_plagiarism[other_submission.id]['question_similarities'].append({
-                        'question': question,
-                        'similarity': similarity
-                    })
-                    
-                    # Update max similarity
-                    if similarity > submission_plagiarism[other_submission.id]['max_similarity']:
-                        submission_plagiarism[other_submission.id]['max_similarity'] = similarity
-        
-        # Create plagiarism records for submissions that had similarities above threshold
-        overall_max_similarity = 0.0
-        
-        for sub_id, data in submission_plagiarism.items():
-            if data['question_similarities']:
-                other_submission = data['submission']
-                max_similarity = data['max_similarity']
-                
-                # Update overall max similarity for this submission
-                overall_max_similarity = max(overall_max_similarity, max_similarity)
-                
-                # Ensure consistent ordering of submissions
-                submission1 = self if self.id < other_submission.id else other_submission
-                submission2 = other_submission if self.id < other_submission.id else self
-                
-                # Create the main plagiarism record
-                plagiarism_record = PlagiarismRecord.objects.create(
-                    submission1=submission1,
-                    submission2=submission2,
-                    similarity_score=max_similarity,
-                    threshold_used=default_threshold
-                )
-                
-                # Create question-level plagiarism records
-                for question_data in data['question_similarities']:
-                    QuestionPlagiarismRecord.objects.create(
-                        plagiarism_record=plagiarism_record,
-                        question=question_data['question'],
-                        similarity_score=question_data['similarity']
-                    )
-        
-        # Update the overall plagiarism score for this submission
-        if overall_max_similarity > 0:
-            self.plagiarism_score = overall_max_similarity
-            self.save()
+            scores = {
+                other_id: round(similarity, 3)
+                for other_id, similarity in store.search(key, tag, query, len(peer_ids), exclude_ids=[answer_id])
+            }
+            # Identical up to case, punctuation and whitespace, as in detect_answer_plagiarism
+            canonical = canonical_text(answer)
+            scores.update((peer_id, 1.0) for peer_id, text in peer_ids if canonical_text(text) == canonical)
+            for other_id, similarity in scores.items():
+                # Answers deleted after the store was pruned
+                if similarity > threshold and other_id in submission_of:
+                    pair_similarities.setdefault(submission_of[other_id], []).append((question_id, similarity))
+        return pair_similarities
 
 
 class TheorySubmissionAnswer(BaseModel):
@@ -193,6 +559,80 @@ class TheorySubmissionAnswer(BaseModel):
             self.answer = ''
         super().save(*args, **kwargs)
 
+    @staticmethod
+    def index_partition(answer):
+        """ANN index partition of an answer: its course, question lineage and answer type"""
+        return (
+            answer.submission.theory.classroom.course_id,
+            ann.question_lineage(answer.question.question),
+            answer.question.answer_type
+        )
+
+    @classmethod
+    def index(cls, answers):
+        """
+        Insert answers into their course's ANN indexes for cross-theory plagiarism search.
+
+        Each partition is encoded in one batch and appended to its index, which
+        is retrained once it has doubled in size. This encodes and may cluster
+        a whole index, so it runs off the request path: see index_later and the
+        build_ann_indexes command.
+        """
+        partitions = {}
+        for answer in answers:
+            if answer.answer and answer.answer.strip() != '':
+                partitions.setdefault(cls.index_partition(answer), []).append(answer)
+
+        for (course_id, lineage, answer_type), group in partitions.items():
+            # Also keeps the answers' embeddings in the embedding store, if one is configured
+            vectors = encode_answers(
+                [(answer.submission.theory_id, answer.question_id) for answer in group],
+                [answer.id for answer in group],
+                [answer.answer for answer in group],
+                answer_type,
+                lambda texts, answer_type=answer_type: encode(texts, answer_type)
+            )
+            index = ann.get_index(course_id, lineage, answer_type, model_tag(answer_type))
+            index.add(
+                [answer.id for answer in group],
+                vectors,
+                [answer.submission.theory_id for answer in group]
+            )
+            if index.needs_training:
+                index.train()
+
+    @classmethod
+    def index_later(cls, answer_ids):
+        """
+        Index answers once the current transaction commits.
+
+        With ANN_INDEX_IN_BACKGROUND the work is queued on a single background
+        thread, so saving a submission never waits for encoding or clustering.
+        """
+        answer_ids = list(answer_ids)
+        if not answer_ids:
+            return
+        if getattr(settings, 'ANN_INDEX_IN_BACKGROUND', True):
+            transaction.on_commit(lambda: _indexer.submit(_index_answers, answer_ids))
+        else:
+            transaction.on_commit(lambda: _index_answers(answer_ids))
+
+
+def _index_answers(answer_ids):
+    try:
+        TheorySubmissionAnswer.index(
+            TheorySubmissionAnswer.objects.filter(id__in=answer_ids).select_related('question', 'submission__theory__classroom')
+        )
+    except Exception:
+        # The build_ann_indexes command indexes anything missed here
+        logger.exception(f"Could not index answers {answer_ids}")
+    finally:
+        if threading.current_thread() is not threading.main_thread():
+            close_old_connections()
+
+
+_indexer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ann-indexer')
+
 
 class PlagiarismRecord(BaseModel):
     """Records overall plagiarism between two submissions"""
@@ -222,4 +662,64 @@ class QuestionPlagiarismRecord(BaseModel):
         unique_together = ('plagiarism_record', 'question')
     
     def __str__(self):
-        return f"Question plagiarism for {self.question.question[:30]}... ({self.similarity_score:.2f})"
\ No newline at end of file
+        return f"Question plagiarism for {self.question.question[:30]}... ({self.similarity_score:.2f})"
+
+
+class QuestionSimilarityScores(BaseModel):
+    """Similarities above a floor between all answers to a question, kept for threshold replay"""
+    question = models.OneToOneField(TheoryQuestions, on_delete=models.CASCADE, related_name='similarity_scores')
+    # Model that produced the scores and checksum of the answers they were computed from
+    model_tag = models.CharField(max_length=255)
+    answers_checksum = models.CharField(max_length=64)
+    # Only pairs scoring strictly above the floor are stored
+    floor = models.FloatField()
+    # int64 (n, 2) array of submission id pairs and float32 (n,) array of their scores
+    pairs = models.BinaryField()
+    scores = models.BinaryField()
+
+    @staticmethod
+    def checksum_of(question_data):
+        """
+        Checksum of a question's answers, as passed to detect_question_plagiarism_batch,
+        and of the prefilter settings that decide which pairs get scored
+        """
+        parts = [
+            f"lexical:{getattr(settings, 'LEXICAL_PREFILTER', True)}:{getattr(settings, 'LEXICAL_DUPLICATE_THRESHOLD', 0.9)}",
+            f"binary:{getattr(settings, 'BINARY_PREFILTER', False)}:{getattr(settings, 'BINARY_PREFILTER_MARGIN', None)}"
+            f":{getattr(settings, 'BINARY_PREFILTER_MIN_ANSWERS', 256)}:{getattr(settings, 'BINARY_PREFILTER_SAMPLE', 4096)}"
+            f":{getattr(settings, 'BINARY_PREFILTER_MAX_CANDIDATES', 0.05)}",
+        ]
+        parts += [f"{data['submission_id']}:{text_hash(data['answer'])}" for data in question_data]
+        return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+
+    @classmethod
+    def store(cls, question_id, model_tag, answers_checksum, floor, scored_pairs):
+        """Replace the stored scores of a question with (submission1_id, submission2_id, similarity) tuples"""
+        pairs = np.array([(first, second) for first, second, _ in scored_pairs], dtype=np.int64).reshape(-1, 2)
+        scores = np.array([similarity for _, _, similarity in scored_pairs], dtype=np.float32)
+        cls.objects.update_or_create(
+            question_id=question_id,
+            defaults={
+                'model_tag': model_tag,
+                'answers_checksum': answers_checksum,
+                'floor': floor,
+                'pairs': pairs.tobytes(),
+                'scores': scores.tobytes()
+            }
+        )
+
+    def is_valid(self, model_tag, answers_checksum, threshold):
+        """Whether the stored scores answer a check at threshold for the current answers and model"""
+        return (
+            self.model_tag == model_tag
+            and self.answers_checksum == answers_checksum
+            and threshold >= self.floor
+        )
+
+    def pairs_above(self, threshold):
+        """Stored pairs scoring strictly above threshold, as (submission1_id, submission2_id, similarity)"""
+        pairs = np.frombuffer(bytes(self.pairs), dtype=np.int64).reshape(-1, 2)
+        # Scores were rounded to 3 decimals before being stored as float32
+        scores = np.round(np.frombuffer(bytes(self.scores), dtype=np.float32).astype(np.float64), 3)
+        above = scores > threshold
+        return list(zip(pairs[above, 0].tolist(), pairs[above, 1].tolist(), scores[above].tolist()))
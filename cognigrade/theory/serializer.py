@@ -8,12 +8,15 @@ from .models import (
     QuestionPlagiarismRecord
 )
 from django.db import transaction
+import logging
+
+logger = logging.getLogger(__name__)
 
 class TheoryQuestionsSerializer(serializers.ModelSerializer):
     theory = serializers.PrimaryKeyRelatedField(required=False, read_only=True)
     class Meta:
         model = TheoryQuestions
-        fields = '__all__'
+        exclude = ('answer_embedding', 'answer_embedding_model', 'answer_embedding_fingerprint')
 
     def to_representation(self, instance):
         data = super().to_representation(instance)
@@ -28,6 +31,15 @@ class TheorySerializer(serializers.ModelSerializer):
         model = Theory
         fields = '__all__'
 
+    def embed_answer_keys(self, questions):
+        """Precompute answer key embeddings so evaluation only encodes student answers"""
+        try:
+            with transaction.atomic():
+                TheoryQuestions.answer_key_embeddings(questions)
+        except Exception as e:
+            # Evaluation computes any missing key embeddings itself
+            logger.warning(f"Could not precompute answer key embeddings: {str(e)}")
+
     @transaction.atomic
     def create(self, validated_data):
         questions = validated_data.pop('questions') if 'questions' in validated_data else None
@@ -37,6 +49,7 @@ class TheorySerializer(serializers.ModelSerializer):
             keep_questions.append(TheoryQuestions.objects.create(theory=theory, **question))
         theory.questions.set(keep_questions)
         theory.save()
+        self.embed_answer_keys(keep_questions)
 
         return theory
     
@@ -58,6 +71,7 @@ class TheorySerializer(serializers.ModelSerializer):
                 question.delete()
 
         theory.save()
+        self.embed_answer_keys(keep_questions)
         return theory
         
 
@@ -90,6 +104,8 @@ class TheorySubmissionSerializer(serializers.ModelSerializer):
             keep_answers.append(TheorySubmissionAnswer.objects.create(submission=submission, **answer))
         submission.answers.set(keep_answers)
         submission.save()
+        # Indexed for cross-theory plagiarism search after commit, off the request path
+        TheorySubmissionAnswer.index_later(answer.id for answer in keep_answers)
         return submission
     
     @transaction.atomic
@@ -105,6 +121,8 @@ class TheorySubmissionSerializer(serializers.ModelSerializer):
 
         submission.answers.set(keep_answers)
         submission.save()
+        # Indexed for cross-theory plagiarism search after commit, off the request path
+        TheorySubmissionAnswer.index_later(answer.id for answer in keep_answers)
         return submission
 
 
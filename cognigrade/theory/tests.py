@@ -1,6 +1,12 @@
+import os
 import unittest
+import tempfile
+from io import StringIO
 from unittest.mock import patch, MagicMock, PropertyMock
-from django.test import TestCase
+import numpy as np
+from django.core.management import call_command
+from django.db.models import F
+from django.test import TestCase, override_settings
 from django.urls import reverse
 from rest_framework.test import APIClient
 from rest_framework import status
@@ -9,6 +15,11 @@ from cognigrade.accounts.models import User
 from cognigrade.accounts.choices import RoleChoices
 from cognigrade.institutions.models import Institutions
 from cognigrade.courses.models import Course, Classroom
+from cognigrade.utils import ann, embedding_cache
+from cognigrade.utils.embedding_store import get_store, text_fingerprint
+from cognigrade.utils.embeddings import model_tag
+from cognigrade.utils.evaluation import grade_answer_proc, grading_cache
+from cognigrade.utils.tests import FakeSentenceModel
 from cognigrade.theory.models import (
     Theory, 
     TheoryQuestions, 
@@ -16,8 +27,10 @@ from cognigrade.theory.models import (
     TheorySubmissionAnswer, 
     PlagiarismRecord,
     QuestionPlagiarismRecord,
+    QuestionSimilarityScores,
     TheoryType,
-    AnswerType
+    AnswerType,
+    DEFAULT_PLAGIARISM_THRESHOLDS
 )
 
 class PlagiarismDetectionTestCase(TestCase):
@@ -660,7 +673,8 @@ class PlagiarismDetectionTestCase(TestCase):
         plag_record = PlagiarismRecord.objects.first()
         self.assertAlmostEqual(plag_record.similarity_score, 0.75, places=2)
     
-    def test_permissions(self):
+    @patch('cognigrade.theory.models.detect_question_plagiarism_batch', return_value=[])
+    def test_permissions(self, mock_detect):
         """Test that only authorized users can check plagiarism"""
         # Create submissions to test with
         submission1 = self.create_submission_with_answers(
@@ -684,4 +698,709 @@ class PlagiarismDetectionTestCase(TestCase):
         # Test as teacher (should be allowed)
         self.client.force_authenticate(user=self.teacher)
         response = self.client.post(url)
-        self.assertEqual(response.status_code, status.HTTP_200_OK)
\ No newline at end of file
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class FakeModelTheoryMixin:
+    """Creates a small theory and replaces the embedding models with a deterministic fake"""
+
+    def setUp(self):
+        self.model = FakeSentenceModel()
+        self.model_patch = patch('cognigrade.utils.embeddings.get_model', return_value=self.model)
+        self.model_patch.start()
+        embedding_cache.memory_cache.clear()
+        grading_cache.clear()
+
+        self.institution = Institutions.objects.create(name="Test University", location="Test City")
+        self.teacher = User.objects.create(
+            email="teacher@example.com",
+            first_name="Test",
+            last_name="Teacher",
+            role=RoleChoices.TEACHER,
+            institution=self.institution,
+            is_active=True
+        )
+        self.students = [
+            User.objects.create(
+                email=f"student{i}@example.com",
+                first_name="Student",
+                last_name=str(i),
+                role=RoleChoices.STUDENT,
+                institution=self.institution,
+                is_active=True
+            )
+            for i in range(3)
+        ]
+        self.course = Course.objects.create(name="Computer Science 101", code="CS101", institution=self.institution)
+        self.classroom = Classroom.objects.create(name="Introduction to Programming", course=self.course, teacher=self.teacher)
+        self.theory = Theory.objects.create(classroom=self.classroom, title="Python Basics", type=TheoryType.QUIZ)
+        self.short_question = TheoryQuestions.objects.create(
+            theory=self.theory,
+            question="Define a variable in Python.",
+            answer="A variable is a named location in memory that stores a value.",
+            marks=10,
+            answer_type=AnswerType.SHORT
+        )
+        self.long_question = TheoryQuestions.objects.create(
+            theory=self.theory,
+            question="Explain the difference between lists and tuples in Python.",
+            answer="Lists are mutable and use square brackets, tuples are immutable and use parentheses.",
+            marks=20,
+            answer_type=AnswerType.LONG
+        )
+        self.client = APIClient()
+
+    def tearDown(self):
+        self.model_patch.stop()
+        embedding_cache.memory_cache.clear()
+
+    def create_submission_with_answers(self, student, answers_dict):
+        submission = TheorySubmission.objects.create(theory=self.theory, student=student)
+        for question, answer_text in answers_dict.items():
+            TheorySubmissionAnswer.objects.create(submission=submission, question=question, answer=answer_text)
+        return submission
+
+
+class AnswerKeyEmbeddingTestCase(FakeModelTheoryMixin, TestCase):
+    """Test cases for precomputed answer key embeddings"""
+
+    def test_serializer_precomputes_key_embeddings(self):
+        self.client.force_authenticate(user=self.teacher)
+        response = self.client.post(reverse('theory-list'), {
+            'classroom': self.classroom.id,
+            'title': 'Variables',
+            'type': TheoryType.QUIZ,
+            'questions': [
+                {'question': 'What is a variable?', 'answer': 'A named value.', 'marks': 5, 'answer_type': AnswerType.SHORT},
+            ]
+        }, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn('answer_embedding', response.data['questions'][0])
+        question = TheoryQuestions.objects.get(id=response.data['questions'][0]['id'])
+        self.assertIsNotNone(question.answer_embedding)
+        self.assertEqual(question.answer_embedding_model, 'sentence-transformers/all-MiniLM-L6-v2@main')
+
+    def test_evaluation_encodes_each_key_once(self):
+        for student in self.students:
+            self.create_submission_with_answers(student, {
+                self.short_question: f"A variable stores a value ({student.id}).",
+                self.long_question: f"Lists change, tuples do not ({student.id}).",
+            })
+
+        self.client.force_authenticate(user=self.teacher)
+        response = self.client.post(reverse('theory-evaluate', kwargs={'pk': self.theory.id}))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        encoded = self.model.encoded_texts
+        self.assertEqual(encoded.count(self.short_question.answer), 1)
+        self.assertEqual(encoded.count(self.long_question.answer), 1)
+        self.assertEqual(len(encoded), 2 + 2 * len(self.students))
+
+    def test_edited_key_is_encoded_again(self):
+        before = TheoryQuestions.answer_key_embeddings([self.long_question])[self.long_question.id]
+
+        self.long_question.answer = "Tuples are immutable sequences."
+        self.long_question.save()
+        question = TheoryQuestions.objects.get(id=self.long_question.id)
+        after = TheoryQuestions.answer_key_embeddings([question])[question.id]
+
+        self.assertFalse(np.allclose(before, after))
+        self.assertEqual(self.model.encoded_texts[-1], "Tuples are immutable sequences.")
+        question.refresh_from_db()
+        self.assertTrue(np.array_equal(np.frombuffer(bytes(question.answer_embedding), dtype=np.float32), after))
+
+
+class BatchEvaluationTestCase(FakeModelTheoryMixin, TestCase):
+    """Test cases for theory-wide batched evaluation"""
+
+    def test_batch_marks_match_per_answer_grading(self):
+        submissions = [
+            self.create_submission_with_answers(student, {
+                self.short_question: f"A variable stores a value ({student.id}).",
+                self.long_question: f"Lists change, tuples do not ({student.id}).",
+            })
+            for student in self.students
+        ]
+
+        self.theory.evaluate()
+
+        for submission in submissions:
+            submission.refresh_from_db()
+            expected_score = 0
+            for answer in submission.answers.select_related('question'):
+                grade, similarity = grade_answer_proc(answer.answer, answer.question.answer, answer.question.answer_type)
+                expected_score += similarity * answer.question.marks
+                self.assertEqual(answer.marks, int(similarity * answer.question.marks))
+            self.assertEqual(submission.score, int(expected_score))
+
+    def test_one_forward_pass_per_model(self):
+        for student in self.students:
+            self.create_submission_with_answers(student, {
+                self.short_question: f"A variable stores a value ({student.id}).",
+                self.long_question: f"Lists change, tuples do not ({student.id}).",
+            })
+        TheoryQuestions.answer_key_embeddings(self.theory.questions.all())
+        self.model.calls.clear()
+
+        self.theory.evaluate()
+
+        self.assertEqual(len(self.model.calls), 2)
+        self.assertTrue(all(len(call) == len(self.students) for call in self.model.calls))
+
+    def test_key_matches_and_duplicates_skip_the_model(self):
+        answers = [self.short_question.answer.upper() + "!", "N/A", "n/a"]
+        submissions = [
+            self.create_submission_with_answers(student, {self.short_question: answer})
+            for student, answer in zip(self.students, answers)
+        ]
+        TheoryQuestions.answer_key_embeddings(self.theory.questions.all())
+        self.model.calls.clear()
+
+        self.theory.evaluate()
+
+        self.assertEqual(self.model.encoded_texts, ["N/A"])
+        submissions[0].refresh_from_db()
+        self.assertEqual(submissions[0].score, self.short_question.marks)
+
+    def test_reevaluation_only_regrades_changed_answers(self):
+        submissions = [
+            self.create_submission_with_answers(student, {
+                self.short_question: f"A variable stores a value ({student.id}).",
+            })
+            for student in self.students
+        ]
+        self.theory.evaluate()
+        self.assertEqual(grading_cache.stats()['misses'], 3)
+
+        answer = submissions[0].answers.get()
+        answer.answer = "A variable holds a value."
+        answer.save()
+        embedding_cache.memory_cache.clear()
+        self.model.calls.clear()
+
+        self.theory.evaluate(force=True)
+
+        self.assertEqual(self.model.encoded_texts, ["A variable holds a value."])
+        self.assertEqual(grading_cache.stats()['hits'], 2)
+
+        with override_settings(EMBEDDING_MODEL_REVISIONS={'short': 'v2'}):
+            self.theory.evaluate()
+        self.assertEqual(grading_cache.stats()['hits'], 2)
+
+    def test_only_dirty_submissions_are_regraded(self):
+        submissions = [
+            self.create_submission_with_answers(student, {
+                self.short_question: f"A variable stores a value ({student.id}).",
+                self.long_question: f"Lists change, tuples do not ({student.id}).",
+            })
+            for student in self.students
+        ]
+        self.assertEqual(len(self.theory.evaluate()), 3)
+        self.assertEqual(self.theory.evaluate(), [])
+
+        answer = submissions[1].answers.get(question=self.short_question)
+        answer.answer = "A variable holds a value."
+        answer.save()
+        self.assertEqual([submission.id for submission in self.theory.evaluate()], [submissions[1].id])
+
+        # A changed key or mark makes every submission answering the question dirty
+        self.long_question.marks = 25
+        self.long_question.save()
+        self.assertEqual(len(self.theory.evaluate()), 3)
+
+        submissions[0].refresh_from_db()
+        self.assertFalse(submissions[0].evaluate())
+        self.assertTrue(submissions[0].evaluate(force=True))
+
+    def test_forced_reevaluation_reads_the_embedding_store(self):
+        for student in self.students:
+            self.create_submission_with_answers(student, {
+                self.short_question: f"A variable stores a value ({student.id}).",
+            })
+        with tempfile.TemporaryDirectory() as root, \
+                override_settings(EMBEDDING_STORE='memmap', EMBEDDING_STORE_ROOT=root, EMBEDDING_CACHE_PERSIST=False):
+            self.theory.evaluate()
+            self.assertTrue(os.listdir(os.path.join(root, f"theory_{self.theory.id}")))
+            embedding_cache.memory_cache.clear()
+            grading_cache.clear()
+            self.model.calls.clear()
+
+            self.theory.evaluate(force=True)
+
+        self.assertEqual(self.model.calls, [])
+
+    def test_single_submission_evaluate(self):
+        submission = self.create_submission_with_answers(self.students[0], {
+            self.short_question: "A variable is a named location in memory that stores a value.",
+        })
+
+        submission.evaluate()
+
+        submission.refresh_from_db()
+        answer = submission.answers.get()
+        self.assertGreaterEqual(answer.marks, 9)
+        self.assertEqual(submission.score, answer.marks)
+
+
+class TheoryPlagiarismEngineTestCase(FakeModelTheoryMixin, TestCase):
+    """Test cases for theory-wide vectorized plagiarism detection"""
+
+    def setUp(self):
+        super().setUp()
+        self.submissions = [
+            self.create_submission_with_answers(self.students[0], {
+                self.short_question: "A variable is a name for a memory location.",
+                self.long_question: "Lists are mutable, tuples are immutable.",
+            }),
+            self.create_submission_with_answers(self.students[1], {
+                self.short_question: "A variable is a name for a memory location.",
+                self.long_question: "Tuples cannot be changed after creation.",
+            }),
+            self.create_submission_with_answers(self.students[2], {
+                self.short_question: "  a variable is a name for a memory location.",
+                self.long_question: "Lists are mutable, tuples are immutable.",
+            }),
+        ]
+
+    def record_set(self):
+        return {
+            (record.submission1_id, record.submission2_id, record.similarity_score,
+             frozenset(record.question_records.values_list('question_id', 'similarity_score')))
+            for record in PlagiarismRecord.objects.all()
+        }
+
+    @override_settings(LEXICAL_PREFILTER=False)
+    def test_matches_per_submission_check(self):
+        thresholds = {'default': 0.85, 'short': 0.9, 'long': 0.85, 'paraphrased': 0.8}
+        for submission in self.submissions:
+            submission.check_plagiarism(thresholds=thresholds)
+        expected = self.record_set()
+        expected_scores = dict(TheorySubmission.objects.values_list('id', 'plagiarism_score'))
+
+        TheorySubmission.objects.update(plagiarism_score=None)
+        self.theory.check_plagiarism(thresholds=thresholds)
+
+        self.assertEqual(self.record_set(), expected)
+        self.assertEqual(dict(TheorySubmission.objects.values_list('id', 'plagiarism_score')), expected_scores)
+        # All three short answers are identical up to case and whitespace
+        self.assertEqual(PlagiarismRecord.objects.count(), 3)
+        self.assertEqual(QuestionPlagiarismRecord.objects.count(), 4)
+
+    def test_each_answer_encoded_once(self):
+        self.theory.check_plagiarism()
+
+        # The three short answers are identical up to case and whitespace, so they
+        # are flagged without the model, and the long answers have one identical
+        # pair, so only 2 long answers reach it
+        self.assertEqual(len(self.model.encoded_texts), 2)
+        self.assertEqual(PlagiarismRecord.objects.count(), 3)
+
+    def test_answers_of_one_submission_are_not_compared(self):
+        TheorySubmissionAnswer.objects.create(
+            submission=self.submissions[1],
+            question=self.long_question,
+            answer="Tuples cannot be changed after creation."
+        )
+
+        self.theory.check_plagiarism()
+
+        self.assertFalse(PlagiarismRecord.objects.filter(submission1=F('submission2')).exists())
+        self.assertEqual(PlagiarismRecord.objects.count(), 3)
+
+    def test_new_thresholds_replay_stored_scores(self):
+        self.theory.check_plagiarism()
+        embedding_cache.memory_cache.clear()
+        self.model.calls.clear()
+
+        strict = {'default': 0.95, 'short': 0.95, 'long': 0.99, 'paraphrased': 0.95}
+        stats = {}
+        self.theory.check_plagiarism(thresholds=strict, stats=stats)
+        replayed = self.record_set()
+
+        self.assertEqual(self.model.calls, [])
+        self.assertEqual(stats['replayed_questions'], 2)
+        self.theory.check_plagiarism(thresholds=strict, replay=False)
+        self.assertEqual(self.record_set(), replayed)
+
+    def test_lower_thresholds_replay_stored_scores(self):
+        self.theory.check_plagiarism()
+        embedding_cache.memory_cache.clear()
+        self.model.calls.clear()
+
+        lenient = {'default': 0.6, 'short': 0.6, 'long': 0.6, 'paraphrased': 0.6}
+        stats = {}
+        self.theory.check_plagiarism(thresholds=lenient, stats=stats)
+        replayed = self.record_set()
+
+        self.assertEqual(self.model.calls, [])
+        self.assertEqual(stats['replayed_questions'], 2)
+        self.theory.check_plagiarism(thresholds=lenient, replay=False)
+        self.assertEqual(self.record_set(), replayed)
+
+    @override_settings(PLAGIARISM_SCORE_FLOOR=None)
+    def test_only_flagged_pairs_are_stored_without_floor(self):
+        self.theory.check_plagiarism()
+
+        for scores in QuestionSimilarityScores.objects.all():
+            threshold = DEFAULT_PLAGIARISM_THRESHOLDS[scores.question.answer_type]
+            self.assertEqual(scores.floor, threshold)
+            self.assertEqual(
+                len(scores.pairs_above(threshold)),
+                len(np.frombuffer(bytes(scores.scores), dtype=np.float32))
+            )
+
+    def test_prefilter_settings_invalidate_stored_scores(self):
+        self.theory.check_plagiarism()
+        for changed in ({'BINARY_PREFILTER': True}, {'LEXICAL_PREFILTER': False}):
+            stats = {}
+            with override_settings(**changed):
+                self.theory.check_plagiarism(stats=stats)
+            self.assertNotIn('replayed_questions', stats)
+
+    def test_failed_check_keeps_previous_results(self):
+        thresholds = {'default': 0.85, 'short': 0.9, 'long': 0.85, 'paraphrased': 0.8}
+        self.theory.check_plagiarism(thresholds=thresholds)
+        records = self.record_set()
+        self.submissions[1].answers.filter(question=self.long_question).update(answer="Changed answer.")
+        embedding_cache.memory_cache.clear()
+        self.model.encode = MagicMock(side_effect=RuntimeError("model unavailable"))
+
+        self.client.force_authenticate(user=self.teacher)
+        response = self.client.post(reverse('theory-check-plagiarism', kwargs={'pk': self.theory.id}))
+
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        # Neither empty results nor scores of the failed run are stored
+        self.assertEqual(self.record_set(), records)
+        stored = QuestionSimilarityScores.objects.get(question=self.long_question)
+        self.assertEqual(len(stored.pairs_above(0.85)), 1)
+        with self.assertRaises(RuntimeError):
+            self.theory.check_plagiarism(thresholds=thresholds, replay=False)
+
+    def test_failed_single_submission_check_keeps_previous_records(self):
+        self.theory.check_plagiarism()
+        records = self.record_set()
+        self.submissions[1].answers.filter(question=self.long_question).update(answer="Changed answer.")
+        embedding_cache.memory_cache.clear()
+        self.model.encode = MagicMock(side_effect=RuntimeError("model unavailable"))
+
+        self.client.force_authenticate(user=self.teacher)
+        response = self.client.post(
+            reverse('theory-submission-check-single-submission-plagiarism', kwargs={'pk': self.submissions[0].id})
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(self.record_set(), records)
+        self.assertTrue(records)
+
+    def test_changed_answers_are_recomputed(self):
+        self.theory.check_plagiarism()
+        answer = self.submissions[1].answers.get(question=self.long_question)
+        answer.answer = "Lists are mutable, tuples are immutable."
+        answer.save()
+        stats = {}
+
+        self.theory.check_plagiarism(stats=stats)
+
+        self.assertEqual(stats.get('replayed_questions'), 1)
+        self.assertEqual(
+            QuestionPlagiarismRecord.objects.filter(question=self.long_question).count(), 3
+        )
+
+    def test_late_submission_only_encodes_its_own_answers(self):
+        self.theory.check_plagiarism()
+        existing = set(PlagiarismRecord.objects.values_list('id', flat=True))
+        late_student = User.objects.create(
+            email="late@example.com",
+            first_name="Late",
+            last_name="Student",
+            role=RoleChoices.STUDENT,
+            institution=self.institution,
+            is_active=True
+        )
+        late = self.create_submission_with_answers(late_student, {
+            self.short_question: "A variable is a name for a memory location.",
+            self.long_question: "Sets are unordered collections.",
+        })
+        self.model.calls.clear()
+
+        records = late.check_plagiarism()
+
+        # The short answers were all copies, so none of them had been encoded yet
+        self.assertEqual(self.model.encoded_texts, ["A variable is a name for a memory location.", "Sets are unordered collections."])
+        self.assertEqual(len(records), 3)
+        self.assertTrue(existing <= set(PlagiarismRecord.objects.values_list('id', flat=True)))
+        late.refresh_from_db()
+        self.assertEqual(late.plagiarism_score, 1.0)
+
+
+class StoreSearchPlagiarismTestCase(FakeModelTheoryMixin, TestCase):
+    """Test cases for single-submission plagiarism search through the memmap embedding store"""
+
+    store_settings = {'EMBEDDING_STORE': 'memmap'}
+
+    def setUp(self):
+        super().setUp()
+        self.root = tempfile.TemporaryDirectory()
+        self.submissions = [
+            self.create_submission_with_answers(self.students[0], {
+                self.short_question: "A variable is a name for a memory location.",
+                self.long_question: "Lists are mutable, tuples are immutable.",
+            }),
+            self.create_submission_with_answers(self.students[1], {
+                self.short_question: "A variable is a name for a memory location.",
+                self.long_question: "Tuples cannot be changed after creation.",
+            }),
+            self.create_submission_with_answers(self.students[2], {
+                self.short_question: "Variables hold values.",
+                self.long_question: "Lists are mutable, tuples are immutable.",
+            }),
+        ]
+
+    def tearDown(self):
+        super().tearDown()
+        self.root.cleanup()
+
+    def store_enabled(self):
+        return override_settings(EMBEDDING_STORE_ROOT=self.root.name, EMBEDDING_CACHE_PERSIST=False, **self.store_settings)
+
+    def record_set(self):
+        return {
+            (record.submission1_id, record.submission2_id, record.similarity_score,
+             frozenset(record.question_records.values_list('question_id', 'similarity_score')))
+            for record in PlagiarismRecord.objects.all()
+        }
+
+    def test_search_matches_full_comparison(self):
+        for submission in self.submissions:
+            submission.check_plagiarism()
+        expected = self.record_set()
+        PlagiarismRecord.objects.all().delete()
+
+        with self.store_enabled():
+            for submission in self.submissions:
+                submission.check_plagiarism()
+
+        self.assertEqual(self.record_set(), expected)
+        self.assertEqual(len(expected), 2)
+
+    def test_stored_peers_are_not_reencoded(self):
+        with self.store_enabled():
+            self.submissions[0].check_plagiarism()
+            embedding_cache.memory_cache.clear()
+            self.model.calls.clear()
+
+            self.submissions[1].check_plagiarism()
+
+        self.assertEqual(self.model.calls, [])
+
+    def test_edited_peer_answers_are_reencoded(self):
+        with self.store_enabled():
+            self.submissions[0].check_plagiarism()
+            self.submissions[2].answers.filter(question=self.short_question).update(
+                answer="A variable is a name for a memory location."
+            )
+
+            records = self.submissions[0].check_plagiarism()
+
+        self.assertEqual(
+            {(record.submission1_id, record.submission2_id) for record in records},
+            {(self.submissions[0].id, self.submissions[1].id), (self.submissions[0].id, self.submissions[2].id)}
+        )
+        self.assertIn(
+            (self.short_question.id, 1.0),
+            set(QuestionPlagiarismRecord.objects.filter(
+                plagiarism_record__submission2=self.submissions[2]
+            ).values_list('question_id', 'similarity_score'))
+        )
+
+    def test_canonical_copies_score_one(self):
+        self.submissions[2].answers.filter(question=self.short_question).update(
+            answer="a variable is a name, for a memory location!"
+        )
+        self.submissions[2].check_plagiarism()
+        expected = self.record_set()
+        PlagiarismRecord.objects.all().delete()
+
+        with self.store_enabled():
+            self.submissions[2].check_plagiarism()
+
+        self.assertEqual(self.record_set(), expected)
+        self.assertEqual(
+            set(QuestionPlagiarismRecord.objects.filter(question=self.short_question).values_list('similarity_score', flat=True)),
+            {1.0}
+        )
+
+    def test_deleted_peer_answers_are_ignored(self):
+        deleted = list(self.submissions[1].answers.values_list('id', 'question_id', 'answer'))
+        with self.store_enabled():
+            self.submissions[0].check_plagiarism()
+            self.submissions[1].delete()
+
+            records = self.submissions[0].check_plagiarism()
+            store = get_store()
+
+        self.assertEqual(
+            [(record.submission1_id, record.submission2_id) for record in records],
+            [(self.submissions[0].id, self.submissions[2].id)]
+        )
+        for answer_id, question_id, text in deleted:
+            question = TheoryQuestions.objects.get(id=question_id)
+            self.assertFalse(store.contains(
+                (self.theory.id, question_id), model_tag(question.answer_type), [answer_id], [text_fingerprint(text)]
+            )[0])
+
+    def test_answers_are_deleted_in_one_query(self):
+        with self.store_enabled(), self.assertNumQueries(1):
+            TheorySubmissionAnswer.objects.filter(submission=self.submissions[1]).delete()
+
+
+class PgVectorStoreSearchPlagiarismTestCase(StoreSearchPlagiarismTestCase):
+    """The same checks against the pgvector store; needs PostgreSQL with the vector extension"""
+
+    store_settings = {'EMBEDDING_STORE': 'pgvector'}
+
+    def setUp(self):
+        from django.db import connection
+        from cognigrade.utils.embedding_store import ANSWER_EMBEDDING_TABLE
+
+        if connection.vendor != 'postgresql':
+            self.skipTest("pgvector store needs PostgreSQL")
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT to_regclass(%s)", [ANSWER_EMBEDDING_TABLE])
+            if cursor.fetchone()[0] is None:
+                self.skipTest("pgvector extension is not installed")
+        super().setUp()
+
+
+class HistoryPlagiarismTestCase(FakeModelTheoryMixin, TestCase):
+    """Test cases for cross-theory plagiarism search over the course ANN index"""
+
+    def setUp(self):
+        super().setUp()
+        self.index_dir = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(ANN_INDEX_ROOT=self.index_dir.name)
+        self.settings_override.enable()
+
+        other_classroom = Classroom.objects.create(name="Last term", course=self.course, teacher=self.teacher)
+        self.old_theory = Theory.objects.create(classroom=other_classroom, title="Python Basics", type=TheoryType.QUIZ)
+        old_question = TheoryQuestions.objects.create(
+            theory=self.old_theory,
+            question="define a variable in python.",
+            answer=self.short_question.answer,
+            marks=10,
+            answer_type=AnswerType.SHORT
+        )
+        self.old_submission = TheorySubmission.objects.create(theory=self.old_theory, student=self.students[2])
+        self.old_answer = TheorySubmissionAnswer.objects.create(
+            submission=self.old_submission,
+            question=old_question,
+            answer="A variable is a label bound to an object."
+        )
+        TheorySubmissionAnswer.index([self.old_answer])
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.index_dir.cleanup()
+        super().tearDown()
+
+    def test_finds_answer_from_earlier_term(self):
+        submission = self.create_submission_with_answers(self.students[0], {
+            self.short_question: "A variable is a label bound to an object.",
+        })
+        classmate = self.create_submission_with_answers(self.students[1], {
+            self.short_question: "A variable is a label bound to an object.",
+        })
+        TheorySubmissionAnswer.index(list(classmate.answers.all()))
+
+        self.client.force_authenticate(user=self.teacher)
+        response = self.client.get(reverse('theory-submission-history-plagiarism', kwargs={'pk': submission.id}))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        matches = response.data['matches'][0]['matches']
+        # The classmate's identical answer belongs to the same theory and is excluded
+        self.assertEqual([match['answer_id'] for match in matches], [self.old_answer.id])
+        self.assertEqual(matches[0]['theory_id'], self.old_theory.id)
+        self.assertAlmostEqual(matches[0]['similarity'], 1.0, places=3)
+
+    def test_search_does_not_write_to_index(self):
+        submission = self.create_submission_with_answers(self.students[0], {
+            self.short_question: "A variable is a label bound to an object.",
+        })
+        index_root = self.index_dir.name
+
+        def snapshot():
+            return sorted(
+                (os.path.join(directory, name), os.path.getmtime(os.path.join(directory, name)))
+                for directory, _, names in os.walk(index_root) for name in names
+            )
+
+        before = snapshot()
+        self.client.force_authenticate(user=self.teacher)
+        response = self.client.get(reverse('theory-submission-history-plagiarism', kwargs={'pk': submission.id}))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(snapshot(), before)
+
+    def test_rejects_non_positive_k(self):
+        submission = self.create_submission_with_answers(self.students[0], {
+            self.short_question: "A variable is a label bound to an object.",
+        })
+        self.client.force_authenticate(user=self.teacher)
+        response = self.client.get(reverse('theory-submission-history-plagiarism', kwargs={'pk': submission.id}), {'k': 0})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(ANN_INDEX_IN_BACKGROUND=False)
+    def test_answers_are_indexed_after_commit(self):
+        submission = self.create_submission_with_answers(self.students[0], {
+            self.short_question: "A variable is a label bound to an object.",
+        })
+        self.client.force_authenticate(user=self.teacher)
+
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            TheorySubmissionAnswer.index_later(answer.id for answer in submission.answers.all())
+        response = self.client.get(reverse('theory-submission-history-plagiarism', kwargs={'pk': submission.id}))
+        # Nothing is indexed until the transaction commits
+        self.assertEqual(len(response.data['matches'][0]['matches']), 1)
+
+        for callback in callbacks:
+            callback()
+        # Excluded from its own theory, but found from another theory's point of view
+        response = self.client.get(reverse('theory-submission-history-plagiarism', kwargs={'pk': self.old_submission.id}))
+        self.assertEqual(
+            [match['answer_id'] for match in response.data['matches'][0]['matches']],
+            [submission.answers.get().id]
+        )
+
+    def test_build_command_indexes_missed_answers(self):
+        submission = self.create_submission_with_answers(self.students[0], {
+            self.short_question: "A variable is a label bound to an object.",
+        })
+        call_command('build_ann_indexes', stdout=StringIO())
+
+        self.client.force_authenticate(user=self.teacher)
+        response = self.client.get(reverse('theory-submission-history-plagiarism', kwargs={'pk': self.old_submission.id}))
+        self.assertEqual(
+            [match['answer_id'] for match in response.data['matches'][0]['matches']],
+            [submission.answers.get().id]
+        )
+
+    def test_build_command_reruns_keep_index(self):
+        submission = self.create_submission_with_answers(self.students[0], {
+            self.short_question: "A variable is a label bound to an object.",
+        })
+        TheorySubmissionAnswer.index(list(submission.answers.all()))
+        for _ in range(2):
+            call_command('build_ann_indexes', stdout=StringIO())
+
+        index = ann.get_index(*TheorySubmissionAnswer.index_partition(self.old_answer), model_tag(AnswerType.SHORT))
+        self.assertEqual(len(index), 2)
+        # Answers already in the index were not inserted again
+        self.assertEqual(len(np.load(os.path.join(index.path, 'entries.npy'))), 2)
+
+        self.client.force_authenticate(user=self.teacher)
+        response = self.client.get(reverse('theory-submission-history-plagiarism', kwargs={'pk': self.old_submission.id}))
+        self.assertEqual(
+            [match['answer_id'] for match in response.data['matches'][0]['matches']],
+            [submission.answers.get().id]
+        )
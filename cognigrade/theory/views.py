@@ -16,6 +16,7 @@ from .serializer import (
     QuestionPlagiarismRecordSerializer
 )
 from cognigrade.utils.paginations import PagePagination
+from cognigrade.utils.evaluation import grading_cache
 from .filters import TheoryFilter, TheorySubmissionFilter
 from rest_framework.decorators import action
 from rest_framework.response import Response
@@ -57,10 +58,14 @@ class TheoryViewSet(viewsets.ModelViewSet):
         submissions = TheorySubmission.objects.filter(theory=theory)
         if submissions.count() == 0:
             return Response({'error': 'No submissions found'}, status=status.HTTP_400_BAD_REQUEST)
-        for submission in submissions:
-            submission.evaluate()
-            submission.save()
-        return Response({'message': 'Submissions evaluated', 'submissions': TheorySubmissionSerializer(submissions, many=True).data}, status=status.HTTP_200_OK)
+        force = str(request.data.get('force', False)).lower() in ('true', '1')
+        evaluated = theory.evaluate(submissions=submissions, force=force)
+        return Response({
+            'message': 'Submissions evaluated',
+            'evaluated': len(evaluated),
+            'grading_cache': grading_cache.stats(),
+            'submissions': TheorySubmissionSerializer(submissions, many=True).data
+        }, status=status.HTTP_200_OK)
     
     @transaction.atomic
     @action(url_path='check-plagiarism', detail=True, methods=['post'], permission_classes=[IsSuperAdminUser|IsAdminUser|IsTeacher])
@@ -103,21 +108,20 @@ class TheoryViewSet(viewsets.ModelViewSet):
                     'error': f'Invalid threshold value for {key}'
                 }, status=status.HTTP_400_BAD_REQUEST)
         
-        # First, clear all existing plagiarism records for this theory
-        # This will cascade delete related QuestionPlagiarismRecords due to on_delete=CASCADE
-        logger.info(f"Deleting existing plagiarism records for theory {theory.id}")
-        
-        # Delete records where either submission1 or submission2 is from this theory
-        deleted_count1 = PlagiarismRecord.objects.filter(submission1__theory=theory).delete()
-        deleted_count2 = PlagiarismRecord.objects.filter(submission2__theory=theory).delete()
-        
-        logger.info(f"Deleted {deleted_count1[0] + deleted_count2[0]} existing plagiarism records")
-        
-        # Check each submission for plagiarism with the specified thresholds
+        # Rebuild all plagiarism records for this theory with the specified thresholds.
+        # Existing records are deleted first, cascading to QuestionPlagiarismRecords.
         logger.info(f"Processing {submissions.count()} submissions")
-        for submission in submissions:
-            logger.info(f"Checking submission {submission.id} for student {submission.student.email}")
-            submission.check_plagiarism(thresholds=thresholds)
+        # Stored similarity scores are replayed for new thresholds unless a recompute is requested
+        replay = str(request.data.get('replay', True)).lower() not in ('false', '0')
+        stage_counts = {}
+        try:
+            # Rolled back on failure, so the previous records and scores stay in place
+            with transaction.atomic():
+                theory.check_plagiarism(thresholds=thresholds, stats=stage_counts, replay=replay)
+        except Exception as e:
+            logger.exception(f"Plagiarism check failed for theory {theory.id}")
+            return Response({'error': f'Plagiarism check failed: {str(e)}'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        logger.info(f"Pairs resolved per stage: {stage_counts}")
         
         # Get all plagiarism records for this theory
         plagiarism_records = PlagiarismRecord.objects.filter(
@@ -131,6 +135,7 @@ class TheoryViewSet(viewsets.ModelViewSet):
             'theory_title': theory.title,
             'thresholds_used': thresholds,
             'total_records': plagiarism_records.count(),
+            'stage_counts': stage_counts,
             'plagiarism_results': PlagiarismRecordSerializer(plagiarism_records, many=True).data
         }, status=status.HTTP_200_OK)
 
@@ -286,13 +291,19 @@ class TheorySubmissionViewSet(viewsets.ModelViewSet):
                     'error': f'Invalid threshold value for {key}'
                 }, status=status.HTTP_400_BAD_REQUEST)
         
-        # Delete existing plagiarism records for this submission
-        PlagiarismRecord.objects.filter(
-            models.Q(submission1=submission) | models.Q(submission2=submission)
-        ).delete()
-        
-        # Check for plagiarism
-        submission.check_plagiarism(thresholds=thresholds)
+        try:
+            # Rolled back on failure, so the previous records stay in place
+            with transaction.atomic():
+                # Delete existing plagiarism records for this submission
+                PlagiarismRecord.objects.filter(
+                    models.Q(submission1=submission) | models.Q(submission2=submission)
+                ).delete()
+                
+                # Check for plagiarism
+                submission.check_plagiarism(thresholds=thresholds)
+        except Exception as e:
+            logger.exception(f"Plagiarism check failed for submission {submission.id}")
+            return Response({'error': f'Plagiarism check failed: {str(e)}'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
         
         # Get plagiarism records involving this submission
         plagiarism_records = PlagiarismRecord.objects.filter(
@@ -306,4 +317,24 @@ class TheorySubmissionViewSet(viewsets.ModelViewSet):
             'theory_title': submission.theory.title,
             'thresholds_used': thresholds,
             'plagiarism_records': PlagiarismRecordSerializer(plagiarism_records, many=True).data
+        }, status=status.HTTP_200_OK)
+    
+    @action(url_path='history-plagiarism', detail=True, methods=['get'], permission_classes=[IsSuperAdminUser|IsAdminUser|IsTeacher])
+    def history_plagiarism(self, request, *args, **kwargs):
+        """Search other sections and earlier terms of the course for answers similar to this submission"""
+        submission = self.get_object()
+        
+        try:
+            k = int(request.query_params.get('k', 5))
+            threshold = request.query_params.get('threshold')
+            threshold = float(threshold) if threshold is not None else None
+        except ValueError:
+            return Response({'error': 'Invalid k or threshold'}, status=status.HTTP_400_BAD_REQUEST)
+        if k <= 0:
+            return Response({'error': 'k must be at least 1'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        return Response({
+            'submission_id': submission.id,
+            'theory_id': submission.theory.id,
+            'matches': submission.history_plagiarism(k=k, threshold=threshold)
         }, status=status.HTTP_200_OK)
\ No newline at end of file
@@ -28,6 +28,7 @@ from cognigrade.institutions.urls import institutions_router
 from cognigrade.courses.urls import courses_router
 from cognigrade.omr.urls import omr_router
 from cognigrade.theory.urls import theory_router
+from cognigrade.utils.views import readiness
 
 router = DefaultRouter()
 router.registry.extend(users_router.registry)
@@ -42,4 +43,5 @@ urlpatterns = [
     path(r'api/v1/login/token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
     path(r'api/v1/login/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
     path(r'api/v1/login/token/verify/', TokenVerifyView.as_view(), name='token_verify'),
+    path(r'api/v1/health/ready/', readiness, name='readiness'),
 ]
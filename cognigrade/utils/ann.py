@@ -0,0 +1,299 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+from typing import List, Optional, Tuple
+import numpy as np
+from django.conf import settings
+from filelock import FileLock
+from cognigrade.utils.npy_files import append_rows, open_rows, row_count
+
+logger = logging.getLogger(__name__)
+
+
+def question_lineage(question_text: str) -> str:
+    """
+    Identify a question across theories, sections and terms.
+
+    Questions reused in another theory share a lineage when their text is the
+    same up to case and whitespace.
+    """
+    normalized = " ".join((question_text or "").casefold().split())
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()[:16]
+
+
+def _kmeans(vectors: np.ndarray, k: int, iterations: int = 10, seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """Spherical k-means: centroids are kept normalized and assignment uses cosine similarity."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        counts = np.bincount(assignments, minlength=k)
+        # Empty clusters keep their previous centroid
+        filled = counts > 0
+        norms = np.linalg.norm(sums[filled], axis=1, keepdims=True)
+        centroids[filled] = sums[filled] / np.maximum(norms, 1e-12)
+    assignments = np.argmax(vectors @ centroids.T, axis=1)
+    return centroids, assignments.astype(np.int32)
+
+
+class IVFIndex:
+    """
+    Inverted-file approximate nearest-neighbour index over normalized embeddings.
+
+    The index is a directory of append-only .npy files read through np.memmap:
+    vectors.npy and entries.npy (id and group of every row), superseded.npy
+    (rows replaced by a later insert of the same id), and per training
+    generation the centroids and one inverted list of row numbers per cluster.
+    Inserts append rows and extend the lists of their nearest clusters under a
+    file lock; nothing is rewritten. A query reads the centroids and the
+    nprobe closest lists and scores only those rows. Until the index has been
+    trained (train(), run outside requests), search is exhaustive. Superseded
+    rows stay in the files until compact() rewrites the index without them.
+
+    Each vector carries an id and an integer group (the theory it came from)
+    so queries can exclude their own group. An index built with another model
+    is discarded, since its vectors are not comparable with new embeddings.
+    """
+
+    def __init__(self, path: str, model_tag: str = '', min_train_size: Optional[int] = None):
+        self.path = path
+        self.model_tag = model_tag
+        self.min_train_size = min_train_size or getattr(settings, 'ANN_MIN_TRAIN_SIZE', 1024)
+        self._meta = None
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _generation_file(self, generation: int, name: str) -> str:
+        return os.path.join(self.path, f"gen_{generation}", name)
+
+    def _lock(self) -> FileLock:
+        return FileLock(f"{self.path}.lock")
+
+    def _read_meta(self) -> Optional[dict]:
+        try:
+            with open(self._file("meta.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @property
+    def meta(self) -> dict:
+        """
+        Training generation and size, read once per instance.
+
+        'exists' is False when there is no index yet, or only one built with another model.
+        """
+        if self._meta is None:
+            meta = self._read_meta()
+            if meta is None or meta.get('model_tag') != self.model_tag:
+                meta = {'model_tag': self.model_tag, 'generation': 0, 'trained_size': 0, 'exists': False}
+            else:
+                meta['exists'] = True
+            self._meta = meta
+        return self._meta
+
+    def _write_meta(self, meta: dict) -> None:
+        tmp_path = self._file("meta.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self._file("meta.json"))
+        self._meta = None
+
+    def _rows(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Memory-mapped vectors and entries, cut to the rows both files hold"""
+        vectors = open_rows(self._file("vectors.npy"))
+        entries = open_rows(self._file("entries.npy"))
+        count = min(len(vectors), len(entries))
+        return vectors[:count], entries[:count]
+
+    def _superseded(self) -> np.ndarray:
+        return np.asarray(open_rows(self._file("superseded.npy")), dtype=np.int64)
+
+    def __len__(self):
+        if not self.meta['exists']:
+            return 0
+        return min(row_count(self._file("vectors.npy")), row_count(self._file("entries.npy"))) - row_count(self._file("superseded.npy"))
+
+    @property
+    def is_trained(self) -> bool:
+        return self.meta['generation'] > 0
+
+    @property
+    def needs_training(self) -> bool:
+        """True once the index is big enough to train and has doubled since the last training"""
+        size = len(self)
+        return size >= self.min_train_size and size >= 2 * self.meta['trained_size']
+
+    def _reset_if_stale(self) -> None:
+        """Start over when the index on disk was built with another model (writers only)"""
+        meta = self._read_meta()
+        if meta is not None and meta.get('model_tag') != self.model_tag:
+            logger.info(f"Discarding ANN index {self.path} built with {meta.get('model_tag')}")
+            shutil.rmtree(self.path)
+            meta = None
+        if meta is None:
+            shutil.rmtree(self.path, ignore_errors=True)
+            os.makedirs(self.path)
+            self._write_meta({'model_tag': self.model_tag, 'generation': 0, 'trained_size': 0})
+        self._meta = None
+
+    def add(self, ids, vectors: np.ndarray, groups) -> None:
+        """Insert vectors, superseding any existing entries with the same ids."""
+        ids = np.asarray(ids, dtype=np.int64)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        groups = np.asarray(groups, dtype=np.int64)
+        if not len(ids):
+            return
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with self._lock():
+            self._reset_if_stale()
+            _, entries = self._rows()
+            start = len(entries)
+            if start:
+                # Only live rows: a row superseded twice would be subtracted twice from the size
+                replaced = np.nonzero(np.isin(entries[:, 0], ids))[0]
+                replaced = replaced[~np.isin(replaced, self._superseded())]
+                if len(replaced):
+                    append_rows(self._file("superseded.npy"), replaced.astype(np.int64))
+            # Vectors first: a row only becomes visible once its entry is written
+            append_rows(self._file("vectors.npy"), vectors)
+            append_rows(self._file("entries.npy"), np.stack([ids, groups], axis=1))
+
+            generation = self.meta['generation']
+            if generation:
+                centroids = np.load(self._generation_file(generation, "centroids.npy"))
+                assignments = np.argmax(vectors @ centroids.T, axis=1)
+                rows = np.arange(start, start + len(ids), dtype=np.int64)
+                for cluster in np.unique(assignments):
+                    append_rows(self._generation_file(generation, f"list_{cluster}.npy"), rows[assignments == cluster])
+
+    def live_ids(self) -> np.ndarray:
+        """Ids of the entries a search can return"""
+        if not self.meta['exists']:
+            return np.zeros(0, dtype=np.int64)
+        _, entries = self._rows()
+        live = np.setdiff1d(np.arange(len(entries)), self._superseded())
+        return np.asarray(entries[live, 0], dtype=np.int64)
+
+    @property
+    def needs_compaction(self) -> bool:
+        """True once superseded rows make up half the files"""
+        superseded = row_count(self._file("superseded.npy"))
+        return self.meta['exists'] and superseded > 0 and 2 * superseded >= row_count(self._file("entries.npy"))
+
+    def compact(self) -> None:
+        """
+        Rewrite the index with only its live rows, dropping superseded ones.
+
+        The index is rebuilt next to the current one and swapped in; it is
+        untrained afterwards, so searches are exhaustive until train() runs.
+        """
+        with self._lock():
+            self._meta = None
+            if not self.meta['exists']:
+                return
+            vectors, entries = self._rows()
+            live = np.setdiff1d(np.arange(len(entries)), self._superseded())
+
+            compacted = f"{self.path}.compact"
+            shutil.rmtree(compacted, ignore_errors=True)
+            os.makedirs(compacted)
+            if len(live):
+                append_rows(os.path.join(compacted, "vectors.npy"), np.asarray(vectors[live]))
+                append_rows(os.path.join(compacted, "entries.npy"), np.asarray(entries[live]))
+            with open(os.path.join(compacted, "meta.json"), "w") as f:
+                json.dump({'model_tag': self.model_tag, 'generation': 0, 'trained_size': 0}, f)
+
+            # Readers holding the old files keep their memory maps until they finish
+            replaced = f"{self.path}.replaced"
+            shutil.rmtree(replaced, ignore_errors=True)
+            os.replace(self.path, replaced)
+            os.replace(compacted, self.path)
+            shutil.rmtree(replaced)
+            self._meta = None
+
+    def train(self) -> None:
+        """
+        Cluster the live vectors into about sqrt(n) lists, as a new generation.
+
+        Readers keep using the previous generation until meta.json points to
+        the new one; the generation before that is then removed.
+        """
+        with self._lock():
+            self._meta = None
+            vectors, _ = self._rows()
+            live = np.setdiff1d(np.arange(len(vectors)), self._superseded())
+            if not len(live):
+                return
+            centroids, assignments = _kmeans(np.asarray(vectors[live], dtype=np.float32), max(1, int(np.sqrt(len(live)))))
+
+            generation = self.meta['generation'] + 1
+            shutil.rmtree(os.path.join(self.path, f"gen_{generation}"), ignore_errors=True)
+            os.makedirs(os.path.dirname(self._generation_file(generation, "centroids.npy")), exist_ok=True)
+            np.save(self._generation_file(generation, "centroids.npy"), centroids)
+            for cluster in range(len(centroids)):
+                append_rows(self._generation_file(generation, f"list_{cluster}.npy"), live[assignments == cluster].astype(np.int64))
+            self._write_meta({'model_tag': self.model_tag, 'generation': generation, 'trained_size': len(live)})
+            shutil.rmtree(os.path.join(self.path, f"gen_{generation - 2}"), ignore_errors=True)
+
+    def search(self, query: np.ndarray, k: int = 5, exclude_group: Optional[int] = None, nprobe: Optional[int] = None) -> List[Tuple[int, float]]:
+        """
+        Find the k entries most similar to a query vector.
+
+        Args:
+            query: Normalized query embedding
+            k: Number of matches to return, at least 1
+            exclude_group: Skip entries from this group (e.g. the query's own theory)
+            nprobe: Number of clusters to scan, defaults to ANN_NPROBE
+
+        Returns:
+            List of (id, similarity) sorted by decreasing similarity
+        """
+        if k <= 0:
+            raise ValueError("k must be at least 1")
+        if not self.meta['exists']:
+            return []
+        vectors, entries = self._rows()
+        if not len(entries):
+            return []
+
+        generation = self.meta['generation']
+        if generation:
+            centroids = np.load(self._generation_file(generation, "centroids.npy"))
+            nprobe = min(nprobe or getattr(settings, 'ANN_NPROBE', 8), len(centroids))
+            probes = np.argpartition(-(centroids @ query), nprobe - 1)[:nprobe]
+            candidates = np.concatenate([
+                np.asarray(open_rows(self._generation_file(generation, f"list_{cluster}.npy")), dtype=np.int64)
+                for cluster in probes
+            ])
+            candidates = np.sort(candidates[candidates < len(entries)])
+        else:
+            candidates = np.arange(len(entries))
+        candidates = candidates[~np.isin(candidates, self._superseded())]
+        if exclude_group is not None and len(candidates):
+            candidates = candidates[entries[candidates, 1] != exclude_group]
+        if not len(candidates):
+            return []
+
+        similarities = np.asarray(vectors[candidates], dtype=np.float32) @ query
+        ids = entries[candidates, 0]
+        k = min(k, len(candidates))
+        top = np.argpartition(-similarities, k - 1)[:k]
+        top = top[np.argsort(-similarities[top])]
+        return [(int(ids[i]), float(similarities[i])) for i in top]
+
+
+def index_path(course_id: int, lineage: str, answer_type: str) -> str:
+    root = getattr(settings, 'ANN_INDEX_ROOT', os.path.join(settings.MEDIA_ROOT, 'ann'))
+    return os.path.join(root, f"course_{course_id}", f"{lineage}_{answer_type}")
+
+
+def get_index(course_id: int, lineage: str, answer_type: str, model_tag: str) -> IVFIndex:
+    """Index of a course and question lineage"""
+    return IVFIndex(index_path(course_id, lineage, answer_type), model_tag)
@@ -0,0 +1,44 @@
+import re
+import hashlib
+from typing import List, Tuple
+import numpy as np
+
+# Punctuation that carries no meaning: not a sign or operator, and not next to a digit
+_PUNCTUATION = re.compile(r'(?<!\d)[^\w\s+\-*/=<>^%](?!\d)')
+
+
+def canonical_text(text: str) -> str:
+    """
+    Canonical form of an answer: case-folded, punctuation removed and whitespace collapsed.
+
+    Signs, operators and punctuation next to a digit are kept, so "-5" and
+    "5", "3.14" and "314" or "a-b" and "ab" stay different. Answers with the
+    same canonical form are treated as identical and get similarity 1.0
+    without reaching a model.
+    """
+    return " ".join(_PUNCTUATION.sub('', (text or "").casefold()).split())
+
+
+def canonical_hash(text: str) -> str:
+    return hashlib.sha1(canonical_text(text).encode("utf-8")).hexdigest()
+
+
+def exact_duplicate_groups(texts: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Group texts with the same canonical form.
+
+    Returns:
+        Tuple of (representatives, inverse): the index of the first text of
+        each group, and the group of every text, so that
+        [texts[i] for i in representatives][inverse[k]] stands for texts[k]
+    """
+    groups = {}
+    representatives = []
+    inverse = np.empty(len(texts), dtype=np.int64)
+    for index, text in enumerate(texts):
+        key = canonical_hash(text)
+        if key not in groups:
+            groups[key] = len(representatives)
+            representatives.append(index)
+        inverse[index] = groups[key]
+    return np.array(representatives, dtype=np.int64), inverse
@@ -0,0 +1,143 @@
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+from typing import Dict, Iterable
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text: str) -> str:
+    """Collapse whitespace so formatting-only differences share a cache entry."""
+    return " ".join((text or "").split())
+
+
+def text_hash(text: str) -> str:
+    """Content address of a text: sha256 of its normalized form."""
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class LRUCache:
+    """Thread-safe, size-bounded least-recently-used mapping with hit/miss counters."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {'size': len(self._data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
+
+    def __len__(self):
+        return len(self._data)
+
+
+memory_cache = LRUCache(getattr(settings, 'EMBEDDING_CACHE_SIZE', 20000))
+
+# Models whose stale rows were already purged by this process
+_purged = set()
+
+
+def purge_stale(model_name: str, model_version: str) -> int:
+    """
+    Delete persisted embeddings of a model produced by any other version.
+
+    Returns:
+        Number of rows deleted
+    """
+    from cognigrade.utils.models import EmbeddingCache
+
+    deleted, _ = EmbeddingCache.objects.filter(model_name=model_name).exclude(model_version=model_version).delete()
+    if deleted:
+        logger.info(f"Purged {deleted} stale embeddings for {model_name}")
+    return deleted
+
+
+def get_many(model_name: str, model_version: str, hashes: Iterable[str], purge: bool = True) -> Dict[str, np.ndarray]:
+    """
+    Look up embeddings by text hash, first in memory then in the database.
+
+    The first database lookup of a model version in this process purges rows
+    of the model's other versions, unless purge is False (used when comparing
+    a non-default backend against the configured one).
+
+    Returns:
+        Dictionary of {text_hash: vector} for the hashes that were found
+    """
+    found = {}
+    missing = []
+    for h in hashes:
+        vector = memory_cache.get((model_name, model_version, h))
+        if vector is None:
+            missing.append(h)
+        else:
+            found[h] = vector
+
+    if not missing or not getattr(settings, 'EMBEDDING_CACHE_PERSIST', True):
+        return found
+
+    from cognigrade.utils.models import EmbeddingCache
+
+    if purge and (model_name, model_version) not in _purged:
+        _purged.add((model_name, model_version))
+        purge_stale(model_name, model_version)
+
+    rows = EmbeddingCache.objects.filter(
+        model_name=model_name,
+        model_version=model_version,
+        text_hash__in=missing
+    ).values_list('text_hash', 'vector')
+    for h, vector in rows:
+        vector = np.frombuffer(bytes(vector), dtype=np.float32)
+        memory_cache.put((model_name, model_version, h), vector)
+        found[h] = vector
+    return found
+
+
+def set_many(model_name: str, model_version: str, vectors: Dict[str, np.ndarray]) -> None:
+    """Store embeddings by text hash in memory and, if enabled, in the database."""
+    for h, vector in vectors.items():
+        memory_cache.put((model_name, model_version, h), vector)
+
+    if not vectors or not getattr(settings, 'EMBEDDING_CACHE_PERSIST', True):
+        return
+
+    from cognigrade.utils.models import EmbeddingCache
+
+    EmbeddingCache.objects.bulk_create([
+        EmbeddingCache(
+            model_name=model_name,
+            model_version=model_version,
+            text_hash=h,
+            vector=np.asarray(vector, dtype=np.float32).tobytes()
+        )
+        for h, vector in vectors.items()
+    ], ignore_conflicts=True)
@@ -0,0 +1,465 @@
+import os
+import abc
+import glob
+import hashlib
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from django.conf import settings
+from filelock import FileLock
+from cognigrade.utils.embedding_cache import LRUCache, normalize_text
+from cognigrade.utils.embeddings import model_tag
+from cognigrade.utils.npy_files import append_rows, file_dtype, open_rows, row_count
+from cognigrade.utils.similarity import binary_codes
+
+# A store key identifies one question's answers: (theory_id, question_id)
+StoreKey = Tuple[int, int]
+
+
+def text_fingerprint(text: str) -> int:
+    """60-bit fingerprint of a text's normalized form, stored next to its vector to detect edits."""
+    return int(hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()[:15], 16)
+
+
+class EmbeddingStore(abc.ABC):
+    """
+    Persistent answer embeddings, grouped by question.
+
+    Rows are identified by answer id and carry a fingerprint of the text they
+    were computed from, so an edited answer is simply not found.
+    """
+
+    @abc.abstractmethod
+    def get(self, key: StoreKey, tag: str, ids: Sequence[int], fingerprints: Sequence[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Look up stored vectors.
+
+        Returns:
+            Tuple of (found mask, float32 vectors for the found rows in order)
+        """
+
+    @abc.abstractmethod
+    def add(self, key: StoreKey, tag: str, ids: Sequence[int], fingerprints: Sequence[int], vectors: np.ndarray) -> None:
+        """Store vectors, replacing earlier vectors of the same answers."""
+
+    def get_codes(self, key: StoreKey, tag: str, ids: Sequence[int], fingerprints: Sequence[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Look up the sign codes of stored vectors (see similarity.binary_codes).
+
+        Returns:
+            Tuple of (found mask, uint64 codes for the found rows in order)
+        """
+        found, vectors = self.get(key, tag, ids, fingerprints)
+        return found, binary_codes(vectors) if found.any() else np.zeros((0, 0), dtype=np.uint64)
+
+    @abc.abstractmethod
+    def contains(self, key: StoreKey, tag: str, ids: Sequence[int], fingerprints: Sequence[int]) -> np.ndarray:
+        """Mask of the answers that have a stored vector for their current text, without loading it."""
+
+    @abc.abstractmethod
+    def remove(self, key: StoreKey, ids: Sequence[int]) -> None:
+        """Forget the vectors of deleted answers, for every model."""
+
+    @abc.abstractmethod
+    def retain(self, key: StoreKey, ids: Sequence[int]) -> None:
+        """
+        Forget the vectors of answers to a question that are not in ids, for every model.
+
+        Answers with ids above the largest of ids are kept: they may have been
+        added after ids were read.
+        """
+
+    @abc.abstractmethod
+    def search(self, key: StoreKey, tag: str, query: np.ndarray, k: int, exclude_ids: Sequence[int] = ()) -> List[Tuple[int, float]]:
+        """
+        Find the stored answers to a question most similar to a query vector.
+
+        Returns:
+            List of up to k (answer_id, similarity) sorted by decreasing similarity
+        """
+
+
+class _Lookup:
+    """Latest row and fingerprint of every stored answer, sorted by answer id"""
+
+    __slots__ = ('answer_ids', 'rows', 'fingerprints')
+
+    def __init__(self, meta: np.ndarray, removed: np.ndarray):
+        # Last occurrence of each answer id: unique over the reversed rows
+        answer_ids, reversed_rows = np.unique(meta[::-1, 0], return_index=True)
+        rows = len(meta) - 1 - reversed_rows
+        kept = ~np.isin(answer_ids, removed)
+        self.answer_ids = answer_ids[kept]
+        self.rows = rows[kept]
+        self.fingerprints = meta[self.rows, 1]
+
+    def find(self, ids: Sequence[int], fingerprints: Sequence[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """Mask of the (id, fingerprint) pairs whose latest row matches, and those rows"""
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        if not len(self.answer_ids):
+            return np.zeros(len(ids), dtype=bool), np.zeros(0, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.answer_ids, ids), len(self.answer_ids) - 1)
+        found = (
+            (self.answer_ids[positions] == ids)
+            & (self.fingerprints[positions] == np.asarray(fingerprints, dtype=np.int64).reshape(-1))
+        )
+        return found, self.rows[positions[found]]
+
+
+# {ids path: ((inode, rows, removed rows), _Lookup)}, rebuilt only when a file
+# grows; the least recently used questions are dropped past the size limit
+_lookups = LRUCache(getattr(settings, 'EMBEDDING_STORE_LOOKUPS', 256))
+
+
+class MemmapEmbeddingStore(EmbeddingStore):
+    """
+    Embeddings kept as contiguous .npy files, one set per question and model.
+
+    question_<id>_<model>.npy holds the vectors, question_<id>_<model>.codes.npy
+    their packed sign codes (48 bytes for 384 float32 dimensions, for the
+    binary prefilter), question_<id>_<model>.ids.npy the (answer id,
+    fingerprint) of each row and question_<id>_<model>.removed.npy the ids of
+    deleted answers. New rows are appended under a file lock and
+    readers open the files with np.memmap, so every worker shares the same
+    pages through the OS cache. A later row for the same answer supersedes
+    earlier ones; the latest row of each answer is looked up through an index
+    kept per process (for the EMBEDDING_STORE_LOOKUPS most recently used
+    questions) until the files change.
+    """
+
+    def __init__(self, root: Optional[str] = None, dtype: Optional[str] = None):
+        self.root = root or getattr(settings, 'EMBEDDING_STORE_ROOT', os.path.join(settings.MEDIA_ROOT, 'embeddings'))
+        # Only used for new files: rows appended to an existing file take its dtype
+        self.dtype = np.dtype(dtype or getattr(settings, 'EMBEDDING_STORE_DTYPE', 'float32'))
+
+    def _base(self, key: StoreKey) -> str:
+        theory_id, question_id = key
+        return os.path.join(self.root, f"theory_{theory_id}", f"question_{question_id}_")
+
+    def paths(self, key: StoreKey, tag: str) -> Tuple[str, str]:
+        base = self._base(key) + hashlib.sha1(tag.encode("utf-8")).hexdigest()[:8]
+        return f"{base}.npy", f"{base}.ids.npy"
+
+    def _removed_path(self, ids_path: str) -> str:
+        return ids_path[:-len(".ids.npy")] + ".removed.npy"
+
+    def _codes_path(self, ids_path: str) -> str:
+        return ids_path[:-len(".ids.npy")] + ".codes.npy"
+
+    def _rows(self, key: StoreKey, tag: str) -> Tuple[Optional[np.ndarray], Optional[_Lookup]]:
+        return self._rows_at(*self.paths(key, tag))
+
+    def _rows_at(self, vectors_path: str, ids_path: str) -> Tuple[Optional[np.ndarray], Optional[_Lookup]]:
+        removed_path = self._removed_path(ids_path)
+        try:
+            inode = os.stat(ids_path).st_ino
+        except FileNotFoundError:
+            return None, None
+        # Rows appended after the headers were read are ignored until the next lookup
+        count = min(row_count(ids_path), row_count(vectors_path))
+        if not count:
+            return None, None
+        version = (inode, count, row_count(removed_path))
+
+        cached = _lookups.get(ids_path)
+        if cached is None or cached[0] != version:
+            meta = np.asarray(open_rows(ids_path)[:count])
+            removed = np.asarray(open_rows(removed_path)[:version[2]], dtype=np.int64)
+            cached = (version, _Lookup(meta, removed))
+            _lookups.put(ids_path, cached)
+        return open_rows(vectors_path)[:count], cached[1]
+
+    def get(self, key, tag, ids, fingerprints):
+        vectors, lookup = self._rows(key, tag)
+        if lookup is None:
+            return np.zeros(len(ids), dtype=bool), np.zeros((0, 0), dtype=np.float32)
+        found, rows = lookup.find(ids, fingerprints)
+        if not found.any():
+            return found, np.zeros((0, 0), dtype=np.float32)
+        return found, np.asarray(vectors[rows], dtype=np.float32)
+
+    def get_codes(self, key, tag, ids, fingerprints):
+        _, lookup = self._rows(key, tag)
+        if lookup is None:
+            return np.zeros(len(ids), dtype=bool), np.zeros((0, 0), dtype=np.uint64)
+        found, rows = lookup.find(ids, fingerprints)
+        # Rows stored before codes were kept have none
+        codes = open_rows(self._codes_path(self.paths(key, tag)[1]))
+        coded = rows < len(codes)
+        found[np.flatnonzero(found)[~coded]] = False
+        if not found.any():
+            return found, np.zeros((0, 0), dtype=np.uint64)
+        return found, np.asarray(codes[rows[coded]], dtype=np.uint64)
+
+    def contains(self, key, tag, ids, fingerprints):
+        _, lookup = self._rows(key, tag)
+        if lookup is None:
+            return np.zeros(len(ids), dtype=bool)
+        return lookup.find(ids, fingerprints)[0]
+
+    def search(self, key, tag, query, k, exclude_ids=()):
+        vectors, lookup = self._rows(key, tag)
+        if lookup is None or k <= 0:
+            return []
+        kept = ~np.isin(lookup.answer_ids, np.asarray(exclude_ids, dtype=np.int64))
+        answer_ids, rows = lookup.answer_ids[kept], lookup.rows[kept]
+        if not len(rows):
+            return []
+
+        similarities = np.asarray(vectors[rows], dtype=np.float32) @ np.asarray(query, dtype=np.float32)
+        k = min(k, len(answer_ids))
+        top = np.argpartition(-similarities, k - 1)[:k]
+        top = top[np.argsort(-similarities[top])]
+        return [(int(answer_ids[i]), float(similarities[i])) for i in top]
+
+    def add(self, key, tag, ids, fingerprints, vectors):
+        if not len(ids):
+            return
+        vectors_path, ids_path = self.paths(key, tag)
+        os.makedirs(os.path.dirname(vectors_path), exist_ok=True)
+        meta = np.array(list(zip(ids, fingerprints)), dtype=np.int64).reshape(-1, 2)
+        with FileLock(f"{vectors_path}.lock"):
+            # Vectors first: a row only becomes visible once its ids are written
+            dtype = file_dtype(vectors_path) if os.path.exists(vectors_path) else self.dtype
+            codes_path = self._codes_path(ids_path)
+            # Codes are row-aligned with the vectors, so files from before they were kept get none
+            if row_count(codes_path) == row_count(vectors_path):
+                append_rows(codes_path, binary_codes(np.asarray(vectors, dtype=np.float32)))
+            append_rows(vectors_path, np.asarray(vectors, dtype=dtype))
+            append_rows(ids_path, meta)
+
+    def remove(self, key, ids):
+        if not len(ids):
+            return
+        ids = np.asarray(ids, dtype=np.int64)
+        for ids_path in glob.glob(glob.escape(self._base(key)) + "*.ids.npy"):
+            vectors_path = ids_path[:-len(".ids.npy")] + ".npy"
+            with FileLock(f"{vectors_path}.lock"):
+                append_rows(self._removed_path(ids_path), ids)
+
+    def retain(self, key, ids):
+        if not len(ids):
+            return
+        ids = np.asarray(ids, dtype=np.int64)
+        for ids_path in glob.glob(glob.escape(self._base(key)) + "*.ids.npy"):
+            vectors_path = ids_path[:-len(".ids.npy")] + ".npy"
+            _, lookup = self._rows_at(vectors_path, ids_path)
+            if lookup is None:
+                continue
+            gone = np.setdiff1d(lookup.answer_ids[lookup.answer_ids < ids.max()], ids)
+            if len(gone):
+                with FileLock(f"{vectors_path}.lock"):
+                    append_rows(self._removed_path(ids_path), gone)
+
+
+ANSWER_EMBEDDING_TABLE = f'{settings.DB_PREFIX}_answer_embedding'
+
+
+def _vector_literal(vector: np.ndarray) -> str:
+    return "[" + ",".join(repr(float(x)) for x in vector) + "]"
+
+
+def _parse_vector(text: str) -> np.ndarray:
+    return np.array(text.strip("[]").split(","), dtype=np.float32)
+
+
+class PgVectorEmbeddingStore(EmbeddingStore):
+    """
+    Embeddings kept in a pgvector column of the answer embedding table.
+
+    Similarity search runs in PostgreSQL as a cosine-distance query joined with
+    the answers table, using the HNSW index of the embedding's dimension, so
+    neither vectors nor answer texts of other submissions are loaded into Python.
+    The table and its indexes are created by a migration when the database is
+    PostgreSQL with the vector extension available.
+    """
+
+    def get(self, key, tag, ids, fingerprints):
+        from django.db import connection
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT answer_id, fingerprint, embedding::text FROM {ANSWER_EMBEDDING_TABLE} "
+                "WHERE model_tag = %s AND answer_id = ANY(%s::bigint[])",
+                [tag, [int(answer_id) for answer_id in ids]]
+            )
+            rows = {(answer_id, fingerprint): text for answer_id, fingerprint, text in cursor.fetchall()}
+
+        texts = [rows.get((int(answer_id), int(fingerprint))) for answer_id, fingerprint in zip(ids, fingerprints)]
+        found = np.array([text is not None for text in texts], dtype=bool)
+        if not found.any():
+            return found, np.zeros((0, 0), dtype=np.float32)
+        return found, np.stack([_parse_vector(text) for text in texts if text is not None])
+
+    def add(self, key, tag, ids, fingerprints, vectors):
+        from django.db import connection
+
+        theory_id, question_id = key
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {ANSWER_EMBEDDING_TABLE} "
+                "(theory_id, question_id, answer_id, model_tag, fingerprint, dims, embedding) "
+                "VALUES (%s, %s, %s, %s, %s, %s, %s::vector) "
+                "ON CONFLICT (answer_id, model_tag) DO UPDATE SET "
+                "fingerprint = EXCLUDED.fingerprint, dims = EXCLUDED.dims, embedding = EXCLUDED.embedding",
+                [
+                    (theory_id, question_id, int(answer_id), tag, int(fingerprint), len(vector), _vector_literal(vector))
+                    for answer_id, fingerprint, vector in zip(ids, fingerprints, vectors)
+                ]
+            )
+
+    def contains(self, key, tag, ids, fingerprints):
+        from django.db import connection
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT answer_id, fingerprint FROM {ANSWER_EMBEDDING_TABLE} WHERE model_tag = %s AND answer_id = ANY(%s::bigint[])",
+                [tag, [int(answer_id) for answer_id in ids]]
+            )
+            stored = set(cursor.fetchall())
+        return np.array([(int(answer_id), int(fingerprint)) in stored for answer_id, fingerprint in zip(ids, fingerprints)], dtype=bool)
+
+    def remove(self, key, ids):
+        from django.db import connection
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {ANSWER_EMBEDDING_TABLE} WHERE answer_id = ANY(%s::bigint[])",
+                [[int(answer_id) for answer_id in ids]]
+            )
+
+    def retain(self, key, ids):
+        # Rows go with their answers through the ON DELETE CASCADE foreign key
+        return
+
+    def search_statements(self, key, tag, query, k, exclude_ids=(), iterative_scan=True) -> List[Tuple[str, list]]:
+        """
+        SQL search runs in one transaction: scan settings local to it, then the query.
+
+        The question filter applies to rows the HNSW index returns, so a plain
+        index scan stops after ef_search rows of any question and can miss this
+        question's answers. With pgvector 0.8+ the scan goes on until k rows
+        pass the filter (iterative_scan); older versions scan the question's
+        rows exactly instead of using the HNSW index.
+        """
+        from django.apps import apps
+
+        _, question_id = key
+        answers_table = apps.get_model('theory', 'TheorySubmissionAnswer')._meta.db_table
+        # The cast must match the partial HNSW index of this dimension for the index to be used
+        dims = int(len(query))
+        distance = f"e.embedding::vector({dims}) <=> %s::vector({dims})"
+        literal = _vector_literal(query)
+        if iterative_scan:
+            settings_statements = [
+                (f"SET LOCAL hnsw.ef_search = {min(max(int(k), 40), 1000)}", []),
+                ("SET LOCAL hnsw.iterative_scan = strict_order", []),
+            ]
+        else:
+            # Bitmap scans of the (question_id, model_tag) index stay available
+            settings_statements = [("SET LOCAL enable_indexscan = off", [])]
+        return settings_statements + [(
+            f"SELECT e.answer_id, 1 - ({distance}) AS similarity "
+            f"FROM {ANSWER_EMBEDDING_TABLE} e JOIN {answers_table} a ON a.id = e.answer_id "
+            f"WHERE e.question_id = %s AND a.question_id = %s AND e.model_tag = %s AND e.dims = {dims} "
+            "AND NOT (e.answer_id = ANY(%s::bigint[])) "
+            f"ORDER BY {distance} LIMIT %s",
+            [literal, question_id, question_id, tag, [int(answer_id) for answer_id in exclude_ids], literal, int(k)]
+        )]
+
+    def search(self, key, tag, query, k, exclude_ids=()):
+        from django.db import connection, transaction
+
+        if k <= 0:
+            return []
+        # SET LOCAL ends with the transaction, so pooled connections keep their settings
+        with transaction.atomic(), connection.cursor() as cursor:
+            for sql, params in self.search_statements(key, tag, query, k, exclude_ids, _supports_iterative_scan(cursor)):
+                cursor.execute(sql, params)
+            return [(answer_id, float(similarity)) for answer_id, similarity in cursor.fetchall()]
+
+
+# {database alias: whether its pgvector has hnsw.iterative_scan (0.8+)}
+_iterative_scan: Dict[str, bool] = {}
+
+
+def _supports_iterative_scan(cursor) -> bool:
+    alias = cursor.db.alias
+    if alias not in _iterative_scan:
+        cursor.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+        row = cursor.fetchone()
+        version = tuple(int(part) for part in row[0].split(".")[:2]) if row else (0, 0)
+        _iterative_scan[alias] = version >= (0, 8)
+    return _iterative_scan[alias]
+
+
+def get_store() -> Optional[EmbeddingStore]:
+    """The configured answer embedding store, or None when EMBEDDING_STORE is unset."""
+    backend = getattr(settings, 'EMBEDDING_STORE', '')
+    if not backend:
+        return None
+    if backend == 'memmap':
+        return MemmapEmbeddingStore()
+    if backend == 'pgvector':
+        return PgVectorEmbeddingStore()
+    raise ValueError(f"Unknown embedding store '{backend}'")
+
+
+def encode_answers(
+    keys: Sequence[StoreKey],
+    ids: Sequence[int],
+    texts: List[str],
+    answer_type: str,
+    encoder: Callable[[List[str]], np.ndarray]
+) -> np.ndarray:
+    """
+    Embeddings of answers, read from the store where possible.
+
+    Answers missing from the store (new or edited) are encoded together with
+    one encoder call and added to it.
+
+    Args:
+        keys: Store key of each answer
+        ids: Id of each answer
+        texts: Text of each answer
+        answer_type: Model the embeddings come from
+        encoder: Function encoding a list of texts with that model
+
+    Returns:
+        float32 array of embeddings, one row per answer
+    """
+    store = get_store()
+    if store is None:
+        return encoder(texts)
+
+    tag = model_tag(answer_type)
+    fingerprints = [text_fingerprint(text) for text in texts]
+    groups = {}
+    for index, key in enumerate(keys):
+        groups.setdefault(key, []).append(index)
+
+    vectors = [None] * len(texts)
+    missing = []
+    for key, indexes in groups.items():
+        found, stored = store.get(key, tag, [ids[i] for i in indexes], [fingerprints[i] for i in indexes])
+        for index, vector in zip([i for i, hit in zip(indexes, found) if hit], stored):
+            vectors[index] = vector
+        missing.extend(i for i, hit in zip(indexes, found) if not hit)
+
+    if missing:
+        encoded = encoder([texts[i] for i in missing])
+        by_key = {}
+        for index, vector in zip(missing, encoded):
+            vectors[index] = vector
+            by_key.setdefault(keys[index], []).append(index)
+        for key, indexes in by_key.items():
+            store.add(
+                key,
+                tag,
+                [ids[i] for i in indexes],
+                [fingerprints[i] for i in indexes],
+                np.stack([vectors[i] for i in indexes])
+            )
+
+    if not texts:
+        return np.zeros((0, 0), dtype=np.float32)
+    return np.stack(vectors).astype(np.float32, copy=False)
@@ -0,0 +1,300 @@
+import os
+import threading
+import logging
+from typing import Dict, Iterable, List, Optional, Tuple
+import numpy as np
+from django.conf import settings
+from cognigrade.utils import embedding_cache
+
+logger = logging.getLogger(__name__)
+
+# Path to store the models locally
+LOCAL_MODEL_DIR = os.path.join(os.path.dirname(__file__), "models")
+
+# Model used for each answer type. Grading and plagiarism detection share these
+# so each model is loaded at most once per process.
+MODEL_NAMES = {
+    "short": "sentence-transformers/all-MiniLM-L6-v2",
+    "long": "sentence-transformers/all-mpnet-base-v2",
+    "paraphrased": "sentence-transformers/paraphrase-mpnet-base-v2",
+}
+
+# Inference backends:
+#   torch       fp32 PyTorch (reference)
+#   torch-int8  PyTorch with Linear layers dynamically quantized to int8
+#   onnx        ONNX Runtime, fp32
+#   onnx-int8   ONNX Runtime with a dynamically quantized int8 export
+BACKENDS = ("torch", "torch-int8", "onnx", "onnx-int8")
+
+_models: Dict[Tuple[str, str], object] = {}
+# Commit each unpinned model's 'main' branch resolved to in the local cache
+_revisions: Dict[str, str] = {}
+_lock = threading.Lock()
+
+
+def model_backend(answer_type: str = "short") -> str:
+    """Inference backend configured for an answer type, 'torch' unless set in EMBEDDING_BACKENDS."""
+    backend = getattr(settings, 'EMBEDDING_BACKENDS', {}).get(answer_type) or "torch"
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown embedding backend '{backend}' for '{answer_type}'")
+    return backend
+
+
+def _cached_commit(name: str) -> Optional[str]:
+    """Commit the local model cache downloaded for a model's 'main' branch, or None before the first download."""
+    ref = os.path.join(LOCAL_MODEL_DIR, f"models--{name.replace('/', '--')}", "refs", "main")
+    try:
+        with open(ref) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def model_revision(answer_type: str = "short") -> str:
+    """
+    Hugging Face revision used for an answer type's model.
+
+    A commit pinned in EMBEDDING_MODEL_REVISIONS wins. Otherwise it is the
+    commit first downloaded for 'main', so an upstream update changes neither
+    the weights that are loaded nor the version embeddings are cached under.
+    'main' is only used until the model has been downloaded.
+    """
+    pinned = getattr(settings, 'EMBEDDING_MODEL_REVISIONS', {}).get(answer_type)
+    if pinned:
+        return pinned
+    name = MODEL_NAMES.get(answer_type, MODEL_NAMES["short"])
+    if name not in _revisions:
+        commit = _cached_commit(name)
+        if commit is None:
+            return "main"
+        _revisions[name] = commit
+    return _revisions[name]
+
+
+def model_version(answer_type: str = "short", backend: Optional[str] = None) -> str:
+    """
+    Version of the embeddings an answer type's model produces.
+
+    Quantized backends produce slightly different vectors, so the backend is
+    part of the version (and so of every cache key) unless it is the fp32 reference.
+    """
+    backend = backend or model_backend(answer_type)
+    revision = model_revision(answer_type)
+    return revision if backend == "torch" else f"{revision}+{backend}"
+
+
+def model_tag(answer_type: str = "short", backend: Optional[str] = None) -> str:
+    """Identifier of the exact model that produces an answer type's embeddings."""
+    if answer_type not in MODEL_NAMES:
+        answer_type = "short"
+    return f"{MODEL_NAMES[answer_type]}@{model_version(answer_type, backend)}"
+
+
+def _load_model(answer_type: str, backend: str):
+    from sentence_transformers import SentenceTransformer
+
+    name = MODEL_NAMES[answer_type]
+    revision = model_revision(answer_type)
+
+    if backend == "torch":
+        return SentenceTransformer(name, cache_folder=LOCAL_MODEL_DIR, revision=revision)
+
+    if backend == "torch-int8":
+        import torch
+
+        model = SentenceTransformer(name, cache_folder=LOCAL_MODEL_DIR, revision=revision)
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    if backend == "onnx":
+        return SentenceTransformer(name, backend="onnx", cache_folder=LOCAL_MODEL_DIR, revision=revision)
+
+    # onnx-int8: export and quantize once into LOCAL_MODEL_DIR, then load the int8 file
+    from sentence_transformers import export_dynamic_quantized_onnx_model
+
+    config = getattr(settings, 'EMBEDDING_ONNX_QUANTIZATION', 'avx2')
+    export_dir = os.path.join(LOCAL_MODEL_DIR, "onnx-int8", f"{name.replace('/', '__')}@{revision}")
+    file_name = f"onnx/model_qint8_{config}.onnx"
+    if not os.path.exists(os.path.join(export_dir, file_name)):
+        logger.info(f"Exporting int8 ONNX model for '{answer_type}' to {export_dir}")
+        model = SentenceTransformer(name, backend="onnx", cache_folder=LOCAL_MODEL_DIR, revision=revision)
+        model.save(export_dir)
+        export_dynamic_quantized_onnx_model(model, config, export_dir)
+    return SentenceTransformer(export_dir, backend="onnx", model_kwargs={"file_name": file_name})
+
+
+def get_model(answer_type: str = "short", backend: Optional[str] = None):
+    """
+    Return the SentenceTransformer for an answer type, loading it on first use.
+
+    Unknown answer types fall back to the 'short' model.
+
+    Args:
+        answer_type: Type of answer - 'short', 'long', or 'paraphrased'
+        backend: Inference backend, defaults to the one configured for the answer type
+    """
+    if answer_type not in MODEL_NAMES:
+        answer_type = "short"
+    backend = backend or model_backend(answer_type)
+
+    model = _models.get((answer_type, backend))
+    if model is not None:
+        return model
+
+    with _lock:
+        # Another thread may have loaded it while we were waiting
+        model = _models.get((answer_type, backend))
+        if model is None:
+            logger.info(f"Loading embedding model for '{answer_type}' ({backend}): {MODEL_NAMES[answer_type]}")
+            model = _load_model(answer_type, backend)
+            _models[(answer_type, backend)] = model
+    return model
+
+
+def token_lengths(model, texts: List[str]) -> List[int]:
+    """
+    Number of tokens each text occupies in a model's input, after truncation.
+
+    Models without a tokenizer fall back to whitespace word counts.
+    """
+    tokenizer = getattr(model, 'tokenizer', None)
+    if tokenizer is None:
+        return [len(text.split()) + 2 for text in texts]
+    max_length = getattr(model, 'max_seq_length', None) or 512
+    encoded = tokenizer(list(texts), add_special_tokens=True, truncation=True, max_length=max_length)
+    return [len(ids) for ids in encoded['input_ids']]
+
+
+def token_buckets(lengths: List[int], token_budget: int, max_batch_size: int) -> List[np.ndarray]:
+    """
+    Group texts of similar length into batches under a padded-token budget.
+
+    Texts are sorted by length, so each batch pads to about its own length.
+    A batch is closed once padding everything to its longest text would
+    exceed the budget, or once it holds max_batch_size texts.
+
+    Returns:
+        Index arrays into lengths, one per batch
+    """
+    order = np.argsort(np.asarray(lengths), kind='stable')
+    buckets = []
+    start = 0
+    for position, index in enumerate(order):
+        size = position - start + 1
+        if size > 1 and (size * lengths[index] > token_budget or size > max_batch_size):
+            buckets.append(order[start:position])
+            start = position
+    if len(order):
+        buckets.append(order[start:])
+    return buckets
+
+
+def encode_with_model(texts: List[str], answer_type: str = "short", backend: Optional[str] = None) -> np.ndarray:
+    """
+    Run texts through the in-process model, bypassing the cache and the embedding service.
+
+    Texts are encoded in length buckets under EMBEDDING_TOKEN_BUDGET, so a few
+    long answers don't make every short answer in their batch pad to their
+    length. Rows are returned in the order of texts.
+    """
+    model = get_model(answer_type, backend)
+    batch_size = getattr(settings, 'EMBEDDING_BATCH_SIZE', 128)
+    token_budget = getattr(settings, 'EMBEDDING_TOKEN_BUDGET', 16384)
+
+    vectors = None
+    for bucket in token_buckets(token_lengths(model, texts), token_budget, batch_size):
+        bucket_vectors = model.encode(
+            [texts[i] for i in bucket],
+            batch_size=len(bucket),
+            convert_to_numpy=True,
+            normalize_embeddings=True
+        )
+        if vectors is None:
+            vectors = np.empty((len(texts), bucket_vectors.shape[1]), dtype=np.float32)
+        vectors[bucket] = bucket_vectors
+    if vectors is None:
+        return np.zeros((0, 0), dtype=np.float32)
+    return vectors
+
+
+def encode(texts: List[str], answer_type: str = "short", backend: Optional[str] = None) -> np.ndarray:
+    """
+    Encode texts with an answer type's model, going through the embedding cache.
+
+    Only texts whose normalized form has no cached embedding for the current
+    model version reach the model, which runs in the embedding service when
+    EMBEDDING_SERVICE_ADDRESS is set and in-process otherwise.
+
+    Args:
+        texts: Texts to encode
+        answer_type: Type of answer - 'short', 'long', or 'paraphrased'
+        backend: Inference backend, defaults to the one configured for the answer type
+
+    Returns:
+        float32 array of L2 normalized embeddings, one row per text
+    """
+    if answer_type not in MODEL_NAMES:
+        answer_type = "short"
+    backend = backend or model_backend(answer_type)
+
+    texts = [embedding_cache.normalize_text(text) for text in texts]
+    if not texts:
+        return np.zeros((0, 0), dtype=np.float32)
+
+    model_name = MODEL_NAMES[answer_type]
+    version = model_version(answer_type, backend)
+    hashes = [embedding_cache.text_hash(text) for text in texts]
+
+    found = embedding_cache.get_many(
+        model_name,
+        version,
+        set(hashes),
+        purge=backend == model_backend(answer_type)
+    )
+    missing = {h: text for h, text in zip(hashes, texts) if h not in found}
+    if missing:
+        from cognigrade.utils.inference_service import get_client
+
+        client = get_client()
+        if client is not None:
+            vectors = client.encode(list(missing.values()), answer_type, backend)
+        else:
+            vectors = encode_with_model(list(missing.values()), answer_type, backend)
+        computed = dict(zip(missing.keys(), vectors))
+        embedding_cache.set_many(model_name, version, computed)
+        found.update(computed)
+
+    return np.stack([found[h] for h in hashes])
+
+
+def warm_up(answer_types: Optional[Iterable[str]] = None) -> None:
+    """
+    Load models ahead of the first request.
+
+    Args:
+        answer_types: Answer types to load, defaults to all of them
+    """
+    for answer_type in answer_types or MODEL_NAMES.keys():
+        get_model(answer_type)
+
+
+def loaded_models() -> Dict[str, bool]:
+    """Return which answer types currently have their model in memory."""
+    return {answer_type: (answer_type, model_backend(answer_type)) in _models for answer_type in MODEL_NAMES}
+
+
+def is_ready(answer_types: Optional[Iterable[str]] = None) -> bool:
+    """
+    Readiness probe: True once every requested model is loaded.
+
+    Without EMBEDDING_WARMUP models load on first use, so a worker is ready
+    as soon as it runs.
+
+    Args:
+        answer_types: Answer types that must be loaded, defaults to all of them
+    """
+    if not getattr(settings, 'EMBEDDING_WARMUP', False):
+        return True
+    return all(
+        (answer_type, model_backend(answer_type)) in _models
+        for answer_type in answer_types or MODEL_NAMES.keys()
+    )
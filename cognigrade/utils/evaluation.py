@@ -1,14 +1,10 @@
-from sentence_transformers import SentenceTransformer, util
-from typing import Tuple
-import os
-
-LOCAL_MODEL_DIR = os.path.join(os.path.dirname(__file__), "models")
-
-models = {
-    "short": SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2", cache_folder=LOCAL_MODEL_DIR),
-    "long": SentenceTransformer("sentence-transformers/all-mpnet-base-v2", cache_folder=LOCAL_MODEL_DIR),
-    "paraphrased": SentenceTransformer("sentence-transformers/paraphrase-mpnet-base-v2", cache_folder=LOCAL_MODEL_DIR),
-}
+from typing import List, Optional, Sequence, Tuple
+import numpy as np
+from django.conf import settings
+from cognigrade.utils.duplicates import canonical_text, exact_duplicate_groups
+from cognigrade.utils.embedding_cache import LRUCache, text_hash
+from cognigrade.utils.embeddings import encode, model_tag
+from cognigrade.utils.embedding_store import StoreKey, encode_answers
 
 grading_thresholds = {
     "strict": {
@@ -25,21 +21,53 @@ grading_thresholds = {
     }
 }
 
+def grading_model_type(answer_type: str) -> str:
+    """Embedding model used to grade an answer type."""
+    if answer_type == "paraphrased":
+        return "paraphrased"
+    return "short" if answer_type == "short" else "long"
+
+# Similarity of (answer, key) pairs already graded by this process
+grading_cache = LRUCache(getattr(settings, 'GRADING_CACHE_SIZE', 50000))
+
+
+def grading_cache_key(student_answer: str, answer_key: str, answer_type: str) -> Tuple[str, str, str, str]:
+    """
+    Key of a grading result: the answer, the key, the answer type and the grading model.
+
+    The model tag carries the model version, so results of a replaced model
+    are never reused.
+    """
+    return (
+        text_hash(student_answer),
+        text_hash(answer_key),
+        answer_type,
+        model_tag(grading_model_type(answer_type))
+    )
+
 def grade_answer_proc(
     student_answer: str,
     answer_key: str,
-    answer_type: str
+    answer_type: str,
+    key_embedding: Optional[np.ndarray] = None
 ) -> Tuple[str, float]:
     
-    if answer_type == "paraphrased":
-        model = models["paraphrased"]
-    else:
-        model = models["short"] if answer_type == "short" else models["long"]
-
-    emb_student = model.encode(student_answer, convert_to_tensor=True)
-    emb_key = model.encode(answer_key, convert_to_tensor=True)
+    model_type = grading_model_type(answer_type)
 
-    similarity = float(util.cos_sim(emb_student, emb_key)[0])
+    if canonical_text(student_answer) == canonical_text(answer_key):
+        # The answer is the key up to case, punctuation and whitespace
+        similarity = 1.0
+    else:
+        cache_key = grading_cache_key(student_answer, answer_key, answer_type)
+        similarity = grading_cache.get(cache_key)
+        if similarity is None:
+            if key_embedding is None:
+                emb_student, emb_key = encode([student_answer, answer_key], model_type)
+                similarity = float(np.dot(emb_student, emb_key))
+            else:
+                # Answer key was embedded ahead of time, only the student answer needs encoding
+                similarity = float(np.dot(encode([student_answer], model_type)[0], key_embedding))
+            grading_cache.put(cache_key, similarity)
 
     thresholds = grading_thresholds.get(answer_type, grading_thresholds["strict"])
 
@@ -48,4 +76,94 @@ def grade_answer_proc(
     elif similarity >= thresholds["partial"]:
         return "Partial Marks", similarity
     else:
-        return "Incorrect", similarity
\ No newline at end of file
+        return "Incorrect", similarity
+
+
+def grade_similarities(similarities: np.ndarray, answer_types: Sequence[str]) -> np.ndarray:
+    """
+    Apply grading_thresholds to many similarities at once.
+
+    Args:
+        similarities: Similarity of each answer to its key
+        answer_types: Answer type of each answer
+
+    Returns:
+        Array of grades ('Full Marks', 'Partial Marks' or 'Incorrect')
+    """
+    thresholds = [grading_thresholds.get(answer_type, grading_thresholds["strict"]) for answer_type in answer_types]
+    full = np.array([t["full"] for t in thresholds], dtype=np.float32)
+    partial = np.array([t["partial"] for t in thresholds], dtype=np.float32)
+    similarities = np.asarray(similarities, dtype=np.float32)
+    return np.where(
+        similarities >= full,
+        "Full Marks",
+        np.where(similarities >= partial, "Partial Marks", "Incorrect")
+    )
+
+
+def grade_answers_batch(
+    student_answers: List[str],
+    key_embeddings: List[np.ndarray],
+    answer_types: List[str],
+    answer_keys: Optional[List[str]] = None,
+    store_refs: Optional[List[Tuple[StoreKey, int]]] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Grade many answers, encoding each model's answers in one batch.
+
+    Answers identical to their key up to case, punctuation and whitespace
+    get similarity 1.0 without being encoded, and identical answers are
+    encoded once. When key texts are given, pairs already graded by this
+    process are served from grading_cache.
+
+    Args:
+        student_answers: Student answer texts
+        key_embeddings: Embedding of each answer's key, from the answer type's grading model
+        answer_types: Answer type of each answer
+        answer_keys: Key text of each answer, used to spot answers that match their key
+        store_refs: (store key, answer id) of each answer, to read and add
+                    embeddings through the embedding store
+
+    Returns:
+        Tuple of (grades, similarities) arrays aligned with student_answers
+    """
+    similarities = np.zeros(len(student_answers), dtype=np.float32)
+
+    groups = {}
+    cache_keys = {}
+    for index, answer_type in enumerate(answer_types):
+        if answer_keys is not None:
+            if canonical_text(student_answers[index]) == canonical_text(answer_keys[index]):
+                similarities[index] = 1.0
+                continue
+            cache_keys[index] = grading_cache_key(student_answers[index], answer_keys[index], answer_type)
+            cached = grading_cache.get(cache_keys[index])
+            if cached is not None:
+                similarities[index] = cached
+                continue
+        groups.setdefault(grading_model_type(answer_type), []).append(index)
+
+    for model_type, indexes in groups.items():
+        def encode_distinct(texts, model_type=model_type):
+            representatives, inverse = exact_duplicate_groups(texts)
+            return encode([texts[i] for i in representatives], model_type)[inverse]
+
+        texts = [student_answers[i] for i in indexes]
+        if store_refs is not None:
+            student = encode_answers(
+                [store_refs[i][0] for i in indexes],
+                [store_refs[i][1] for i in indexes],
+                texts,
+                model_type,
+                encode_distinct
+            )
+        else:
+            student = encode_distinct(texts)
+        keys = np.stack([key_embeddings[i] for i in indexes])
+        # Row-wise dot products of normalized vectors are the cosine similarities
+        similarities[indexes] = np.einsum('ij,ij->i', student, keys)
+        for index in indexes:
+            if index in cache_keys:
+                grading_cache.put(cache_keys[index], float(similarities[index]))
+
+    return grade_similarities(similarities, answer_types), similarities
@@ -0,0 +1,259 @@
+import os
+import time
+import queue
+import threading
+import logging
+from multiprocessing.connection import Client, Listener
+from typing import Dict, List, Optional, Tuple, Union
+import numpy as np
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from cognigrade.utils import embeddings
+
+logger = logging.getLogger(__name__)
+
+Address = Union[str, Tuple[str, int]]
+
+
+def parse_address(address: str) -> Address:
+    """
+    Parse an EMBEDDING_SERVICE_ADDRESS value.
+
+    An absolute path, or 'unix:/path/to/socket', is a Unix socket. TCP must be asked for
+    explicitly as 'tcp:host:port'.
+    """
+    address = (address or '').strip()
+    if address.startswith('unix:'):
+        address = address[len('unix:'):]
+    elif address.startswith('tcp:'):
+        host, separator, port = address[len('tcp:'):].rpartition(':')
+        if not separator or not host or not port.isdigit() or not 0 < int(port) < 65536:
+            raise ImproperlyConfigured(
+                f"Invalid embedding service address {address!r}: expected 'tcp:host:port' with a port between 1 and 65535"
+            )
+        return host, int(port)
+    if not os.path.isabs(address):
+        raise ImproperlyConfigured(
+            f"Invalid embedding service address {address!r}: expected an absolute socket path, "
+            f"'unix:/path/to/socket' or 'tcp:host:port'"
+        )
+    return address
+
+
+def _authkey() -> bytes:
+    """
+    Key both ends prove they know before any message is exchanged.
+
+    Messages are pickled, so anyone who can connect can run code in the
+    service: there is no default key, and the (public) SECRET_KEY is refused.
+    """
+    authkey = getattr(settings, 'EMBEDDING_SERVICE_AUTHKEY', '')
+    if not authkey or authkey == settings.SECRET_KEY:
+        raise ImproperlyConfigured(
+            "EMBEDDING_SERVICE_AUTHKEY must be set to a random secret, other than SECRET_KEY, "
+            "to run or connect to the embedding service"
+        )
+    return authkey.encode('utf-8')
+
+
+class _Request:
+    """Texts waiting for the next batch, and the slot their vectors come back in"""
+
+    __slots__ = ('texts', 'answer_type', 'backend', 'done', 'vectors', 'error')
+
+    def __init__(self, texts: List[str], answer_type: str, backend: str):
+        self.texts = texts
+        self.answer_type = answer_type
+        self.backend = backend
+        self.done = threading.Event()
+        self.vectors = None
+        self.error = None
+
+
+class EmbeddingServer:
+    """
+    Long-lived process that owns the embedding models.
+
+    Each client connection is served by its own thread, which queues the
+    request and waits. A single batching thread drains the queue: it waits up
+    to max_latency for more requests after the first one, or until
+    max_batch_size texts are queued, then runs one forward pass per model for
+    everything it collected. Concurrent grading and plagiarism requests from
+    all web workers therefore share forward passes.
+    """
+
+    def __init__(self, address: Address, max_batch_size: Optional[int] = None, max_latency: Optional[float] = None):
+        self.address = address
+        self._authkey = _authkey()
+        self.max_batch_size = max_batch_size or getattr(settings, 'EMBEDDING_SERVICE_MAX_BATCH', 256)
+        if max_latency is None:
+            max_latency = getattr(settings, 'EMBEDDING_SERVICE_MAX_LATENCY', 0.01)
+        self.max_latency = max_latency
+        self.batches = 0
+        self._queue = queue.Queue()
+        self._listener = None
+        self._stopped = threading.Event()
+
+    def start(self) -> None:
+        """Bind the address and start serving in background threads."""
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+        self._listener = Listener(self.address, authkey=self._authkey)
+        if isinstance(self.address, str):
+            # Only the service's own user (and group) may connect
+            os.chmod(self.address, 0o660)
+        threading.Thread(target=self._batch_loop, daemon=True).start()
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        logger.info(f"Embedding service listening on {self.address}")
+
+    def serve_forever(self) -> None:
+        self.start()
+        self._stopped.wait()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._queue.put(None)
+        if self._listener is not None:
+            self._listener.close()
+
+    def _accept_loop(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                connection = self._listener.accept()
+            except OSError:
+                # Listener closed by stop()
+                break
+            except Exception as e:
+                logger.warning(f"Rejected embedding service connection: {str(e)}")
+                continue
+            threading.Thread(target=self._serve_connection, args=(connection,), daemon=True).start()
+
+    def _serve_connection(self, connection) -> None:
+        with connection:
+            while True:
+                try:
+                    message = connection.recv()
+                except (EOFError, OSError):
+                    return
+
+                if message.get('op') == 'status':
+                    connection.send({'models': embeddings.loaded_models(), 'ready': embeddings.is_ready()})
+                    continue
+
+                request = _Request(message['texts'], message['answer_type'], message['backend'])
+                self._queue.put(request)
+                request.done.wait()
+                if request.error is not None:
+                    connection.send({'error': request.error})
+                else:
+                    connection.send({'vectors': request.vectors})
+
+    def _batch_loop(self) -> None:
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = [first]
+            size = len(first.texts)
+            deadline = time.monotonic() + self.max_latency
+            while size < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    self._queue.put(None)
+                    break
+                batch.append(request)
+                size += len(request.texts)
+            self._run(batch)
+
+    def _run(self, batch: List[_Request]) -> None:
+        """Encode a batch with one forward pass per (answer type, backend)."""
+        self.batches += 1
+        by_model: Dict[Tuple[str, str], List[_Request]] = {}
+        for request in batch:
+            by_model.setdefault((request.answer_type, request.backend), []).append(request)
+
+        for (answer_type, backend), requests in by_model.items():
+            try:
+                vectors = embeddings.encode_with_model(
+                    [text for request in requests for text in request.texts],
+                    answer_type,
+                    backend
+                )
+                offset = 0
+                for request in requests:
+                    request.vectors = vectors[offset:offset + len(request.texts)]
+                    offset += len(request.texts)
+            except Exception as e:
+                logger.error(f"Error encoding batch for '{answer_type}' ({backend}): {str(e)}")
+                for request in requests:
+                    request.error = str(e)
+            finally:
+                for request in requests:
+                    request.done.set()
+
+
+class EmbeddingClient:
+    """
+    Thin client of the embedding service.
+
+    Connections are not thread-safe, so each thread keeps its own and
+    reconnects once if the service was restarted.
+    """
+
+    def __init__(self, address: Address):
+        self.address = address
+        self._authkey = _authkey()
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = Client(self.address, authkey=self._authkey)
+            self._local.connection = connection
+        return connection
+
+    def _call(self, message: dict) -> dict:
+        for attempt in range(2):
+            try:
+                connection = self._connection()
+                connection.send(message)
+                return connection.recv()
+            except (EOFError, OSError):
+                self.close()
+                if attempt:
+                    raise
+        raise ConnectionError(f"Embedding service at {self.address} is unreachable")
+
+    def encode(self, texts: List[str], answer_type: str, backend: str) -> np.ndarray:
+        reply = self._call({'op': 'encode', 'texts': list(texts), 'answer_type': answer_type, 'backend': backend})
+        if 'error' in reply:
+            raise RuntimeError(f"Embedding service error: {reply['error']}")
+        return reply['vectors']
+
+    def status(self) -> dict:
+        return self._call({'op': 'status'})
+
+    def close(self) -> None:
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+
+_clients: Dict[str, EmbeddingClient] = {}
+
+
+def get_client() -> Optional[EmbeddingClient]:
+    """Client of the configured embedding service, or None when models run in-process."""
+    address = getattr(settings, 'EMBEDDING_SERVICE_ADDRESS', '')
+    if not address:
+        return None
+    if address not in _clients:
+        _clients[address] = EmbeddingClient(parse_address(address))
+    return _clients[address]
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+from cognigrade.utils import ann
+from cognigrade.utils.embeddings import model_tag
+
+
+class Command(BaseCommand):
+    help = "Index submitted answers for cross-theory plagiarism search and retrain the indexes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--course', type=int, help="Only index answers of this course")
+        parser.add_argument('--batch-size', type=int, default=500, help="Answers encoded per batch")
+        parser.add_argument('--skip-insert', action='store_true', help="Only compact and retrain the indexes")
+
+    def handle(self, *args, **options):
+        from cognigrade.theory.models import TheorySubmissionAnswer
+
+        answers = TheorySubmissionAnswer.objects.exclude(answer='').select_related(
+            'question', 'submission__theory__classroom'
+        ).order_by('id')
+        if options['course'] is not None:
+            answers = answers.filter(submission__theory__classroom__course_id=options['course'])
+
+        # Answers already live in their index are skipped, so reruns only add what was missed
+        indexed = {}
+        batch = []
+        for answer in answers.iterator(chunk_size=options['batch_size']):
+            partition = TheorySubmissionAnswer.index_partition(answer)
+            if partition not in indexed:
+                course_id, lineage, answer_type = partition
+                indexed[partition] = set(ann.get_index(course_id, lineage, answer_type, model_tag(answer_type)).live_ids().tolist())
+            if options['skip_insert'] or answer.id in indexed[partition]:
+                continue
+            batch.append(answer)
+            if len(batch) == options['batch_size']:
+                TheorySubmissionAnswer.index(batch)
+                batch = []
+        if batch:
+            TheorySubmissionAnswer.index(batch)
+
+        for course_id, lineage, answer_type in sorted(indexed):
+            index = ann.get_index(course_id, lineage, answer_type, model_tag(answer_type))
+            if index.needs_compaction:
+                index.compact()
+                index = ann.get_index(course_id, lineage, answer_type, model_tag(answer_type))
+            if len(index):
+                index.train()
+            self.stdout.write(f"course {course_id} {lineage} {answer_type}: {len(index)} answers")
+        self.stdout.write(self.style.SUCCESS(f"Built {len(indexed)} indexes"))
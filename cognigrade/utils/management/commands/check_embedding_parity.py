@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+from cognigrade.utils.embeddings import BACKENDS, MODEL_NAMES
+from cognigrade.utils.parity import check_backend_parity
+
+
+class Command(BaseCommand):
+    help = "Compare a quantized embedding backend with fp32 on stored answers before enabling it"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backend', required=True, choices=BACKENDS)
+        parser.add_argument('--answer-type', required=True, choices=list(MODEL_NAMES))
+        parser.add_argument('--limit', type=int, default=500, help="Maximum number of answers to sample")
+
+    def handle(self, *args, **options):
+        from cognigrade.theory.models import TheorySubmissionAnswer
+
+        answers = list(
+            TheorySubmissionAnswer.objects.filter(
+                question__answer_type=options['answer_type']
+            ).exclude(answer='').select_related('question').order_by('-id')[:options['limit']]
+        )
+
+        # Grading pairs (answer, key) and plagiarism pairs (answer, classmate's answer)
+        pairs = [(answer.answer, answer.question.answer) for answer in answers]
+        by_question = {}
+        for answer in answers:
+            by_question.setdefault(answer.question_id, []).append(answer.answer)
+        for texts in by_question.values():
+            pairs.extend(zip(texts, texts[1:]))
+
+        report = check_backend_parity(pairs, options['answer_type'], options['backend'])
+        for key, value in report.items():
+            self.stdout.write(f"{key}: {value}")
+
+        if not report['passed']:
+            raise CommandError(f"{options['backend']} does not match fp32 for {options['answer_type']} answers")
+        self.stdout.write(self.style.SUCCESS(f"{options['backend']} matches fp32 for {options['answer_type']} answers"))
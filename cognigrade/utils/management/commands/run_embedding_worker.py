@@ -0,0 +1,39 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from cognigrade.utils.embeddings import warm_up
+from cognigrade.utils.inference_service import EmbeddingServer, parse_address
+
+
+class Command(BaseCommand):
+    help = "Run the embedding service that web workers send their encoding requests to"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--address', help="Unix socket path or 'tcp:host:port', defaults to EMBEDDING_SERVICE_ADDRESS")
+        parser.add_argument('--max-batch-size', type=int, help="Texts per batch, defaults to EMBEDDING_SERVICE_MAX_BATCH")
+        parser.add_argument('--max-latency-ms', type=float, help="Batching window, defaults to EMBEDDING_SERVICE_MAX_LATENCY")
+        parser.add_argument('--no-warmup', action='store_true', help="Load models on first request instead of at startup")
+
+    def handle(self, *args, **options):
+        address = options['address'] or settings.EMBEDDING_SERVICE_ADDRESS
+        if not address:
+            raise CommandError("Set EMBEDDING_SERVICE_ADDRESS or pass --address")
+
+        max_latency = options['max_latency_ms']
+        try:
+            server = EmbeddingServer(
+                parse_address(address),
+                max_batch_size=options['max_batch_size'],
+                max_latency=max_latency / 1000 if max_latency is not None else None
+            )
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e))
+
+        if not options['no_warmup']:
+            warm_up()
+
+        self.stdout.write(self.style.SUCCESS(f"Embedding service listening on {address}"))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.stop()
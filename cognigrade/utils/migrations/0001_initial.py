@@ -0,0 +1,30 @@
+# Generated by Django 5.1 on 2026-10-17 12:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmbeddingCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('updated_on', models.DateTimeField(auto_now=True)),
+                ('model_name', models.CharField(max_length=255)),
+                ('model_version', models.CharField(max_length=255)),
+                ('text_hash', models.CharField(max_length=64)),
+                ('vector', models.BinaryField()),
+            ],
+            options={
+                'db_table': 'congnigrade_embedding_cache',
+                'unique_together': {('model_name', 'model_version', 'text_hash')},
+            },
+        ),
+    ]
@@ -0,0 +1,97 @@
+import zlib
+from typing import List, Optional, Set, Tuple
+import numpy as np
+from django.conf import settings
+
+# Mersenne prime used by the universal hash family
+_PRIME = np.int64((1 << 31) - 1)
+
+
+def shingles(text: str, size: int = 5) -> Set[int]:
+    """
+    Hash the character shingles of a text.
+
+    The text is case-folded and whitespace-collapsed first, so layout changes
+    don't hide a copy. Texts shorter than one shingle become a single shingle.
+    """
+    normalized = " ".join((text or "").casefold().split())
+    if len(normalized) <= size:
+        return {zlib.crc32(normalized.encode("utf-8"))}
+    return {
+        zlib.crc32(normalized[i:i + size].encode("utf-8"))
+        for i in range(len(normalized) - size + 1)
+    }
+
+
+def _permutations(num_perm: int, seed: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, _PRIME, size=num_perm, dtype=np.int64)
+    b = rng.integers(0, _PRIME, size=num_perm, dtype=np.int64)
+    return a, b
+
+
+def minhash_signatures(texts: List[str], num_perm: Optional[int] = None, shingle_size: int = 5) -> np.ndarray:
+    """
+    Compute a MinHash signature for each text.
+
+    Returns:
+        int64 array of shape (len(texts), num_perm)
+    """
+    num_perm = num_perm or getattr(settings, 'MINHASH_NUM_PERM', 128)
+    a, b = _permutations(num_perm)
+    signatures = np.empty((len(texts), num_perm), dtype=np.int64)
+    for row, text in enumerate(texts):
+        hashes = np.fromiter(shingles(text, shingle_size), dtype=np.int64) % _PRIME
+        # (num_perm, n_shingles) universal hashes, minimum per permutation
+        signatures[row] = ((np.outer(a, hashes) + b[:, None]) % _PRIME).min(axis=1)
+    return signatures
+
+
+def lsh_candidate_pairs(signatures: np.ndarray, bands: Optional[int] = None) -> Set[Tuple[int, int]]:
+    """
+    Bucket signatures band by band; texts sharing any bucket become candidates.
+
+    Returns:
+        Set of (i, j) row pairs with i < j
+    """
+    bands = bands or getattr(settings, 'MINHASH_BANDS', 32)
+    rows_per_band = max(1, signatures.shape[1] // bands)
+    candidates = set()
+    for start in range(0, signatures.shape[1], rows_per_band):
+        buckets = {}
+        for row, band in enumerate(signatures[:, start:start + rows_per_band]):
+            buckets.setdefault(band.tobytes(), []).append(row)
+        for members in buckets.values():
+            if len(members) > 1:
+                candidates.update(
+                    (members[i], members[j])
+                    for i in range(len(members))
+                    for j in range(i + 1, len(members))
+                )
+    return candidates
+
+
+def near_duplicate_pairs(texts: List[str], threshold: Optional[float] = None) -> List[Tuple[int, int]]:
+    """
+    Find near-verbatim copies.
+
+    Only LSH candidates whose own estimated Jaccard similarity reaches the
+    threshold are returned; copies of copies are not chained together.
+
+    Args:
+        texts: Texts to compare
+        threshold: Minimum estimated shingle Jaccard similarity, defaults to LEXICAL_DUPLICATE_THRESHOLD
+
+    Returns:
+        Sorted list of (i, j) index pairs with i < j
+    """
+    if threshold is None:
+        threshold = getattr(settings, 'LEXICAL_DUPLICATE_THRESHOLD', 0.9)
+    if len(texts) < 2:
+        return []
+
+    signatures = minhash_signatures(texts)
+    return sorted(
+        (i, j) for i, j in lsh_candidate_pairs(signatures)
+        if np.mean(signatures[i] == signatures[j]) >= threshold
+    )
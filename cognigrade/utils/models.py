@@ -1,4 +1,5 @@
 from django.db import models
+from django.conf import settings
 
 # Create your models here.
 
@@ -14,3 +15,16 @@ class BaseModel(models.Model):
 
     class Meta:
         abstract = True  # define this table/model is abstract.
+
+
+class EmbeddingCache(BaseModel):
+    """Persisted sentence embedding, addressed by model and normalized text hash"""
+    model_name = models.CharField(max_length=255)
+    model_version = models.CharField(max_length=255)
+    text_hash = models.CharField(max_length=64)
+    # float32 vector, L2 normalized
+    vector = models.BinaryField()
+
+    class Meta:
+        db_table = f'{settings.DB_PREFIX}_embedding_cache'
+        unique_together = ('model_name', 'model_version', 'text_hash')
@@ -0,0 +1,63 @@
+import os
+import ast
+from typing import Tuple
+import numpy as np
+
+# Bytes reserved for the .npy header, so it can be rewritten in place as rows are appended
+HEADER_SIZE = 128
+
+
+def _write_header(f, dtype: np.dtype, shape: Tuple[int, ...]) -> None:
+    header = repr({'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': shape})
+    # Magic (6) + version (2) + header length (2) + header padded with spaces and a newline
+    padded = header.ljust(HEADER_SIZE - 10 - 1) + "\n"
+    f.seek(0)
+    f.write(b"\x93NUMPY\x01\x00" + np.array(len(padded), dtype='<u2').tobytes() + padded.encode("latin1"))
+
+
+def _read_header(path: str) -> dict:
+    with open(path, "rb") as f:
+        f.seek(10)
+        return ast.literal_eval(f.read(HEADER_SIZE - 10).decode("latin1"))
+
+
+def row_count(path: str) -> int:
+    """Rows of an append-only .npy file, 0 when it doesn't exist yet."""
+    if not os.path.exists(path):
+        return 0
+    return _read_header(path)['shape'][0]
+
+
+def file_dtype(path: str) -> np.dtype:
+    return np.dtype(np.lib.format.descr_to_dtype(_read_header(path)['descr']))
+
+
+def append_rows(path: str, rows: np.ndarray) -> None:
+    """
+    Append rows to a .npy file, creating it if needed.
+
+    Rows are converted to the file's dtype, and the row count in the header is
+    updated last, so readers never see a partially written row. Callers
+    serialize writers with a file lock.
+    """
+    rows = np.asarray(rows)
+    if not os.path.exists(path):
+        with open(path, "wb") as f:
+            _write_header(f, rows.dtype, (0,) + rows.shape[1:])
+    header = _read_header(path)
+    dtype = np.dtype(np.lib.format.descr_to_dtype(header['descr']))
+    count, shape = header['shape'][0], tuple(header['shape'][1:])
+    if rows.shape[1:] != shape:
+        raise ValueError(f"Cannot append rows of shape {rows.shape[1:]} to {path} with rows of shape {shape}")
+    with open(path, "r+b") as f:
+        f.seek(HEADER_SIZE + count * dtype.itemsize * int(np.prod(shape, dtype=np.int64)))
+        f.write(np.ascontiguousarray(rows, dtype=dtype).tobytes())
+        f.flush()
+        _write_header(f, dtype, (count + len(rows),) + shape)
+
+
+def open_rows(path: str) -> np.ndarray:
+    """Memory-map an append-only .npy file; an empty array when it doesn't exist or has no rows yet."""
+    if not row_count(path):
+        return np.zeros(0, dtype=np.int64)
+    return np.load(path, mmap_mode='r')
@@ -0,0 +1,58 @@
+from typing import Dict, List, Tuple
+import numpy as np
+from django.conf import settings
+from cognigrade.utils.embeddings import encode
+from cognigrade.utils.evaluation import grade_similarities
+from cognigrade.utils.plagiarism import plagiarism_thresholds
+
+
+def _pair_similarities(pairs: List[Tuple[str, str]], answer_type: str, backend: str) -> np.ndarray:
+    first = encode([a for a, _ in pairs], answer_type, backend)
+    second = encode([b for _, b in pairs], answer_type, backend)
+    return np.einsum('ij,ij->i', first, second)
+
+
+def check_backend_parity(
+    pairs: List[Tuple[str, str]],
+    answer_type: str,
+    backend: str,
+    reference_backend: str = "torch"
+) -> Dict:
+    """
+    Compare a backend's similarity scores with the fp32 reference.
+
+    Every pair is scored by both backends and the report counts the pairs whose
+    grade or plagiarism flag would change.
+
+    Args:
+        pairs: (text, text) pairs to score, e.g. (student answer, answer key)
+        answer_type: Type of answer - 'short', 'long', or 'paraphrased'
+        backend: Backend under test, e.g. 'onnx-int8'
+        reference_backend: Backend the scores are compared against
+
+    Returns:
+        Dictionary with pair count, max/mean absolute similarity difference,
+        grade and plagiarism flag changes, and whether the backend passed
+    """
+    if not pairs:
+        return {'pairs': 0, 'max_abs_diff': 0.0, 'mean_abs_diff': 0.0, 'grade_changes': 0, 'plagiarism_flag_changes': 0, 'passed': True}
+
+    reference = _pair_similarities(pairs, answer_type, reference_backend)
+    candidate = _pair_similarities(pairs, answer_type, backend)
+    diff = np.abs(reference - candidate)
+
+    answer_types = [answer_type] * len(pairs)
+    grade_changes = int(np.sum(grade_similarities(reference, answer_types) != grade_similarities(candidate, answer_types)))
+
+    threshold = plagiarism_thresholds.get(answer_type, 0.85)
+    flag_changes = int(np.sum((np.round(reference, 3) > threshold) != (np.round(candidate, 3) > threshold)))
+
+    tolerance = getattr(settings, 'EMBEDDING_PARITY_TOLERANCE', 0.02)
+    return {
+        'pairs': len(pairs),
+        'max_abs_diff': float(diff.max()),
+        'mean_abs_diff': float(diff.mean()),
+        'grade_changes': grade_changes,
+        'plagiarism_flag_changes': flag_changes,
+        'passed': bool(diff.max() <= tolerance and grade_changes == 0 and flag_changes == 0)
+    }
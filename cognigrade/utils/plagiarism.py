@@ -1,21 +1,15 @@
-from sentence_transformers import SentenceTransformer, util
 import numpy as np
-from typing import List, Tuple, Dict
-import os
+from typing import List, Optional, Tuple, Dict
 import logging
+from django.conf import settings
+from cognigrade.utils.duplicates import canonical_text, exact_duplicate_groups
+from cognigrade.utils.embeddings import MODEL_NAMES, encode, model_tag
+from cognigrade.utils.embedding_store import StoreKey, encode_answers, get_store, text_fingerprint
+from cognigrade.utils.minhash import near_duplicate_pairs
+from cognigrade.utils.similarity import binary_codes, calibrate_radius, iter_binary_prefiltered_pairs, iter_similar_pairs
 
 logger = logging.getLogger(__name__)
 
-# Path to store the models locally
-LOCAL_MODEL_DIR = os.path.join(os.path.dirname(__file__), "models")
-
-# Load different models for different answer types
-models = {
-    "short": SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2", cache_folder=LOCAL_MODEL_DIR),
-    "long": SentenceTransformer("sentence-transformers/all-mpnet-base-v2", cache_folder=LOCAL_MODEL_DIR),
-    "paraphrased": SentenceTransformer("sentence-transformers/paraphrase-mpnet-base-v2", cache_folder=LOCAL_MODEL_DIR),
-}
-
 # Different thresholds for different answer types
 plagiarism_thresholds = {
     "short": 0.90,      # Higher threshold for short answers as they can be more similar naturally
@@ -39,20 +33,20 @@ def detect_question_plagiarism(answer1: str, answer2: str, answer_type: str = "s
     if not answer1 or not answer2 or answer1.strip() == '' or answer2.strip() == '':
         return 0.0
     
+    # Identical up to case, punctuation and whitespace
+    if canonical_text(answer1) == canonical_text(answer2):
+        return 1.0
+    
     # Normalize the answer type
-    if answer_type not in models:
+    if answer_type not in MODEL_NAMES:
         answer_type = "short"
     
-    # Select the appropriate model based on answer type
-    model = models[answer_type]
-    
     try:
-        # Calculate embeddings
-        emb1 = model.encode(answer1, convert_to_tensor=True)
-        emb2 = model.encode(answer2, convert_to_tensor=True)
+        # Calculate embeddings, reusing cached ones
+        emb1, emb2 = encode([answer1, answer2], answer_type)
         
-        # Calculate cosine similarity
-        similarity = float(util.cos_sim(emb1, emb2)[0])
+        # Embeddings are normalized, so the dot product is the cosine similarity
+        similarity = float(np.dot(emb1, emb2))
         
         return round(similarity, 3)
     except Exception as e:
@@ -60,16 +54,184 @@ def detect_question_plagiarism(answer1: str, answer2: str, answer_type: str = "s
         return 0.0
 
 
-def detect_question_plagiarism_batch(question_data: List[Dict], answer_type: str = "short") -> List[Tuple[str, str, float]]:
+def _encode_answers(answers: List[str], answer_type: str, store_key: Optional[StoreKey] = None, answer_ids: Optional[List[int]] = None) -> np.ndarray:
+    """
+    Embeddings of answers, from the embedding store when a store key and answer ids are given.
+    """
+    if store_key is None or answer_ids is None:
+        return _encode_distinct(answers, answer_type)
+    return encode_answers(
+        [store_key] * len(answers),
+        answer_ids,
+        answers,
+        answer_type,
+        lambda texts: _encode_distinct(texts, answer_type)
+    )
+
+
+def _answer_codes(embeddings: np.ndarray, answers: List[str], answer_type: str, store_key: Optional[StoreKey] = None, answer_ids: Optional[List[int]] = None) -> np.ndarray:
+    """Sign codes of the answers' embeddings, read from the embedding store where it keeps them"""
+    store = get_store()
+    if store is None or store_key is None or answer_ids is None:
+        return binary_codes(embeddings)
+    found, stored = store.get_codes(store_key, model_tag(answer_type), answer_ids, [text_fingerprint(answer) for answer in answers])
+    if found.all():
+        return stored
+    codes = binary_codes(embeddings)
+    if found.any():
+        codes[found] = stored
+    return codes
+
+
+def _encode_distinct(answers: List[str], answer_type: str) -> np.ndarray:
+    """
+    Encode answers, once per distinct canonical text.
+
+    Only exact duplicates (up to case, punctuation and whitespace) share an
+    embedding; near-verbatim copies are encoded themselves so they keep their
+    own score.
+    """
+    representatives, inverse = exact_duplicate_groups(answers)
+    embeddings = encode([answers[i] for i in representatives], answer_type)
+    return embeddings[inverse]
+
+
+def _copy_groups(answers: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Group exact duplicates and, with LEXICAL_PREFILTER, near-verbatim copies.
+
+    Copies are found with MinHash/LSH among the distinct texts. Each text that
+    leads no group yet takes in every later text paired with it, so copies of
+    copies are not chained into one group.
+
+    Returns:
+        Tuple of (representatives, inverse) as from exact_duplicate_groups
+    """
+    representatives, inverse = exact_duplicate_groups(answers)
+    if not getattr(settings, 'LEXICAL_PREFILTER', True) or len(representatives) < 2:
+        return representatives, inverse
+
+    partners = {}
+    for a, b in near_duplicate_pairs([answers[i] for i in representatives]):
+        partners.setdefault(a, []).append(b)
+    leader = np.arange(len(representatives))
+    for a in range(len(representatives)):
+        if leader[a] != a:
+            continue
+        for b in partners.get(a, []):
+            if leader[b] == b:
+                leader[b] = a
+    leaders, group_of = np.unique(leader, return_inverse=True)
+    return representatives[leaders], group_of[inverse]
+
+
+def _add_stats(stats: Optional[Dict[str, int]], **counts) -> None:
+    if stats is not None:
+        for key, value in counts.items():
+            stats[key] = stats.get(key, 0) + value
+
+
+def _cascade_pairs(
+    answers: List[str],
+    answer_type: str,
+    threshold: float,
+    stats: Optional[Dict[str, int]] = None,
+    store_key: Optional[StoreKey] = None,
+    answer_ids: Optional[List[int]] = None
+) -> List[Tuple[int, int, float]]:
+    """
+    Score pairs with the 'short' model, escalating only uncertain ones.
+
+    Pairs the cheap model scores more than PLAGIARISM_CASCADE_BAND below the
+    threshold are dismissed and pairs more than the band above it are flagged
+    with the cheap score. Only the pairs in between are re-scored with the
+    answer type's own model.
+    """
+    band = getattr(settings, 'PLAGIARISM_CASCADE_BAND', 0.1)
+    cheap = _encode_answers(answers, "short", store_key, answer_ids)
+
+    pairs = []
+    escalated_rows, escalated_cols = [], []
+    for rows, cols, similarities in iter_similar_pairs(cheap, threshold - band):
+        sure = similarities > threshold + band
+        pairs.extend(zip(rows[sure].tolist(), cols[sure].tolist(), similarities[sure].tolist()))
+        escalated_rows.append(rows[~sure])
+        escalated_cols.append(cols[~sure])
+    cheap_flagged = len(pairs)
+
+    escalated_rows = np.concatenate(escalated_rows) if escalated_rows else np.zeros(0, dtype=np.int64)
+    escalated_cols = np.concatenate(escalated_cols) if escalated_cols else np.zeros(0, dtype=np.int64)
+
+    flagged = 0
+    if len(escalated_rows):
+        # Encode only the answers that take part in an escalated pair
+        involved, positions = np.unique(np.concatenate([escalated_rows, escalated_cols]), return_inverse=True)
+        expensive = _encode_answers(
+            [answers[i] for i in involved],
+            answer_type,
+            store_key,
+            [answer_ids[i] for i in involved] if answer_ids is not None else None
+        )
+        first, second = expensive[positions[:len(escalated_rows)]], expensive[positions[len(escalated_rows):]]
+        similarities = np.round(np.einsum('ij,ij->i', first, second).astype(np.float64), 3)
+        above = similarities > threshold
+        flagged = int(above.sum())
+        pairs.extend(zip(escalated_rows[above].tolist(), escalated_cols[above].tolist(), similarities[above].tolist()))
+
+    total = len(answers) * (len(answers) - 1) // 2
+    _add_stats(
+        stats,
+        pairs=total,
+        cheap_dismissed=total - cheap_flagged - len(escalated_rows),
+        cheap_flagged=cheap_flagged,
+        escalated=len(escalated_rows),
+        escalated_flagged=flagged
+    )
+    return pairs
+
+
+def detect_question_plagiarism_batch(
+    question_data: List[Dict],
+    answer_type: str = "short",
+    threshold: Optional[float] = None,
+    stats: Optional[Dict[str, int]] = None,
+    store_key: Optional[StoreKey] = None
+) -> List[Tuple[str, str, float]]:
     """
     Detect plagiarism between multiple answers to the same question.
     
+    Identical answers (up to case, punctuation and whitespace) and, with
+    LEXICAL_PREFILTER, near-verbatim copies found with MinHash/LSH are flagged
+    with 1.0. Only one answer of each such group reaches the model and its
+    scores stand for the whole group. Pairs are scored tile by tile, so
+    memory stays within SIMILARITY_TILE_MEMORY however many answers are
+    compared.
+    
+    With PLAGIARISM_CASCADE, long and paraphrased answers are scored with the
+    'short' model first and only pairs near the threshold reach their own model.
+    
+    With BINARY_PREFILTER, questions with at least BINARY_PREFILTER_MIN_ANSWERS
+    answers first compare sign-bit codes of the embeddings by Hamming distance,
+    and only pairs within the radius get an exact cosine. Questions where the
+    calibrated radius would let through more than BINARY_PREFILTER_MAX_CANDIDATES
+    of the pairs are scored exactly.
+    
     Args:
         question_data: List of dictionaries with 'submission_id' and 'answer' keys
         answer_type: Type of answer - 'short', 'long', or 'paraphrased'
+        threshold: Similarity a pair must exceed, defaults to the answer type's threshold
+        stats: Optional dictionary the number of pairs resolved by each stage is added to
+        store_key: (theory_id, question_id) of the answers; with an 'answer_id'
+                   in every dictionary, embeddings are read from and added to
+                   the embedding store
     
     Returns:
-        List of tuples containing (submission_id1, submission_id2, similarity_score)
+        List of tuples containing (submission_id1, submission_id2, similarity_score),
+        without pairs of answers from the same submission
+    
+    Raises:
+        Encoding errors are not caught, so a failed check is never taken for
+        one that found no plagiarism
     """
     # Filter out empty answers
     valid_data = [data for data in question_data if data['answer'] and data['answer'].strip() != '']
@@ -79,38 +241,152 @@ def detect_question_plagiarism_batch(question_data: List[Dict], answer_type: str
     
     submission_ids = [data['submission_id'] for data in valid_data]
     answers = [data['answer'] for data in valid_data]
+    answer_ids = [data.get('answer_id') for data in valid_data]
+    if None in answer_ids:
+        answer_ids = None
     
     # Normalize the answer type
-    if answer_type not in models:
+    if answer_type not in MODEL_NAMES:
         answer_type = "short"
     
-    # Select the appropriate model and threshold
-    model = models[answer_type]
-    threshold = plagiarism_thresholds.get(answer_type, 0.85)
+    # Select the appropriate threshold
+    if threshold is None:
+        threshold = plagiarism_thresholds.get(answer_type, 0.85)
     
-    try:
-        # Calculate embeddings for all answers
-        embeddings = model.encode(answers, convert_to_tensor=True)
-        
-        # Calculate pairwise similarities
-        similarity_matrix = util.cos_sim(embeddings, embeddings).cpu().numpy()
-        
-        # Find pairs above threshold
-        plagiarism_pairs = []
-        for i in range(len(answers)):
-            for j in range(i + 1, len(answers)):
-                similarity = float(similarity_matrix[i][j])
-                if similarity > threshold:
-                    plagiarism_pairs.append((
-                        submission_ids[i], 
-                        submission_ids[j], 
-                        round(similarity, 3)
-                    ))
-        
-        return plagiarism_pairs
-    except Exception as e:
-        logger.error(f"Error in batch plagiarism detection: {str(e)}")
+    # Copies are flagged with 1.0 and only one answer of each group is scored
+    representatives, inverse = _copy_groups(answers)
+    members = [[] for _ in representatives]
+    for index, group in enumerate(inverse.tolist()):
+        members[group].append(index)
+    found = [(i, j, 1.0) for group in members for a, i in enumerate(group) for j in group[a + 1:]] if threshold < 1.0 else []
+    
+    texts = [answers[i] for i in representatives]
+    if answer_ids is not None:
+        answer_ids = [answer_ids[i] for i in representatives]
+    total = len(answers) * (len(answers) - 1) // 2
+    scored = len(texts) * (len(texts) - 1) // 2
+    _add_stats(stats, pairs=total - scored)
+    if found:
+        _add_stats(stats, copies=len(found))
+    
+    if len(texts) < 2:
+        representative_pairs = []
+    elif getattr(settings, 'PLAGIARISM_CASCADE', False) and answer_type != "short":
+        representative_pairs = _cascade_pairs(texts, answer_type, threshold, stats, store_key, answer_ids)
+    else:
+        representative_pairs = _score_pairs(texts, answer_type, threshold, stats, store_key, answer_ids)
+    
+    # Every answer of a group takes its representative's score
+    for a, b, similarity in representative_pairs:
+        found.extend((min(i, j), max(i, j), similarity) for i in members[a] for j in members[b])
+    return [
+        (submission_ids[i], submission_ids[j], similarity)
+        for i, j, similarity in sorted(found)
+        if submission_ids[i] != submission_ids[j]
+    ]
+
+
+def _score_pairs(
+    answers: List[str],
+    answer_type: str,
+    threshold: float,
+    stats: Optional[Dict[str, int]] = None,
+    store_key: Optional[StoreKey] = None,
+    answer_ids: Optional[List[int]] = None
+) -> List[Tuple[int, int, float]]:
+    """Score every pair with the answer type's model, through the binary prefilter when it applies"""
+    embeddings = _encode_answers(answers, answer_type, store_key, answer_ids)
+    
+    total = len(answers) * (len(answers) - 1) // 2
+    binary_prefilter = (
+        getattr(settings, 'BINARY_PREFILTER', False)
+        and len(answers) >= getattr(settings, 'BINARY_PREFILTER_MIN_ANSWERS', 256)
+    )
+    if binary_prefilter:
+        codes = _answer_codes(embeddings, answers, answer_type, store_key, answer_ids)
+        radius, candidate_share = calibrate_radius(embeddings, codes, threshold)
+        binary_prefilter = candidate_share <= getattr(settings, 'BINARY_PREFILTER_MAX_CANDIDATES', 0.05)
+    
+    # Calculate pairwise similarities and keep the pairs above threshold
+    if binary_prefilter:
+        counts = {'candidates': 0}
+        tiles = iter_binary_prefiltered_pairs(embeddings, threshold, counts=counts, codes=codes, radius=radius)
+    else:
+        tiles = iter_similar_pairs(embeddings, threshold)
+    found = []
+    for rows, cols, similarities in tiles:
+        found.extend(zip(rows.tolist(), cols.tolist(), similarities.tolist()))
+    
+    if binary_prefilter:
+        scored = counts['candidates']
+        _add_stats(stats, pairs=total, binary_dismissed=total - scored, escalated=scored, escalated_flagged=len(found))
+    else:
+        _add_stats(stats, pairs=total, escalated=total, escalated_flagged=len(found))
+    return found
+
+
+def detect_answer_plagiarism(
+    answer: str,
+    other_data: List[Dict],
+    answer_type: str = "short",
+    threshold: Optional[float] = None,
+    store_key: Optional[StoreKey] = None,
+    answer_id: Optional[int] = None
+) -> List[Tuple[str, float]]:
+    """
+    Compare one answer against other answers to the same question.
+    
+    The other answers' embeddings normally come straight from the embedding
+    store or cache, so only the new answer reaches the model and scoring is
+    a single matrix-vector product.
+    
+    Args:
+        answer: The answer to check
+        other_data: List of dictionaries with 'submission_id' and 'answer' keys
+        answer_type: Type of answer - 'short', 'long', or 'paraphrased'
+        threshold: Similarity a pair must exceed, defaults to the answer type's threshold
+        store_key: (theory_id, question_id) of the answers; with answer_id and an
+                   'answer_id' in every dictionary, embeddings go through the embedding store
+        answer_id: Id of the answer to check
+    
+    Returns:
+        List of tuples containing (submission_id, similarity_score)
+    
+    Raises:
+        Encoding errors are not caught, as in detect_question_plagiarism_batch
+    """
+    if not answer or answer.strip() == '':
         return []
+    other_data = [data for data in other_data if data['answer'] and data['answer'].strip() != '']
+    if not other_data:
+        return []
+    
+    # Normalize the answer type
+    if answer_type not in MODEL_NAMES:
+        answer_type = "short"
+    
+    # Select the appropriate threshold
+    if threshold is None:
+        threshold = plagiarism_thresholds.get(answer_type, 0.85)
+    
+    other_ids = [data.get('answer_id') for data in other_data]
+    if answer_id is None or None in other_ids:
+        store_key = None
+    query = _encode_answers([answer], answer_type, store_key, [answer_id])[0]
+    others = _encode_answers([data['answer'] for data in other_data], answer_type, store_key, other_ids)
+    similarities = np.round((others @ query).astype(np.float64), 3)
+    
+    # Identical up to case, punctuation and whitespace
+    canonical = canonical_text(answer)
+    for index, data in enumerate(other_data):
+        if canonical_text(data['answer']) == canonical:
+            similarities[index] = 1.0
+    
+    return [
+        (data['submission_id'], float(similarity))
+        for data, similarity in zip(other_data, similarities)
+        if similarity > threshold
+    ]
 
 
 def compute_embeddings_bulk(texts: List[str], answer_type: str = "short"):
@@ -122,7 +398,7 @@ def compute_embeddings_bulk(texts: List[str], answer_type: str = "short"):
         answer_type: Type of answer - 'short', 'long', or 'paraphrased'
     
     Returns:
-        Tensor of embeddings
+        Array of normalized embeddings, one row per non-empty text
     """
     # Skip empty texts
     valid_texts = [text for text in texts if text and text.strip() != '']
@@ -131,14 +407,11 @@ def compute_embeddings_bulk(texts: List[str], answer_type: str = "short"):
         return None
     
     # Normalize the answer type
-    if answer_type not in models:
+    if answer_type not in MODEL_NAMES:
         answer_type = "short"
     
-    # Select the appropriate model
-    model = models[answer_type]
-    
     try:
-        return model.encode(valid_texts, convert_to_tensor=True)
+        return encode(valid_texts, answer_type)
     except Exception as e:
         logger.error(f"Error computing embeddings: {str(e)}")
         return None
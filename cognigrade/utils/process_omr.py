@@ -2,8 +2,19 @@ import cv2
 import numpy as np
 from pyzbar import pyzbar
 import os
+import zipfile
+import multiprocessing
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
 from django.conf import settings
-import random
+import uuid
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Extensions read from ZIP archives of scanned sheets
+SHEET_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
 
 def order_points(pts):
     rect = np.zeros((4, 2), dtype="float32")
@@ -15,31 +26,38 @@ def order_points(pts):
     rect[3] = pts[np.argmax(diff)]
     return rect
 
-def correct_perspective(image):
-    orig = image.copy()
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+def find_sheet_corners(gray):
+    """Corners of the largest quadrilateral outline in a grayscale image, or None"""
     blur = cv2.GaussianBlur(gray, (5, 5), 1)
     edged = cv2.Canny(blur, 10, 70)
-    contours, _ = cv2.findContours(edged.copy(), cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+    contours, _ = cv2.findContours(edged, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
     contours = sorted(contours, key=cv2.contourArea, reverse=True)[:5]
     for c in contours:
         peri = cv2.arcLength(c, True)
         approx = cv2.approxPolyDP(c, 0.02 * peri, True)
         if len(approx) == 4:
-            screen_cnt = approx
-            break
-    else:
-        return orig  
+            return approx.reshape(4, 2).astype("float32")
+    return None
+
+def sheet_extent(rect):
+    """(width, height) correct_perspective warps a sheet with these ordered corners to"""
+    (tl, tr, br, bl) = rect
+    widthA = np.sqrt(((br[0] - bl[0]) ** 2) + ((br[1] - bl[1]) ** 2))
+    widthB = np.sqrt(((tr[0] - tl[0]) ** 2) + ((tr[1] - tl[1]) ** 2))
+    heightA = np.sqrt(((tr[0] - br[0]) ** 2) + ((tr[1] - br[1]) ** 2))
+    heightB = np.sqrt(((tl[0] - bl[0]) ** 2) + ((tl[1] - bl[1]) ** 2))
+    return max(int(widthA), int(widthB)), max(int(heightA), int(heightB))
+
+def correct_perspective(image):
+    orig = image.copy()
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    corners = find_sheet_corners(gray)
+    if corners is None:
+        return orig
     warped = None
     try:
-        rect = order_points(screen_cnt.reshape(4, 2))
-        (tl, tr, br, bl) = rect
-        widthA = np.sqrt(((br[0] - bl[0]) ** 2) + ((br[1] - bl[1]) ** 2))
-        widthB = np.sqrt(((tr[0] - tl[0]) ** 2) + ((tr[1] - tl[1]) ** 2))
-        maxWidth = max(int(widthA), int(widthB))
-        heightA = np.sqrt(((tr[0] - br[0]) ** 2) + ((tr[1] - br[1]) ** 2))
-        heightB = np.sqrt(((tl[0] - bl[0]) ** 2) + ((tl[1] - bl[1]) ** 2))
-        maxHeight = max(int(heightA), int(heightB))
+        rect = order_points(corners)
+        maxWidth, maxHeight = sheet_extent(rect)
         dst = np.array([
             [0, 0],
             [maxWidth - 1, 0],
@@ -51,6 +69,51 @@ def correct_perspective(image):
         return orig
     return warped
 
+def sheet_size():
+    """Canonical (width, height) sheets are warped to in pyramid mode"""
+    return (getattr(settings, 'OMR_SHEET_WIDTH', 827), getattr(settings, 'OMR_SHEET_HEIGHT', 1169))
+
+def correct_perspective_pyramid(image, reduced=None, size=None):
+    """
+    Find the sheet on a downscaled grayscale copy and warp the full-resolution
+    image straight to the canonical sheet size.
+
+    Edge and contour detection only need the sheet outline, so they run on a
+    sixteenth of the pixels; only the warp samples the full image. The result
+    always has the canonical size, so the bubble grid is in known coordinates.
+
+    Args:
+        image: Full-resolution BGR image
+        reduced: Grayscale copy at a fraction of the resolution, e.g. decoded
+                 with cv2.IMREAD_REDUCED_GRAYSCALE_4; made from image when omitted
+        size: (width, height) to warp to, defaults to OMR_SHEET_WIDTH x OMR_SHEET_HEIGHT
+
+    Returns:
+        Tuple of (warped, scale): scale is the (y, x) factor from the size
+        correct_perspective would have warped the sheet to, to the canonical size
+    """
+    width, height = size or sheet_size()
+    if reduced is None:
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        reduced = cv2.resize(gray, (max(1, gray.shape[1] // 4), max(1, gray.shape[0] // 4)), interpolation=cv2.INTER_AREA)
+
+    corners = find_sheet_corners(reduced)
+    if corners is None:
+        scale = (height / image.shape[0], width / image.shape[1])
+        return cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA), scale
+
+    corners *= np.array([image.shape[1] / reduced.shape[1], image.shape[0] / reduced.shape[0]], dtype="float32")
+    rect = order_points(corners)
+    native_width, native_height = sheet_extent(rect)
+    dst = np.array([
+        [0, 0],
+        [width - 1, 0],
+        [width - 1, height - 1],
+        [0, height - 1]], dtype="float32")
+    M = cv2.getPerspectiveTransform(rect, dst)
+    scale = (height / max(native_height, 1), width / max(native_width, 1))
+    return cv2.warpPerspective(image, M, (width, height)), scale
+
 def preprocess_image(image):
     gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
     thresh = cv2.threshold(gray, 120, 255, cv2.THRESH_BINARY_INV)[1]
@@ -60,56 +123,153 @@ def decode_qr_code(image):
     qr_codes = pyzbar.decode(image)
     return qr_codes[0].data.decode("utf-8") if qr_codes else None
 
-def detect_bubbles(processed_img, original_img, num_questions=30, options=4, columns=3, rows=10):
-    height, width = processed_img.shape[:2]
+def locate_qr_code(corrected, original):
+    """
+    Decode the student's QR code, looking where the sheet template prints it first.
+
+    The OMR_QR_REGION of the warped sheet (fractions of its width and height)
+    is cropped, converted to grayscale and shrunk so its longer side is at most
+    OMR_QR_MAX_SIDE pixels. Only when no code is found there is the whole
+    original photo searched.
+
+    Returns:
+        Tuple of (data, path): path is 'region' or 'full' for the search that
+        found the code, data and path are None when neither did
+    """
+    x0, y0, x1, y1 = getattr(settings, 'OMR_QR_REGION', (0.7, 0.0, 1.0, 0.3))
+    height, width = corrected.shape[:2]
+    region = corrected[int(y0 * height):int(y1 * height), int(x0 * width):int(x1 * width)]
+    if region.size:
+        if region.ndim == 3:
+            region = cv2.cvtColor(region, cv2.COLOR_BGR2GRAY)
+        scale = getattr(settings, 'OMR_QR_MAX_SIDE', 400) / max(region.shape)
+        if scale < 1:
+            region = cv2.resize(region, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        student_info = decode_qr_code(region)
+        if student_info:
+            return student_info, 'region'
+
+    student_info = decode_qr_code(original)
+    if student_info:
+        return student_info, 'full'
+    return None, None
+
+@lru_cache(maxsize=32)
+def bubble_grid(height, width, options=4, columns=3, rows=10, padding=7):
+    """
+    Pixel bounds of every bubble on a sheet of the given size.
+
+    Questions run down each column, then across columns; each question's
+    cell holds a label and one slot per option, with padding trimmed from
+    every side of a slot: padding is a number of pixels, or a (y, x) pair.
+
+    Returns:
+        Tuple of (y0, y1, x0, x1) int arrays of shape (columns * rows, options),
+        already clipped to the sheet
+    """
     cell_width = width // columns
     cell_height = height // rows
-    student_answers = []
-    for col in range(columns):
-        for row in range(rows):
-            x_start = col * cell_width
-            y_start = row * cell_height
-            option_width = cell_width // (options + 1)
-            candidates = []
-            padding = 7
-            for option in range(1, options + 1):
-                ox_start = x_start + (option * option_width)
-                ox_end = ox_start + option_width
-                option_roi = processed_img[y_start+padding:y_start+cell_height-padding, ox_start+padding:ox_end-padding]
-                filled_pixels = cv2.countNonZero(option_roi)
-                total_pixels = option_roi.size
-                if total_pixels == 0:
-                    continue
-                filled_ratio = filled_pixels / total_pixels
-                if filled_ratio > 0.2:
-                    candidates.append((filled_ratio, option))
-            selected_answer = '?'
-            if len(candidates) == 1:
-                selected_answer = chr(64 + candidates[0][1]) 
-            elif len(candidates) > 1:
-                selected_answer = 'X'  
-            student_answers.append(selected_answer)
-    return student_answers
+    option_width = cell_width // (options + 1)
+    cells = np.arange(columns * rows)
+    column, row = np.divmod(cells, rows)
+    option = np.arange(1, options + 1)
+    padding_y, padding_x = padding if isinstance(padding, tuple) else (padding, padding)
+
+    y0 = np.repeat((row * cell_height + padding_y)[:, None], options, axis=1)
+    y1 = y0 + cell_height - 2 * padding_y
+    x0 = (column * cell_width)[:, None] + option * option_width + padding_x
+    x1 = x0 + option_width - 2 * padding_x
+
+    bounds = []
+    for start, end, limit in ((y0, y1, height), (x0, x1, width)):
+        start = np.clip(start, 0, limit)
+        bounds.extend((start, np.clip(end, start, limit)))
+    for array in bounds:
+        array.flags.writeable = False
+    return tuple(bounds)
+
+
+def detect_bubbles(processed_img, original_img, num_questions=30, options=4, columns=3, rows=10, padding=7):
+    height, width = processed_img.shape[:2]
+    y0, y1, x0, x1 = bubble_grid(height, width, options, columns, rows, padding)
+    # Filled pixels of every bubble from four lookups in an integral image
+    binary = cv2.threshold(processed_img, 0, 1, cv2.THRESH_BINARY)[1]
+    integral = cv2.integral(binary, sdepth=cv2.CV_32S)
+    filled = integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+    area = (y1 - y0) * (x1 - x0)
+    filled_ratio = np.divide(filled, area, out=np.zeros(area.shape), where=area > 0)
+    candidates = filled_ratio > 0.2
+
+    counts = candidates.sum(axis=1)
+    letters = np.array([chr(65 + option) for option in range(options)])
+    student_answers = np.where(counts > 1, 'X', '?').astype(object)
+    single = counts == 1
+    student_answers[single] = letters[candidates[single].argmax(axis=1)]
+    return student_answers.tolist()
 
 def grade_answers(student_answers, correct_answers):
     return sum(1 for s, c in zip(student_answers, correct_answers) if s == c)
 
-def process_omr(image_path, correct_answers):
+def load_image(source, flags=cv2.IMREAD_COLOR):
+    """
+    Decode a sheet from a file path, or from the encoded bytes of an upload
+    without copying them (any buffer: bytes, memoryview, numpy array).
+    """
+    if isinstance(source, (str, os.PathLike)):
+        return cv2.imread(os.fspath(source), flags)
+    return cv2.imdecode(np.frombuffer(source, dtype=np.uint8), flags)
+
+def load_sheet(source):
+    """
+    Decode a sheet, and in pyramid mode (OMR_PYRAMID) also a quarter-size
+    grayscale copy to find its outline on. JPEG decoders produce the reduced
+    copy directly from the DCT coefficients, which is much cheaper than
+    shrinking the full image.
+
+    Returns:
+        Tuple of (image, reduced), reduced being None outside pyramid mode
+    """
+    original = load_image(source)
+    if original is None or not getattr(settings, 'OMR_PYRAMID', False):
+        return original, None
+    return original, load_image(source, cv2.IMREAD_REDUCED_GRAYSCALE_4)
+
+def upload_buffer(upload):
+    """Contents of an uploaded file, as a view of the in-memory upload when Django kept it in memory"""
+    getbuffer = getattr(upload.file, 'getbuffer', None)
+    if getbuffer is not None:
+        return getbuffer()
+    upload.seek(0)
+    return upload.read()
+
+# Single background thread writing debug artifacts, so requests don't wait on disk
+_artifact_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='omr-artifacts')
+
+def _write_artifact(path, image):
     try:
-        original = cv2.imread(image_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not cv2.imwrite(path, image):
+            logger.warning(f"Could not write OMR debug artifact {path}")
+    except Exception as e:
+        logger.warning(f"Error writing OMR debug artifact {path}: {str(e)}")
+
+def save_debug_artifact(image):
+    """Queue the thresholded sheet for MEDIA_ROOT/scanned-omr when OMR_DEBUG_ARTIFACTS is on"""
+    if not getattr(settings, 'OMR_DEBUG_ARTIFACTS', False):
+        return None
+    path = os.path.join(settings.MEDIA_ROOT, 'scanned-omr', f"{uuid.uuid4().hex}.jpg")
+    return _artifact_writer.submit(_write_artifact, path, image)
+
+def process_omr(image, correct_answers):
+    try:
+        original, reduced = load_sheet(image)
         if original is None:
             raise FileNotFoundError("Image not found")
-        corrected = correct_perspective(original)
-        processed = preprocess_image(corrected)
-        image_path = os.path.join(settings.MEDIA_ROOT, 'scanned-omr', f"{random.randint(1, 100000000)}.jpg")
-        cv2.imwrite(image_path, processed)
-        print(image_path)
-        student_info = decode_qr_code(original)
+        result = grade_sheet(original, correct_answers, reduced)
+        student_info, score, answers = result['student_info'], result['score'], result['answers']
         if not student_info:
             print("QR code not detected")
             # return
-        answers = detect_bubbles(processed, corrected, num_questions=len(correct_answers))
-        score = grade_answers(answers, correct_answers)
         print("\n" + "="*40)
         print(f" Student ID: {student_info}")
         print(f" Total Questions: {len(correct_answers)}")
@@ -123,6 +283,145 @@ def process_omr(image_path, correct_answers):
         print(f"Error: {str(e)}")
         return (0, [])
     
+def grade_sheet(original, correct_answers, reduced=None):
+    """
+    Run the OMR pipeline on a decoded sheet.
+
+    Unlike process_omr, errors are raised rather than printed. In pyramid mode
+    (OMR_PYRAMID) the sheet is found on reduced, or on a copy shrunk from
+    original, and warped to the canonical sheet size; the bubble padding is
+    scaled with it, so bubbles are trimmed by the same share of the sheet as
+    on the sheet correct_perspective produces.
+
+    Returns:
+        Dictionary with 'student_info', 'qr_path' (see locate_qr_code),
+        'score' and 'answers'
+    """
+    padding = 7
+    if getattr(settings, 'OMR_PYRAMID', False):
+        corrected, scale = correct_perspective_pyramid(original, reduced)
+        padding = tuple(int(round(padding * factor)) for factor in scale)
+    else:
+        corrected = correct_perspective(original)
+    processed = preprocess_image(corrected)
+    save_debug_artifact(processed)
+    student_info, qr_path = locate_qr_code(corrected, original)
+    answers = detect_bubbles(processed, corrected, num_questions=len(correct_answers), padding=padding)
+    return {
+        'student_info': student_info,
+        'qr_path': qr_path,
+        'score': grade_answers(answers, correct_answers),
+        'answers': answers
+    }
+
+
+def process_sheet(name: str, data: bytes, correct_answers: List[str]) -> Dict:
+    """
+    Decode and grade one scanned sheet, reporting a failure instead of raising it.
+
+    Returns:
+        Dictionary with 'name' and the keys of grade_sheet, or 'name' and
+        'error' when the sheet could not be graded
+    """
+    try:
+        original, reduced = load_sheet(data)
+        if original is None:
+            raise ValueError("Could not decode image")
+        return {'name': name, **grade_sheet(original, correct_answers, reduced)}
+    except Exception as e:
+        return {'name': name, 'error': str(e)}
+
+
+def read_sheets(uploads: Iterable) -> List[Tuple[str, bytes]]:
+    """
+    Read scanned sheets from uploaded images and ZIP archives of images.
+
+    Archives are checked from their directory before any entry is read: the
+    number of entries and their declared sizes must fit in what is left of
+    the limits, and zipfile refuses to expand an entry beyond its declared size.
+
+    Raises:
+        ValueError: When there are more than OMR_BATCH_MAX_SHEETS sheets or
+                    an archive expands beyond OMR_BATCH_MAX_BYTES
+    """
+    max_sheets = getattr(settings, 'OMR_BATCH_MAX_SHEETS', 1000)
+    max_bytes = getattr(settings, 'OMR_BATCH_MAX_BYTES', 1024 * 1024 * 1024)
+    sheets = []
+    total = 0
+    for upload in uploads:
+        if zipfile.is_zipfile(upload):
+            upload.seek(0)
+            with zipfile.ZipFile(upload) as archive:
+                entries = archive.infolist()
+                # Directories and other files are skipped, but still bound the work per archive
+                if len(entries) > 2 * max_sheets:
+                    raise ValueError(f"{upload.name} holds {len(entries)} entries, at most {2 * max_sheets} are accepted")
+                members = [
+                    member for member in entries
+                    if not member.is_dir() and member.filename.lower().endswith(SHEET_EXTENSIONS)
+                ]
+                if len(sheets) + len(members) > max_sheets:
+                    raise ValueError(f"At most {max_sheets} sheets can be processed at once")
+                total += sum(member.file_size for member in members)
+                if total > max_bytes:
+                    raise ValueError(f"Sheets exceed {max_bytes} bytes")
+                for member in sorted(members, key=lambda member: member.filename):
+                    sheets.append((f"{upload.name}/{member.filename}", archive.read(member)))
+        else:
+            upload.seek(0)
+            data = upload.read()
+            total += len(data)
+            if total > max_bytes:
+                raise ValueError(f"Sheets exceed {max_bytes} bytes")
+            sheets.append((upload.name, data))
+        if len(sheets) > max_sheets:
+            raise ValueError(f"At most {max_sheets} sheets can be processed at once")
+    return sheets
+
+
+def _init_worker():
+    # Every worker has a core of its own, so OpenCV's thread pool would only oversubscribe
+    cv2.setNumThreads(1)
+
+
+def process_omr_batch(sheets: List[Tuple[str, bytes]], correct_answers: List[str], workers: Optional[int] = None) -> List[Dict]:
+    """
+    Grade many scanned sheets in parallel over a process pool.
+
+    The pool has one process per core (OMR_WORKERS overrides it) and lives for
+    the batch only. Processes are spawned rather than forked so they do not
+    inherit the web worker's threads and locks. A sheet that fails, or a
+    worker that dies, only marks the sheets it was handling as failed.
+
+    Args:
+        sheets: List of (name, encoded image bytes)
+        correct_answers: Answer key letters
+        workers: Number of processes, defaults to OMR_WORKERS or the number of cores
+
+    Returns:
+        One result per sheet in input order, as returned by process_sheet
+    """
+    if workers is None:
+        workers = getattr(settings, 'OMR_WORKERS', 0) or os.cpu_count() or 1
+    workers = min(workers, len(sheets))
+    if workers <= 1:
+        return [process_sheet(name, data, correct_answers) for name, data in sheets]
+
+    results = []
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_worker
+    ) as executor:
+        futures = [executor.submit(process_sheet, name, data, correct_answers) for name, data in sheets]
+        for (name, _), future in zip(sheets, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append({'name': name, 'error': str(e)})
+    return results
+
+
 if __name__ == "__main__":
     CORRECT_ANSWERS = [
         'B', 'A', 'D', 'D', 'D', 'D', 'C', 'A', 'A', 'B',
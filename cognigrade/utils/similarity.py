@@ -0,0 +1,249 @@
+import math
+from typing import Dict, Iterator, Optional, Tuple
+import numpy as np
+from django.conf import settings
+
+# Bytes held per similarity cell while a tile is processed. At peak the
+# float32 product (4) and the float64 copy it is rounded in place in (8)
+# coexist; the boolean mask and np.triu's temporaries (3) only come after the
+# product is freed. The rest is headroom for the indexes of pairs found.
+# Hamming tiles need less: uint16 distances, a uint64 XOR and its popcount.
+# Each tile's arrays are released before the next one is allocated.
+BYTES_PER_CELL = 14
+
+# Bytes held per candidate pair while the binary prefilter rescores a chunk:
+# both float32 embeddings per dimension, plus the pair's indexes and score
+BYTES_PER_PAIR_DIMENSION = 8
+BYTES_PER_PAIR = 32
+
+
+def similar_pairs(similarity_matrix: np.ndarray, threshold: float, decimals: int = 3) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Extract pairs above a threshold from the upper triangle of a similarity matrix.
+
+    Similarities are rounded before comparison, matching detect_question_plagiarism.
+
+    Args:
+        similarity_matrix: Square matrix of pairwise similarities
+        threshold: Pairs must be strictly above this similarity
+        decimals: Rounding applied to similarities
+
+    Returns:
+        Tuple of (row indexes, column indexes, similarities) with row < column
+    """
+    rounded = np.round(np.asarray(similarity_matrix, dtype=np.float64), decimals)
+    rows, cols = np.nonzero(np.triu(rounded > threshold, k=1))
+    return rows, cols, rounded[rows, cols]
+
+
+def tile_size(memory_budget: Optional[int] = None) -> int:
+    """Side of the square similarity tile that fits in the memory budget (bytes)."""
+    if memory_budget is None:
+        memory_budget = getattr(settings, 'SIMILARITY_TILE_MEMORY', 64 * 1024 * 1024)
+    return max(1, int(math.sqrt(memory_budget / BYTES_PER_CELL)))
+
+
+def iter_similar_pairs(
+    embeddings: np.ndarray,
+    threshold: float,
+    others: Optional[np.ndarray] = None,
+    memory_budget: Optional[int] = None,
+    decimals: int = 3
+) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Stream pairs above a threshold, one similarity tile at a time.
+
+    Only one tile of the similarity matrix exists at any time, so peak memory
+    is bounded by the budget regardless of how many embeddings are compared.
+
+    Args:
+        embeddings: Normalized embeddings, one per row
+        threshold: Pairs must be strictly above this (rounded) similarity
+        others: Embeddings to compare against; when omitted, embeddings are
+                compared with each other and only pairs with row < column are returned
+        memory_budget: Bytes available for one tile, defaults to SIMILARITY_TILE_MEMORY
+        decimals: Rounding applied to similarities
+
+    Yields:
+        Tuples of (row indexes, column indexes, similarities) for each tile
+        with at least one pair, using indexes into the full inputs
+    """
+    symmetric = others is None
+    if symmetric:
+        others = embeddings
+
+    size = tile_size(memory_budget)
+    for row_start in range(0, len(embeddings), size):
+        row_block = embeddings[row_start:row_start + size]
+        # For self-comparison, tiles below the diagonal only repeat pairs
+        col_first = row_start if symmetric else 0
+        for col_start in range(col_first, len(others), size):
+            rounded = (row_block @ others[col_start:col_start + size].T).astype(np.float64)
+            np.round(rounded, decimals, out=rounded)
+            mask = rounded > threshold
+            if symmetric and col_start == row_start:
+                mask = np.triu(mask, k=1)
+            rows, cols = np.nonzero(mask)
+            similarities = rounded[rows, cols]
+            del rounded, mask
+            if len(rows):
+                yield rows + row_start, cols + col_start, similarities
+
+
+def binary_codes(embeddings: np.ndarray) -> np.ndarray:
+    """
+    Sign bit of every embedding dimension, packed into uint64 words.
+
+    A 384-dimension float32 embedding (1536 bytes) becomes 6 words (48 bytes).
+
+    Returns:
+        uint64 array of shape (len(embeddings), ceil(dims / 64))
+    """
+    bits = np.packbits(np.asarray(embeddings) > 0, axis=1)
+    padding = (-bits.shape[1]) % 8
+    if padding:
+        bits = np.pad(bits, ((0, 0), (0, padding)))
+    return np.ascontiguousarray(bits).view(np.uint64)
+
+
+def hamming_radius(threshold: float, dims: int, margin: Optional[float] = None) -> int:
+    """
+    Largest Hamming distance between sign codes of a pair that may still exceed threshold.
+
+    For random hyperplanes the fraction of differing sign bits estimates the
+    angle between two vectors divided by pi. Embedding axes are not random, so
+    the margin (a fraction of dims, BINARY_PREFILTER_MARGIN, calibrated from
+    the embeddings themselves when unset) corrects the radius.
+    """
+    if margin is None:
+        margin = getattr(settings, 'BINARY_PREFILTER_MARGIN', None)
+    if margin is None:
+        margin = 0.1
+    angle = math.acos(min(1.0, max(-1.0, threshold))) / math.pi
+    return max(0, min(dims, int(math.ceil(dims * (angle + margin)))))
+
+
+def calibrate_radius(
+    embeddings: np.ndarray,
+    codes: np.ndarray,
+    threshold: float,
+    sample_size: Optional[int] = None,
+    seed: int = 0
+) -> Tuple[int, float]:
+    """
+    Hamming radius for these embeddings, and the share of pairs it lets through.
+
+    On a random sample of pairs the fraction of differing sign bits is
+    compared with the angle it estimates; the largest overshoot is the margin,
+    unless BINARY_PREFILTER_MARGIN fixes one. Embeddings of real answers share
+    most of their signs, so the margin is usually negative and the radius
+    much tighter than for random vectors.
+
+    Returns:
+        Tuple of (radius, share of the sampled pairs within it)
+    """
+    if sample_size is None:
+        sample_size = getattr(settings, 'BINARY_PREFILTER_SAMPLE', 4096)
+    dims = embeddings.shape[1]
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, len(embeddings), sample_size)
+    cols = rng.integers(0, len(embeddings), sample_size)
+    distinct = rows != cols
+    rows, cols = rows[distinct], cols[distinct]
+    if not len(rows):
+        return dims, 1.0
+
+    distances = np.bitwise_count(codes[rows] ^ codes[cols]).sum(axis=1)
+    margin = getattr(settings, 'BINARY_PREFILTER_MARGIN', None)
+    if margin is None:
+        similarities = np.einsum('ij,ij->i', np.asarray(embeddings[rows], dtype=np.float32), np.asarray(embeddings[cols], dtype=np.float32))
+        angles = np.arccos(np.clip(similarities, -1.0, 1.0)) / math.pi
+        margin = float(np.max(distances / dims - angles)) + 1 / dims
+    radius = hamming_radius(threshold, dims, margin)
+    return radius, float(np.mean(distances <= radius))
+
+
+def iter_hamming_pairs(codes: np.ndarray, max_distance: int, memory_budget: Optional[int] = None) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Stream pairs of codes within a Hamming distance, one tile at a time.
+
+    Distances are accumulated word by word with a vectorized popcount, so a
+    tile needs about as much memory as a similarity tile.
+
+    Yields:
+        Tuples of (row indexes, column indexes) with row < column
+    """
+    size = tile_size(memory_budget)
+    for row_start in range(0, len(codes), size):
+        row_block = codes[row_start:row_start + size]
+        for col_start in range(row_start, len(codes), size):
+            col_block = codes[col_start:col_start + size]
+            distances = np.zeros((len(row_block), len(col_block)), dtype=np.uint16)
+            for word in range(codes.shape[1]):
+                distances += np.bitwise_count(row_block[:, word, None] ^ col_block[None, :, word])
+            mask = distances <= max_distance
+            if col_start == row_start:
+                mask = np.triu(mask, k=1)
+            rows, cols = np.nonzero(mask)
+            del distances, mask
+            if len(rows):
+                yield rows + row_start, cols + col_start
+
+
+def iter_binary_prefiltered_pairs(
+    embeddings: np.ndarray,
+    threshold: float,
+    memory_budget: Optional[int] = None,
+    decimals: int = 3,
+    counts: Optional[Dict[str, int]] = None,
+    codes: Optional[np.ndarray] = None,
+    radius: Optional[int] = None
+) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Like iter_similar_pairs, but only pairs whose sign codes are close get an exact cosine.
+
+    Candidates are rescored in chunks that fit the memory budget, so a tile
+    where most pairs pass the Hamming radius never gathers all their
+    embeddings at once. Tiles and pairs come in the same order as from
+    iter_similar_pairs. The number of pairs rescored is added to
+    counts['candidates'] when given.
+
+    Args:
+        codes: Sign codes of the embeddings (see binary_codes), e.g. read from
+               the embedding store; computed when omitted
+        radius: Hamming radius, calibrated on the embeddings when omitted
+
+    Yields:
+        Tuples of (row indexes, column indexes, similarities) for each tile
+        with at least one pair above threshold
+    """
+    if codes is None:
+        codes = binary_codes(embeddings)
+    if radius is None:
+        radius = calibrate_radius(embeddings, codes, threshold)[0]
+    if memory_budget is None:
+        memory_budget = getattr(settings, 'SIMILARITY_TILE_MEMORY', 64 * 1024 * 1024)
+    # A third of the budget for Hamming tiles, whose candidate indexes (16
+    # bytes a pair) may cover the whole tile, and a third for rescoring
+    chunk = max(1, memory_budget // 3 // (BYTES_PER_PAIR_DIMENSION * embeddings.shape[1] + BYTES_PER_PAIR))
+
+    for rows, cols in iter_hamming_pairs(codes, radius, memory_budget // 3):
+        if counts is not None:
+            counts['candidates'] = counts.get('candidates', 0) + len(rows)
+        found_rows, found_cols, found = [], [], []
+        for start in range(0, len(rows), chunk):
+            chunk_rows, chunk_cols = rows[start:start + chunk], cols[start:start + chunk]
+            similarities = np.einsum(
+                'ij,ij->i',
+                np.asarray(embeddings[chunk_rows], dtype=np.float32),
+                np.asarray(embeddings[chunk_cols], dtype=np.float32)
+            ).astype(np.float64)
+            np.round(similarities, decimals, out=similarities)
+            above = similarities > threshold
+            if above.any():
+                found_rows.append(chunk_rows[above])
+                found_cols.append(chunk_cols[above])
+                found.append(similarities[above])
+        del rows, cols
+        if found:
+            yield np.concatenate(found_rows), np.concatenate(found_cols), np.concatenate(found)
@@ -1,3 +1,950 @@
-from django.test import TestCase
+import os
+import hashlib
+import tempfile
+import threading
+import tracemalloc
+from unittest.mock import patch, MagicMock
+import numpy as np
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+from rest_framework import status
 
-# Create your tests here.
+from cognigrade.utils import embeddings, embedding_cache
+from cognigrade.utils.embedding_cache import LRUCache
+from cognigrade.utils.ann import IVFIndex
+from cognigrade.utils.minhash import near_duplicate_pairs
+from cognigrade.utils.plagiarism import detect_question_plagiarism_batch
+from cognigrade.utils.parity import check_backend_parity
+from cognigrade.utils.inference_service import EmbeddingClient, EmbeddingServer, parse_address
+from cognigrade.utils import embedding_store
+from cognigrade.utils.embedding_store import EmbeddingStore, MemmapEmbeddingStore, PgVectorEmbeddingStore, encode_answers, text_fingerprint
+from cognigrade.utils.duplicates import canonical_text, exact_duplicate_groups
+from cognigrade.utils.evaluation import grade_answer_proc, grade_similarities
+from cognigrade.utils.similarity import binary_codes, calibrate_radius, hamming_radius, iter_binary_prefiltered_pairs, iter_hamming_pairs, similar_pairs, iter_similar_pairs
+from cognigrade.utils.models import EmbeddingCache
+
+
+class FakeSentenceModel:
+    """Deterministic stand-in for a SentenceTransformer that records what it encodes"""
+
+    def __init__(self, dim=16):
+        self.dim = dim
+        self.calls = []
+
+    def encode(self, texts, convert_to_numpy=True, normalize_embeddings=False, **kwargs):
+        texts = list(texts)
+        self.calls.append(texts)
+        vectors = np.array([
+            np.random.default_rng(int(hashlib.md5(text.encode()).hexdigest()[:8], 16)).standard_normal(self.dim)
+            for text in texts
+        ], dtype=np.float32).reshape(len(texts), self.dim)
+        if normalize_embeddings:
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors
+
+    @property
+    def encoded_texts(self):
+        return [text for call in self.calls for text in call]
+
+
+class EmbeddingRegistryTestCase(TestCase):
+    """Test cases for the shared, lazily loaded embedding model registry"""
+
+    def setUp(self):
+        self.fake_module = MagicMock()
+        self.fake_module.SentenceTransformer.side_effect = lambda name, **kwargs: MagicMock(name=name)
+        self.modules_patch = patch.dict('sys.modules', {'sentence_transformers': self.fake_module})
+        self.modules_patch.start()
+        self.models_patch = patch.dict(embeddings._models, clear=True)
+        self.models_patch.start()
+
+    def tearDown(self):
+        self.models_patch.stop()
+        self.modules_patch.stop()
+
+    @override_settings(EMBEDDING_WARMUP=True)
+    def test_models_load_lazily_and_are_shared(self):
+        """Models load on first use only, once per answer type"""
+        self.assertFalse(embeddings.is_ready())
+        self.fake_module.SentenceTransformer.assert_not_called()
+
+        first = embeddings.get_model('long')
+        second = embeddings.get_model('long')
+
+        self.assertIs(first, second)
+        self.assertEqual(self.fake_module.SentenceTransformer.call_count, 1)
+        self.assertEqual(embeddings.loaded_models(), {'short': False, 'long': True, 'paraphrased': False})
+
+    def test_unknown_answer_type_uses_short_model(self):
+        self.assertIs(embeddings.get_model('essay'), embeddings.get_model('short'))
+
+    @override_settings(EMBEDDING_WARMUP=True)
+    def test_warm_up_and_readiness_probe(self):
+        client = APIClient()
+        url = reverse('readiness')
+
+        response = client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        embeddings.warm_up()
+
+        response = client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data['ready'])
+        self.assertEqual(self.fake_module.SentenceTransformer.call_count, 3)
+
+    @override_settings(EMBEDDING_WARMUP=False)
+    def test_ready_without_warmup(self):
+        """Models load on first use, so the probe doesn't wait for them"""
+        response = APIClient().get(reverse('readiness'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.fake_module.SentenceTransformer.assert_not_called()
+
+    def test_revision_resolves_to_downloaded_commit(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                patch.object(embeddings, 'LOCAL_MODEL_DIR', directory), \
+                patch.dict(embeddings._revisions, clear=True):
+            self.assertEqual(embeddings.model_revision('short'), 'main')
+
+            ref = os.path.join(directory, 'models--sentence-transformers--all-MiniLM-L6-v2', 'refs', 'main')
+            os.makedirs(os.path.dirname(ref))
+            with open(ref, 'w') as f:
+                f.write('0123abcd\n')
+            self.assertEqual(embeddings.model_revision('short'), '0123abcd')
+            self.assertEqual(embeddings.model_tag('short'), 'sentence-transformers/all-MiniLM-L6-v2@0123abcd')
+
+            # The commit sticks even if the branch moves on
+            with open(ref, 'w') as f:
+                f.write('4567ef01')
+            self.assertEqual(embeddings.model_revision('short'), '0123abcd')
+
+            with override_settings(EMBEDDING_MODEL_REVISIONS={'short': 'pinned'}):
+                self.assertEqual(embeddings.model_revision('short'), 'pinned')
+
+
+class EmbeddingCacheTestCase(TestCase):
+    """Test cases for the content-addressed embedding cache"""
+
+    def setUp(self):
+        self.model = FakeSentenceModel()
+        self.model_patch = patch('cognigrade.utils.embeddings.get_model', return_value=self.model)
+        self.model_patch.start()
+        embedding_cache.memory_cache.clear()
+        embedding_cache._purged.clear()
+
+    def tearDown(self):
+        self.model_patch.stop()
+        embedding_cache.memory_cache.clear()
+
+    def test_repeat_encode_is_a_cache_lookup(self):
+        first = embeddings.encode(["A variable stores a value.", "Lists are mutable."], "short")
+        second = embeddings.encode(["A  variable stores a value. ", "Lists are mutable."], "short")
+
+        np.testing.assert_array_equal(first, second)
+        self.assertEqual(len(self.model.encoded_texts), 2)
+        self.assertEqual(EmbeddingCache.objects.count(), 2)
+
+    def test_persisted_embeddings_survive_memory_eviction(self):
+        first = embeddings.encode(["A variable stores a value."], "long")
+        embedding_cache.memory_cache.clear()
+        second = embeddings.encode(["A variable stores a value."], "long")
+
+        np.testing.assert_array_equal(first, second)
+        self.assertEqual(len(self.model.encoded_texts), 1)
+
+    def test_model_version_change_invalidates_cache(self):
+        embeddings.encode(["A variable stores a value."], "short")
+
+        with override_settings(EMBEDDING_MODEL_REVISIONS={'short': 'v2'}):
+            embeddings.encode(["A variable stores a value."], "short")
+
+        self.assertEqual(len(self.model.encoded_texts), 2)
+        self.assertEqual(
+            list(EmbeddingCache.objects.values_list('model_version', flat=True)),
+            ['v2']
+        )
+
+    def test_lru_eviction_is_bounded(self):
+        cache = embedding_cache.LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+
+
+class GradeSimilaritiesTestCase(TestCase):
+    """Test cases for vectorized grading thresholds"""
+
+    def test_thresholds_per_answer_type(self):
+        grades = grade_similarities(
+            np.array([0.9, 0.75, 0.5, 0.76, 0.62]),
+            ['short', 'long', 'short', 'paraphrased', 'paraphrased']
+        )
+        self.assertEqual(list(grades), ['Full Marks', 'Partial Marks', 'Incorrect', 'Full Marks', 'Partial Marks'])
+
+
+class SimilarPairsTestCase(TestCase):
+    """Test cases for upper-triangle pair extraction"""
+
+    def test_pairs_above_threshold(self):
+        matrix = np.array([
+            [1.0, 0.95, 0.2],
+            [0.95, 1.0, 0.9004],
+            [0.2, 0.9004, 1.0],
+        ])
+        rows, cols, similarities = similar_pairs(matrix, 0.9)
+
+        self.assertEqual(list(zip(rows.tolist(), cols.tolist(), similarities.tolist())), [(0, 1, 0.95)])
+
+    def test_tiled_pairs_match_dense_pairs(self):
+        rng = np.random.default_rng(0)
+        embeddings = rng.standard_normal((57, 8)).astype(np.float32)
+        # Make some near duplicates so there are pairs to find
+        embeddings[30:40] = embeddings[0:10] + 0.05 * rng.standard_normal((10, 8)).astype(np.float32)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+        rows, cols, similarities = similar_pairs(embeddings @ embeddings.T, 0.8)
+        dense = set(zip(rows.tolist(), cols.tolist(), similarities.tolist()))
+
+        # A 160 byte budget gives 3x3 tiles
+        tiled = set()
+        for rows, cols, similarities in iter_similar_pairs(embeddings, 0.8, memory_budget=160):
+            tiled.update(zip(rows.tolist(), cols.tolist(), similarities.tolist()))
+
+        self.assertGreaterEqual(len(dense), 10)
+        self.assertEqual(tiled, dense)
+
+    def test_tiled_pairs_against_other_set(self):
+        rng = np.random.default_rng(1)
+        embeddings = rng.standard_normal((7, 4)).astype(np.float32)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+        pairs = set()
+        for rows, cols, similarities in iter_similar_pairs(embeddings[:2], 0.99, others=embeddings, memory_budget=16):
+            pairs.update(zip(rows.tolist(), cols.tolist()))
+
+        self.assertEqual(pairs, {(0, 0), (1, 1)})
+
+    def test_tiles_stay_within_memory_budget(self):
+        rng = np.random.default_rng(3)
+        embeddings = rng.standard_normal((2000, 32)).astype(np.float32)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        codes = binary_codes(embeddings)
+        budget = 1024 * 1024
+
+        for pairs in (
+            lambda: iter_similar_pairs(embeddings, 0.9, memory_budget=budget),
+            lambda: iter_hamming_pairs(codes, 2, memory_budget=budget),
+            # A wide radius: about a quarter of all pairs are rescored
+            lambda: iter_binary_prefiltered_pairs(embeddings, 0.9, memory_budget=budget, codes=codes, radius=13),
+        ):
+            tracemalloc.start()
+            try:
+                for _ in pairs():
+                    pass
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            self.assertLessEqual(peak, budget)
+
+
+class IVFIndexTestCase(TestCase):
+    """Test cases for the approximate nearest-neighbour index"""
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.vectors = rng.standard_normal((300, 16)).astype(np.float32)
+        self.vectors /= np.linalg.norm(self.vectors, axis=1, keepdims=True)
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'index')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_trained_index_finds_exact_match(self):
+        index = IVFIndex(self.path, model_tag='m', min_train_size=100)
+        index.add(np.arange(200), self.vectors[:200], np.zeros(200))
+        self.assertFalse(index.is_trained)
+        self.assertTrue(index.needs_training)
+        index.train()
+
+        # Inserts after training go straight into the inverted lists
+        for start in range(200, 300, 50):
+            IVFIndex(self.path, model_tag='m').add(np.arange(start, start + 50), self.vectors[start:start + 50], np.zeros(50))
+
+        index = IVFIndex(self.path, model_tag='m', min_train_size=100)
+        self.assertTrue(index.is_trained)
+        self.assertEqual(len(index), 300)
+        for i in (0, 123, 299):
+            answer_id, similarity = index.search(self.vectors[i], k=3)[0]
+            self.assertEqual(answer_id, i)
+            self.assertAlmostEqual(similarity, 1.0, places=5)
+
+    def test_inserts_never_train(self):
+        index = IVFIndex(self.path, model_tag='m', min_train_size=100)
+        index.add(np.arange(300), self.vectors, np.zeros(300))
+        self.assertFalse(index.is_trained)
+        self.assertEqual(index.search(self.vectors[42], k=1)[0][0], 42)
+
+    def test_exclude_group_and_replace(self):
+        index = IVFIndex(self.path, model_tag='m')
+        index.add([1, 2], self.vectors[:2], [10, 20])
+        index.add([1], self.vectors[5:6], [10])
+
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index.search(self.vectors[5], k=1)[0][0], 1)
+        self.assertEqual([answer_id for answer_id, _ in index.search(self.vectors[5], k=5, exclude_group=10)], [2])
+
+    def test_reinserts_keep_size(self):
+        index = IVFIndex(self.path, model_tag='m')
+        for _ in range(3):
+            index.add([1, 2], self.vectors[:2], [10, 20])
+            self.assertEqual(len(IVFIndex(self.path, model_tag='m')), 2)
+        self.assertEqual(sorted(index.live_ids().tolist()), [1, 2])
+
+    def test_compact_drops_superseded_rows(self):
+        index = IVFIndex(self.path, model_tag='m', min_train_size=10)
+        index.add(np.arange(20), self.vectors[:20], np.zeros(20))
+        index.train()
+        index.add(np.arange(20), self.vectors[20:40], np.zeros(20))
+        self.assertTrue(index.needs_compaction)
+
+        index.compact()
+        index = IVFIndex(self.path, model_tag='m', min_train_size=10)
+        self.assertFalse(index.needs_compaction)
+        self.assertFalse(index.is_trained)
+        self.assertEqual(len(index), 20)
+        self.assertEqual(len(np.load(os.path.join(self.path, 'entries.npy'))), 20)
+        self.assertEqual(index.search(self.vectors[20], k=1)[0][0], 0)
+        self.assertEqual(index.search(self.vectors[39], k=1)[0][0], 19)
+
+    def test_model_change_discards_index(self):
+        IVFIndex(self.path, model_tag='m').add(np.arange(10), self.vectors[:10], np.zeros(10))
+
+        self.assertEqual(len(IVFIndex(self.path, model_tag='m')), 10)
+        other = IVFIndex(self.path, model_tag='other-model')
+        self.assertEqual(len(other), 0)
+        self.assertEqual(other.search(self.vectors[0], k=1), [])
+
+        other.add([99], self.vectors[:1], [0])
+        self.assertEqual(len(IVFIndex(self.path, model_tag='other-model')), 1)
+        self.assertEqual(len(IVFIndex(self.path, model_tag='m')), 0)
+
+    def test_search_rejects_non_positive_k(self):
+        index = IVFIndex(self.path, model_tag='m')
+        index.add([1], self.vectors[:1], [0])
+        for k in (0, -1):
+            with self.assertRaises(ValueError):
+                index.search(self.vectors[0], k=k)
+
+
+class LexicalPrefilterTestCase(TestCase):
+    """Test cases for the MinHash/LSH near-duplicate stage"""
+
+    original = (
+        "Lists and tuples are both sequences. Lists are mutable and use square brackets, "
+        "while tuples are immutable and use parentheses, so tuples can be dictionary keys."
+    )
+
+    def setUp(self):
+        self.model = FakeSentenceModel()
+        self.model_patch = patch('cognigrade.utils.embeddings.get_model', return_value=self.model)
+        self.model_patch.start()
+        embedding_cache.memory_cache.clear()
+
+    def tearDown(self):
+        self.model_patch.stop()
+        embedding_cache.memory_cache.clear()
+
+    def test_near_verbatim_copies_are_paired(self):
+        pairs = near_duplicate_pairs([
+            self.original,
+            self.original.upper().replace("  ", " "),
+            self.original.replace("so tuples", "so a tuple"),
+            "A tuple is an immutable ordered collection.",
+        ])
+        self.assertEqual(pairs, [(0, 1), (0, 2), (1, 2)])
+
+    @override_settings(EMBEDDING_CACHE_PERSIST=False)
+    def test_copies_are_flagged_and_encoded_once(self):
+        copy = self.original.replace("so tuples", "so a tuple")
+        unrelated = "A tuple is an immutable ordered collection."
+        self.model_patch.stop()
+        model = TableSentenceModel({self.original: [1, 0, 0], copy: [0, 1, 0], unrelated: [0.9, 0, 0.4359]})
+        self.model_patch = patch('cognigrade.utils.embeddings.get_model', return_value=model)
+        self.model_patch.start()
+        data = [
+            {'submission_id': 1, 'answer': self.original},
+            {'submission_id': 2, 'answer': copy},
+            {'submission_id': 3, 'answer': unrelated},
+            {'submission_id': 4, 'answer': self.original.upper()},
+        ]
+
+        stats = {}
+        pairs = detect_question_plagiarism_batch(data, answer_type='long', threshold=0.85, stats=stats)
+
+        # The copy takes the original's score against the unrelated answer
+        self.assertEqual(pairs, [(1, 2, 1.0), (1, 3, 0.9), (1, 4, 1.0), (2, 3, 0.9), (2, 4, 1.0), (3, 4, 0.9)])
+        self.assertEqual(sorted(model.encoded_texts), sorted([self.original, unrelated]))
+        self.assertEqual((stats['pairs'], stats['copies'], stats['escalated']), (6, 3, 1))
+
+        model.calls.clear()
+        embedding_cache.memory_cache.clear()
+        with override_settings(LEXICAL_PREFILTER=False):
+            pairs = detect_question_plagiarism_batch(data, answer_type='long', threshold=0.85)
+        self.assertEqual(pairs, [(1, 3, 0.9), (1, 4, 1.0), (3, 4, 0.9)])
+        self.assertEqual(sorted(model.encoded_texts), sorted([self.original, copy, unrelated]))
+
+    @override_settings(PLAGIARISM_CASCADE=True, PLAGIARISM_CASCADE_BAND=0.1, EMBEDDING_CACHE_PERSIST=False)
+    def test_cascade_flags_copies_without_either_model(self):
+        copy = self.original.replace("so tuples", "so a tuple")
+        unrelated = "A tuple is an immutable ordered collection."
+        self.model_patch.stop()
+        # The cheap model would miss the copy
+        models = {
+            'short': TableSentenceModel({self.original: [1, 0, 0], copy: [0, 1, 0], unrelated: [0, 0, 1]}),
+            'long': TableSentenceModel({}),
+        }
+        self.model_patch = patch(
+            'cognigrade.utils.embeddings.get_model',
+            side_effect=lambda answer_type, backend=None: models[answer_type]
+        )
+        self.model_patch.start()
+
+        pairs = detect_question_plagiarism_batch([
+            {'submission_id': 1, 'answer': self.original},
+            {'submission_id': 2, 'answer': copy},
+            {'submission_id': 3, 'answer': unrelated},
+        ], answer_type='long', threshold=0.85)
+
+        self.assertEqual(pairs, [(1, 2, 1.0)])
+        self.assertEqual(sorted(models['short'].encoded_texts), sorted([self.original, unrelated]))
+        self.assertEqual(models['long'].encoded_texts, [])
+
+
+class LengthBucketingTestCase(TestCase):
+    """Test cases for token-budgeted length buckets"""
+
+    def test_buckets_respect_budget_and_cover_every_text(self):
+        lengths = [40, 3, 250, 5, 38, 4, 260]
+        buckets = embeddings.token_buckets(lengths, token_budget=300, max_batch_size=3)
+
+        self.assertEqual(sorted(i for bucket in buckets for i in bucket), list(range(len(lengths))))
+        for bucket in buckets:
+            self.assertLessEqual(len(bucket), 3)
+            self.assertTrue(len(bucket) == 1 or len(bucket) * max(lengths[i] for i in bucket) <= 300)
+        # Short texts are never batched with the long ones
+        self.assertIn({1, 3, 5}, [set(bucket.tolist()) for bucket in buckets])
+
+    @override_settings(EMBEDDING_TOKEN_BUDGET=40)
+    def test_encode_restores_input_order(self):
+        model = FakeSentenceModel()
+        texts = ["word " * 30, "short one", "word " * 5, "tiny", "word " * 25]
+        with patch('cognigrade.utils.embeddings.get_model', return_value=model):
+            vectors = embeddings.encode_with_model(texts, 'long')
+
+        self.assertGreater(len(model.calls), 1)
+        np.testing.assert_allclose(vectors, model.encode(texts, normalize_embeddings=True), atol=1e-6)
+
+
+class TableSentenceModel(FakeSentenceModel):
+    """Fake model returning fixed unit vectors per text"""
+
+    def __init__(self, table):
+        super().__init__(dim=3)
+        self.table = table
+
+    def encode(self, texts, convert_to_numpy=True, normalize_embeddings=False, **kwargs):
+        texts = list(texts)
+        self.calls.append(texts)
+        vectors = np.array([self.table[text] for text in texts], dtype=np.float32)
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+@override_settings(PLAGIARISM_CASCADE=True, PLAGIARISM_CASCADE_BAND=0.1, LEXICAL_PREFILTER=False, EMBEDDING_CACHE_PERSIST=False)
+class PlagiarismCascadeTestCase(TestCase):
+    """Test cases for cheap-model-first plagiarism scoring"""
+
+    def setUp(self):
+        # MiniLM: a-b 0.97 (above the band), a-c 0.8 (in the band), b-c 0.65 (below it)
+        self.cheap = TableSentenceModel({'a': [1, 0, 0], 'b': [0.97, 0.2431, 0], 'c': [0.8, -0.5, 0.3317]})
+        # mpnet: a-c 0.9
+        self.expensive = TableSentenceModel({'a': [1, 0, 0], 'b': [0, 1, 0], 'c': [0.9, 0, 0.4359]})
+        models = {'short': self.cheap, 'long': self.expensive}
+        self.model_patch = patch(
+            'cognigrade.utils.embeddings.get_model',
+            side_effect=lambda answer_type, backend=None: models[answer_type]
+        )
+        self.model_patch.start()
+        embedding_cache.memory_cache.clear()
+
+    def tearDown(self):
+        self.model_patch.stop()
+        embedding_cache.memory_cache.clear()
+
+    def test_only_uncertain_pairs_reach_the_expensive_model(self):
+        data = [{'submission_id': i, 'answer': text} for i, text in enumerate(['a', 'b', 'c'])]
+        stats = {}
+        pairs = detect_question_plagiarism_batch(data, 'long', 0.85, stats)
+
+        self.assertEqual(pairs, [(0, 1, 0.97), (0, 2, 0.9)])
+        self.assertEqual(sorted(self.expensive.encoded_texts), ['a', 'c'])
+        self.assertEqual(stats, {'pairs': 3, 'cheap_dismissed': 1, 'cheap_flagged': 1, 'escalated': 1, 'escalated_flagged': 1})
+
+    def test_short_answers_skip_the_cascade(self):
+        data = [{'submission_id': i, 'answer': text} for i, text in enumerate(['a', 'b', 'c'])]
+        stats = {}
+        detect_question_plagiarism_batch(data, 'short', 0.9, stats)
+
+        self.assertEqual(self.expensive.calls, [])
+        self.assertEqual(stats, {'pairs': 3, 'escalated': 3, 'escalated_flagged': 1})
+
+
+class BinaryPrefilterTestCase(TestCase):
+    """Test cases for the sign-code Hamming prefilter"""
+
+    def setUp(self):
+        rng = np.random.default_rng(2)
+        centres = rng.standard_normal((10, 96))
+        # Four noisy copies of each centre, so every cluster has similar pairs
+        vectors = np.repeat(centres, 4, axis=0) + 0.3 * rng.standard_normal((40, 96))
+        self.embeddings = (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+        embedding_cache.memory_cache.clear()
+
+    def tearDown(self):
+        embedding_cache.memory_cache.clear()
+
+    def test_codes_pack_sign_bits(self):
+        codes = binary_codes(self.embeddings)
+
+        self.assertEqual(codes.dtype, np.uint64)
+        self.assertEqual(codes.shape, (40, 2))
+        mismatched = int(np.sum((self.embeddings[0] > 0) != (self.embeddings[5] > 0)))
+        self.assertEqual(int(np.bitwise_count(codes[0] ^ codes[5]).sum()), mismatched)
+
+    def test_prefiltered_pairs_match_exact_pairs(self):
+        exact = set()
+        for rows, cols, similarities in iter_similar_pairs(self.embeddings, 0.8, memory_budget=1024):
+            exact.update(zip(rows.tolist(), cols.tolist(), similarities.tolist()))
+
+        counts = {}
+        prefiltered = set()
+        for rows, cols, similarities in iter_binary_prefiltered_pairs(self.embeddings, 0.8, memory_budget=1024, counts=counts):
+            prefiltered.update(zip(rows.tolist(), cols.tolist(), similarities.tolist()))
+
+        self.assertGreaterEqual(len(exact), 40)
+        self.assertEqual(prefiltered, exact)
+        self.assertLess(counts['candidates'], 40 * 39 // 2)
+
+    def test_radius_shrinks_with_threshold(self):
+        self.assertLess(hamming_radius(0.95, 384, margin=0), hamming_radius(0.8, 384, margin=0))
+        self.assertEqual(hamming_radius(1.0, 384, margin=0), 0)
+        self.assertEqual(hamming_radius(-1.0, 384, margin=0.1), 384)
+
+    def test_calibrated_radius(self):
+        codes = binary_codes(self.embeddings)
+        radius, share = calibrate_radius(self.embeddings, codes, 0.8)
+
+        # Pairs of the same cluster (about 8% of all pairs) are within the radius
+        self.assertGreaterEqual(share, 0.05)
+        self.assertLess(share, 0.2)
+        with override_settings(BINARY_PREFILTER_MARGIN=0.5):
+            self.assertEqual(calibrate_radius(self.embeddings, codes, 0.8), (hamming_radius(0.8, 96, 0.5), 1.0))
+
+    @override_settings(
+        BINARY_PREFILTER_MIN_ANSWERS=10, BINARY_PREFILTER_MAX_CANDIDATES=0.0,
+        LEXICAL_PREFILTER=False, PLAGIARISM_CASCADE=False, EMBEDDING_CACHE_PERSIST=False
+    )
+    def test_unselective_radius_scores_exactly(self):
+        model = TableSentenceModel({f'answer {i}': vector for i, vector in enumerate(self.embeddings)})
+        data = [{'submission_id': i, 'answer': f'answer {i}'} for i in range(40)]
+
+        stats = {}
+        with patch('cognigrade.utils.embeddings.get_model', return_value=model), override_settings(BINARY_PREFILTER=True):
+            pairs = detect_question_plagiarism_batch(data, 'short', 0.8, stats)
+
+        self.assertNotIn('binary_dismissed', stats)
+        self.assertEqual(stats['escalated'], 780)
+        self.assertEqual(len(pairs), stats['escalated_flagged'])
+
+    @override_settings(
+        BINARY_PREFILTER_MIN_ANSWERS=10, BINARY_PREFILTER_MAX_CANDIDATES=1.0,
+        LEXICAL_PREFILTER=False, PLAGIARISM_CASCADE=False, EMBEDDING_CACHE_PERSIST=False
+    )
+    def test_batch_detection_with_prefilter(self):
+        model = TableSentenceModel({f'answer {i}': vector for i, vector in enumerate(self.embeddings)})
+        data = [{'submission_id': i, 'answer': f'answer {i}'} for i in range(40)]
+
+        with patch('cognigrade.utils.embeddings.get_model', return_value=model):
+            with override_settings(BINARY_PREFILTER=False):
+                expected = detect_question_plagiarism_batch(data, 'short', 0.8)
+            stats = {}
+            with override_settings(BINARY_PREFILTER=True):
+                pairs = detect_question_plagiarism_batch(data, 'short', 0.8, stats)
+
+        self.assertEqual(pairs, expected)
+        self.assertEqual(stats['pairs'], 780)
+        self.assertEqual(stats['binary_dismissed'] + stats['escalated'], 780)
+        self.assertGreater(stats['binary_dismissed'], 0)
+        self.assertEqual(stats['escalated_flagged'], len(expected))
+
+
+class ExactDuplicateTestCase(TestCase):
+    """Test cases for the normalized-hash duplicate stage"""
+
+    def setUp(self):
+        self.model = FakeSentenceModel()
+        self.model_patch = patch('cognigrade.utils.embeddings.get_model', return_value=self.model)
+        self.model_patch.start()
+        embedding_cache.memory_cache.clear()
+
+    def tearDown(self):
+        self.model_patch.stop()
+        embedding_cache.memory_cache.clear()
+
+    def test_groups_ignore_case_punctuation_and_whitespace(self):
+        self.assertEqual(canonical_text("  N/A. "), "n/a")
+        self.assertEqual(canonical_text("Lists, tuples; and sets!"), "lists tuples and sets")
+        representatives, inverse = exact_duplicate_groups(["N/A", "Lists are mutable.", "n/a", "lists  are MUTABLE"])
+        self.assertEqual(representatives.tolist(), [0, 1])
+        self.assertEqual(inverse.tolist(), [0, 1, 0, 1])
+
+    @override_settings(LEXICAL_PREFILTER=False)
+    def test_duplicates_score_one_without_extra_encoding(self):
+        data = [{'submission_id': i, 'answer': text} for i, text in enumerate(["N/A", "n/a.", "Lists are mutable."])]
+        pairs = detect_question_plagiarism_batch(data, 'short', 0.9)
+
+        self.assertEqual(pairs, [(0, 1, 1.0)])
+        self.assertEqual(len(self.model.encoded_texts), 2)
+
+    def test_numbers_keep_their_sign_and_decimal_point(self):
+        for first, second in (("-5", "5"), ("3.14", "314"), ("1,000", "1000"), ("a-b", "ab"), ("x^2", "x2"), ("5%", "5")):
+            self.assertNotEqual(canonical_text(first), canonical_text(second))
+        self.assertEqual(canonical_text("The answer is -3.5."), canonical_text("the answer is  -3.5."))
+
+    def test_wrong_sign_is_not_full_marks(self):
+        grade, similarity = grade_answer_proc("-5", "5", "short")
+
+        self.assertNotEqual(similarity, 1.0)
+        self.assertEqual(len(self.model.encoded_texts), 2)
+
+    def test_key_match_is_full_marks(self):
+        grade, similarity = grade_answer_proc("a variable STORES a value", "A variable stores a value.", "short")
+
+        self.assertEqual((grade, similarity), ("Full Marks", 1.0))
+        self.assertEqual(self.model.calls, [])
+
+
+class MemmapEmbeddingStoreTestCase(TestCase):
+    """Test cases for the memory-mapped answer embedding store"""
+
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.store = MemmapEmbeddingStore(root=self.root.name)
+        self.vectors = np.random.default_rng(0).standard_normal((5, 8)).astype(np.float32)
+        self.fingerprints = [text_fingerprint(f"answer {i}") for i in range(5)]
+
+    def tearDown(self):
+        self.root.cleanup()
+
+    def test_appends_are_memory_mapped(self):
+        self.store.add((1, 2), 'model@main', [10, 11, 12], self.fingerprints[:3], self.vectors[:3])
+        self.store.add((1, 2), 'model@main', [13, 14], self.fingerprints[3:], self.vectors[3:])
+
+        vectors_path, _ = self.store.paths((1, 2), 'model@main')
+        mapped = np.load(vectors_path, mmap_mode='r')
+        self.assertIsInstance(mapped, np.memmap)
+        np.testing.assert_array_equal(mapped, self.vectors)
+
+        found, vectors = self.store.get((1, 2), 'model@main', [14, 10, 99], [self.fingerprints[4], self.fingerprints[0], 0])
+        self.assertEqual(found.tolist(), [True, True, False])
+        np.testing.assert_array_equal(vectors, self.vectors[[4, 0]])
+
+    def test_sign_codes_are_stored(self):
+        self.store.add((1, 2), 'model@main', [10, 11, 12], self.fingerprints[:3], self.vectors[:3])
+
+        found, codes = self.store.get_codes((1, 2), 'model@main', [12, 99, 10], [self.fingerprints[2], 0, self.fingerprints[0]])
+        self.assertEqual(found.tolist(), [True, False, True])
+        np.testing.assert_array_equal(codes, binary_codes(self.vectors[[2, 0]]))
+        vectors_path, _ = self.store.paths((1, 2), 'model@main')
+        self.assertEqual(np.load(vectors_path[:-len('.npy')] + '.codes.npy').nbytes, 3 * 8)
+
+    def test_edited_answers_and_other_models_miss(self):
+        self.store.add((1, 2), 'model@main', [10], self.fingerprints[:1], self.vectors[:1])
+
+        found, _ = self.store.get((1, 2), 'model@main', [10], [text_fingerprint("edited answer")])
+        self.assertFalse(found.any())
+        found, _ = self.store.get((1, 2), 'model@v2', [10], self.fingerprints[:1])
+        self.assertFalse(found.any())
+
+    def test_search_uses_latest_rows(self):
+        self.store.add((1, 2), 'model@main', [10, 11, 12], self.fingerprints[:3], self.vectors[:3])
+        # Answer 11 was edited and now has the vector of answer 12's text
+        self.store.add((1, 2), 'model@main', [11], self.fingerprints[3:4], self.vectors[2:3])
+
+        matches = self.store.search((1, 2), 'model@main', self.vectors[2], k=2, exclude_ids=[12])
+
+        self.assertEqual([answer_id for answer_id, _ in matches], [11, 10])
+        self.assertAlmostEqual(matches[0][1], float(self.vectors[2] @ self.vectors[2]), places=4)
+        self.assertEqual(
+            self.store.contains((1, 2), 'model@main', [10, 11, 11, 13], [self.fingerprints[0], self.fingerprints[1], self.fingerprints[3], 0]).tolist(),
+            [True, False, True, False]
+        )
+
+    def test_removed_answers_are_forgotten(self):
+        self.store.add((1, 2), 'model@main', [10, 11], self.fingerprints[:2], self.vectors[:2])
+        self.store.add((1, 2), 'model@v2', [10, 11], self.fingerprints[:2], self.vectors[:2])
+        self.store.remove((1, 2), [11])
+
+        for tag in ('model@main', 'model@v2'):
+            self.assertEqual([answer_id for answer_id, _ in self.store.search((1, 2), tag, self.vectors[1], k=5)], [10])
+            found, _ = self.store.get((1, 2), tag, [10, 11], self.fingerprints[:2])
+            self.assertEqual(found.tolist(), [True, False])
+
+    def test_retain_forgets_answers_not_listed(self):
+        self.store.add((1, 2), 'model@main', [10, 11, 12], self.fingerprints[:3], self.vectors[:3])
+        self.store.add((1, 2), 'model@v2', [10, 11], self.fingerprints[:2], self.vectors[:2])
+        # 12 may have been added after the listed ids were read
+        self.store.retain((1, 2), [11])
+
+        found, _ = self.store.get((1, 2), 'model@main', [10, 11, 12], self.fingerprints[:3])
+        self.assertEqual(found.tolist(), [False, True, True])
+        found, _ = self.store.get((1, 2), 'model@v2', [10, 11], self.fingerprints[:2])
+        self.assertEqual(found.tolist(), [False, True])
+
+    @patch.object(embedding_store, '_lookups', LRUCache(1))
+    def test_lookups_are_bounded(self):
+        self.store.add((1, 2), 'model@main', [10], self.fingerprints[:1], self.vectors[:1])
+        self.store.add((1, 3), 'model@main', [11], self.fingerprints[1:2], self.vectors[1:2])
+        self.store._rows((1, 2), 'model@main')
+        self.store._rows((1, 3), 'model@main')
+
+        self.assertEqual(len(embedding_store._lookups), 1)
+        found, _ = self.store.get((1, 2), 'model@main', [10], self.fingerprints[:1])
+        self.assertEqual(found.tolist(), [True])
+
+    def test_store_interface_is_abstract(self):
+        with self.assertRaises(TypeError):
+            EmbeddingStore()
+
+    def test_lookup_is_reused_until_the_files_change(self):
+        self.store.add((1, 2), 'model@main', [10, 11], self.fingerprints[:2], self.vectors[:2])
+        _, first = self.store._rows((1, 2), 'model@main')
+        _, second = self.store._rows((1, 2), 'model@main')
+        self.assertIs(first, second)
+
+        self.store.add((1, 2), 'model@main', [12], self.fingerprints[2:3], self.vectors[2:3])
+        _, third = self.store._rows((1, 2), 'model@main')
+        self.assertIsNot(third, first)
+        self.assertEqual(third.answer_ids.tolist(), [10, 11, 12])
+
+    def test_dtype_change_keeps_the_file_dtype(self):
+        self.store.add((1, 3), 'model@main', [10], self.fingerprints[:1], self.vectors[:1])
+        MemmapEmbeddingStore(root=self.root.name, dtype='float16').add((1, 3), 'model@main', [11], self.fingerprints[1:2], self.vectors[1:2])
+
+        vectors_path, _ = self.store.paths((1, 3), 'model@main')
+        self.assertEqual(np.load(vectors_path).dtype, np.float32)
+        found, vectors = self.store.get((1, 3), 'model@main', [10, 11], self.fingerprints[:2])
+        self.assertTrue(found.all())
+        np.testing.assert_array_equal(vectors, self.vectors[:2])
+
+    def test_float16_store(self):
+        store = MemmapEmbeddingStore(root=self.root.name, dtype='float16')
+        store.add((1, 3), 'model@main', [10], self.fingerprints[:1], self.vectors[:1])
+
+        found, vectors = store.get((1, 3), 'model@main', [10], self.fingerprints[:1])
+        self.assertEqual(vectors.dtype, np.float32)
+        np.testing.assert_allclose(vectors, self.vectors[:1], atol=1e-2)
+
+    def test_encode_answers_only_encodes_missing(self):
+        model = FakeSentenceModel()
+        texts = ["Lists are mutable.", "Tuples are immutable."]
+        encoder = lambda batch: embeddings.encode(batch, 'short')
+        with override_settings(EMBEDDING_STORE='memmap', EMBEDDING_STORE_ROOT=self.root.name, EMBEDDING_CACHE_PERSIST=False), \
+                patch('cognigrade.utils.embeddings.get_model', return_value=model):
+            first = encode_answers([(1, 2), (1, 2)], [10, 11], texts, 'short', encoder)
+            embedding_cache.memory_cache.clear()
+            second = encode_answers([(1, 2), (1, 2)], [10, 11], texts, 'short', encoder)
+
+        np.testing.assert_array_equal(first, second)
+        self.assertEqual(len(model.encoded_texts), 2)
+
+
+class NoisyFakeSentenceModel(FakeSentenceModel):
+    """Fake model whose vectors drift from FakeSentenceModel's, like a quantized export"""
+
+    def __init__(self, noise, dim=16):
+        super().__init__(dim)
+        self.noise = noise
+
+    def encode(self, texts, convert_to_numpy=True, normalize_embeddings=False, **kwargs):
+        vectors = super().encode(texts) + self.noise
+        if normalize_embeddings:
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors
+
+
+class PgVectorSearchStatementsTestCase(TestCase):
+    """Test cases for the SQL the pgvector store searches with, without PostgreSQL"""
+
+    def setUp(self):
+        self.store = PgVectorEmbeddingStore()
+        self.query = np.array([0.6, 0.8, 0.0], dtype=np.float32)
+
+    def test_iterative_scan(self):
+        statements = self.store.search_statements((1, 2), 'model@main', self.query, 5, exclude_ids=[7])
+
+        self.assertEqual([sql for sql, _ in statements[:2]], [
+            "SET LOCAL hnsw.ef_search = 40",
+            "SET LOCAL hnsw.iterative_scan = strict_order",
+        ])
+        sql, params = statements[2]
+        self.assertIn("e.embedding::vector(3) <=> %s::vector(3)", sql)
+        self.assertIn("e.dims = 3", sql)
+        self.assertEqual(params, ['[0.6000000238418579,0.800000011920929,0.0]', 2, 2, 'model@main', [7], '[0.6000000238418579,0.800000011920929,0.0]', 5])
+
+    def test_exact_scan_without_iterative_scan(self):
+        statements = self.store.search_statements((1, 2), 'model@main', self.query, 5, iterative_scan=False)
+
+        self.assertEqual(statements[0], ("SET LOCAL enable_indexscan = off", []))
+        self.assertFalse(any('hnsw' in sql for sql, _ in statements))
+
+    def test_settings_are_local_to_a_transaction(self):
+        from django.db import connection
+
+        executed = []
+        cursor = MagicMock()
+        cursor.db.alias = 'pgvector-test'
+        cursor.execute.side_effect = lambda sql, params=None: executed.append(sql)
+        cursor.fetchone.return_value = ('0.8.0',)
+        cursor.fetchall.return_value = [(11, 0.93)]
+        context = MagicMock()
+        context.__enter__.return_value = cursor
+
+        with patch.object(connection, 'cursor', return_value=context), patch.dict(embedding_store._iterative_scan, clear=True):
+            matches = self.store.search((1, 2), 'model@main', self.query, 5)
+
+        self.assertEqual(matches, [(11, 0.93)])
+        # The test runs in a transaction already, so the search's own is a savepoint
+        self.assertTrue(executed[0].startswith("SAVEPOINT"))
+        self.assertTrue(executed[-1].startswith("RELEASE SAVEPOINT"))
+        self.assertEqual(executed[2:4], ["SET LOCAL hnsw.ef_search = 40", "SET LOCAL hnsw.iterative_scan = strict_order"])
+
+
+class InferenceBackendTestCase(TestCase):
+    """Test cases for selectable inference backends and the fp32 parity check"""
+
+    pairs = [
+        ("A variable stores a value.", "A variable is a named value."),
+        ("Lists are mutable.", "Tuples are immutable."),
+        ("A variable stores a value.", "A variable stores a value."),
+    ]
+
+    def setUp(self):
+        embedding_cache.memory_cache.clear()
+
+    def tearDown(self):
+        embedding_cache.memory_cache.clear()
+
+    def test_backend_is_part_of_model_version(self):
+        self.assertEqual(embeddings.model_tag('long'), 'sentence-transformers/all-mpnet-base-v2@main')
+        with override_settings(EMBEDDING_BACKENDS={'long': 'onnx-int8'}):
+            self.assertEqual(embeddings.model_tag('long'), 'sentence-transformers/all-mpnet-base-v2@main+onnx-int8')
+            self.assertEqual(embeddings.model_tag('short'), 'sentence-transformers/all-MiniLM-L6-v2@main')
+
+    def test_parity_report(self):
+        fakes = {
+            'torch': FakeSentenceModel(),
+            'onnx-int8': NoisyFakeSentenceModel(noise=0.001),
+            'torch-int8': NoisyFakeSentenceModel(noise=0.5),
+        }
+        with patch('cognigrade.utils.embeddings.get_model', side_effect=lambda answer_type, backend: fakes[backend]):
+            close = check_backend_parity(self.pairs, 'short', 'onnx-int8')
+            far = check_backend_parity(self.pairs, 'short', 'torch-int8')
+
+        self.assertEqual(close['pairs'], 3)
+        self.assertTrue(close['passed'])
+        self.assertLess(close['max_abs_diff'], 0.02)
+        self.assertFalse(far['passed'])
+        self.assertGreater(far['max_abs_diff'], 0.02)
+
+
+class EmbeddingServiceTestCase(TestCase):
+    """Test cases for the out-of-process embedding service and its client"""
+
+    def setUp(self):
+        self.model = FakeSentenceModel()
+        self.model_patch = patch('cognigrade.utils.embeddings.get_model', return_value=self.model)
+        self.model_patch.start()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        socket_path = os.path.join(self.tmpdir.name, 'embeddings.sock')
+        self.settings_patch = override_settings(
+            EMBEDDING_SERVICE_ADDRESS=f'unix:{socket_path}',
+            EMBEDDING_SERVICE_AUTHKEY='test-service-key',
+            EMBEDDING_CACHE_PERSIST=False
+        )
+        self.settings_patch.enable()
+        self.server = EmbeddingServer(socket_path, max_batch_size=64, max_latency=0.2)
+        self.server.start()
+        embedding_cache.memory_cache.clear()
+
+    def tearDown(self):
+        self.server.stop()
+        self.settings_patch.disable()
+        self.model_patch.stop()
+        self.tmpdir.cleanup()
+        embedding_cache.memory_cache.clear()
+
+    def test_concurrent_requests_share_a_forward_pass(self):
+        texts = [[f"Answer {i} about variables."] for i in range(4)]
+        results = {}
+
+        def request(i):
+            results[i] = embeddings.encode(texts[i], 'short')
+
+        threads = [threading.Thread(target=request, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(self.model.calls), 1)
+        self.assertEqual(sorted(self.model.calls[0]), sorted(text for batch in texts for text in batch))
+        for i in range(4):
+            np.testing.assert_allclose(results[i], self.model.encode(texts[i], normalize_embeddings=True), atol=1e-6)
+
+    @override_settings(EMBEDDING_WARMUP=True)
+    def test_readiness_reports_service_models(self):
+        response = APIClient().get(reverse('readiness'))
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(set(response.data['models']), {'short', 'long', 'paraphrased'})
+
+
+class EmbeddingServiceConfigTestCase(TestCase):
+    """Test cases for embedding service addresses and keys"""
+
+    def test_parse_address(self):
+        self.assertEqual(parse_address('/run/embeddings.sock'), '/run/embeddings.sock')
+        self.assertEqual(parse_address('unix:/run/embeddings.sock'), '/run/embeddings.sock')
+        self.assertEqual(parse_address('tcp:10.0.0.2:7000'), ('10.0.0.2', 7000))
+
+    def test_invalid_addresses_are_rejected(self):
+        for address in ('localhost', 'localhost:7000', 'tcp:localhost', 'tcp::7000', 'tcp:localhost:http', 'tcp:localhost:70000', ''):
+            with self.assertRaisesMessage(ImproperlyConfigured, 'Invalid embedding service address'):
+                parse_address(address)
+
+    def test_service_and_client_require_an_authkey(self):
+        for authkey in ('', settings.SECRET_KEY):
+            with override_settings(EMBEDDING_SERVICE_AUTHKEY=authkey):
+                with self.assertRaisesMessage(ImproperlyConfigured, 'EMBEDDING_SERVICE_AUTHKEY'):
+                    EmbeddingServer('/tmp/embeddings.sock')
+                with self.assertRaisesMessage(ImproperlyConfigured, 'EMBEDDING_SERVICE_AUTHKEY'):
+                    EmbeddingClient('/tmp/embeddings.sock')
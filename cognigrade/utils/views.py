@@ -1,3 +1,26 @@
-from django.shortcuts import render
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import AllowAny
+from rest_framework.response import Response
+from rest_framework import status
+from cognigrade.utils.embeddings import is_ready, loaded_models
+from cognigrade.utils.inference_service import get_client
 
-# Create your views here.
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def readiness(request):
+    """Readiness probe: 200 once every embedding model is loaded, 503 before that"""
+    client = get_client()
+    if client is None:
+        ready, models = is_ready(), loaded_models()
+    else:
+        # Models are loaded by the embedding service, not this worker
+        try:
+            service = client.status()
+            ready, models = service['ready'], service['models']
+        except Exception:
+            ready, models = False, {}
+    return Response(
+        {'ready': ready, 'models': models},
+        status=status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE
+    )
@@ -15,4 +15,11 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cognigrade.settings')
 
 application = get_wsgi_application()
 
+from django.conf import settings
+
+# Models live in the embedding service when one is configured
+if settings.EMBEDDING_WARMUP and not settings.EMBEDDING_SERVICE_ADDRESS:
+    from cognigrade.utils.embeddings import warm_up
+    warm_up()
+
 app = application
\ No newline at end of file